@@ -82,7 +82,7 @@ services=(
 # Build and push each service
 for service in "${services[@]}"; do
     echo -e "${YELLOW}Building $service...${NC}"
-    docker build -t $ACR_LOGIN_SERVER/$service:latest ./services/$service
+    docker build -t $ACR_LOGIN_SERVER/$service:latest -f ./services/$service/Dockerfile ./services
     
     echo -e "${YELLOW}Pushing $service to ACR...${NC}"
     docker push $ACR_LOGIN_SERVER/$service:latest
@@ -1,8 +1,8 @@
 import React, { useState } from 'react';
 import { Container, Row, Col, Card, Form, Button, Alert, Spinner, Badge, ProgressBar, Tab, Tabs } from 'react-bootstrap';
-import axios from 'axios';
 import StudyResults from './components/StudyResults';
 import ServiceStatus from './components/ServiceStatus';
+import { emptyPlan, applyPlanEvent, streamStudyPlan } from './planStream';
 
 const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8250';
 
@@ -43,12 +43,19 @@ function App() {
     e.preventDefault();
     setLoading(true);
     setError(null);
+    setResults(null);
     
     try {
-      const response = await axios.post(`${API_URL}/plan_rwe_study`, formData);
-      setResults(response.data);
+      // Sections are rendered as soon as the orchestrator streams them
+      let plan = emptyPlan();
+      await streamStudyPlan(API_URL, formData, (event, data) => {
+        plan = applyPlanEvent(plan, event, data);
+        if (plan.protocol_complexity_score != null) {
+          setResults(plan);
+        }
+      });
     } catch (err) {
-      setError(err.response?.data?.detail || 'An error occurred while processing your request');
+      setError(err.message || 'An error occurred while processing your request');
     } finally {
       setLoading(false);
     }
@@ -263,7 +270,7 @@ Key Exclusion Criteria:
               </Alert>
             )}
 
-            {loading && (
+            {loading && !results && (
               <Card>
                 <Card.Body>
                   <div className="loading-spinner">
@@ -277,7 +284,7 @@ Key Exclusion Criteria:
               </Card>
             )}
 
-            {results && !loading && (
+            {results && (
               <StudyResults results={results} />
             )}
 
@@ -87,19 +87,45 @@ function StudyResults({ results }) {
           <Card className="score-card">
             <Card.Body>
               <h5>Estimated Cohort Size</h5>
-              <div className="display-4 text-primary">
-                {results.estimated_total_cohort_size.toLocaleString()}
-              </div>
-              <p className="text-muted">Potential patients available</p>
-              <ProgressBar 
-                now={(results.estimated_total_cohort_size / 100000) * 100} 
-                label={`${Math.round((results.estimated_total_cohort_size / 100000) * 100)}%`}
-              />
+              {results.estimated_total_cohort_size != null ? (
+                <>
+                  <div className="display-4 text-primary">
+                    {results.estimated_total_cohort_size.toLocaleString()}
+                  </div>
+                  <p className="text-muted">Potential patients available</p>
+                  <ProgressBar 
+                    now={(results.estimated_total_cohort_size / 100000) * 100} 
+                    label={`${Math.round((results.estimated_total_cohort_size / 100000) * 100)}%`}
+                  />
+                </>
+              ) : (
+                <p className="text-muted">Cohort estimate unavailable for this plan</p>
+              )}
             </Card.Body>
           </Card>
         </Col>
       </Row>
 
+      {results.complete === false && (
+        <Alert variant="info">
+          Remaining sections are still being analyzed and will appear as they complete...
+        </Alert>
+      )}
+
+      {results.degraded_sections && results.degraded_sections.length > 0 && (
+        <Alert variant="secondary">
+          <Alert.Heading>Partial Results</Alert.Heading>
+          <p>Some sections were not available within the planning deadline:</p>
+          <ul className="mb-0">
+            {results.degraded_sections.map((section) => (
+              <li key={section.section}>
+                <strong>{section.section}</strong>: {section.fallback === 'cache' ? 'shown from cached results' : 'omitted'} ({section.reason})
+              </li>
+            ))}
+          </ul>
+        </Alert>
+      )}
+
       {results.risk_factors && results.risk_factors.length > 0 && (
         <Alert variant="warning">
           <Alert.Heading>Risk Factors Identified</Alert.Heading>
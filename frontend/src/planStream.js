@@ -0,0 +1,104 @@
+// Client for POST /plan_rwe_study/stream (Server-Sent Events over fetch,
+// since EventSource cannot send a request body).
+
+export const emptyPlan = () => ({
+  protocol_complexity_score: null,
+  estimated_total_cohort_size: null,
+  recommended_sites: [],
+  data_sources: [],
+  risk_factors: [],
+  optimization_opportunities: [],
+  degraded_sections: [],
+  soa_burden: null,
+  complete: false
+});
+
+// Fold one stream event into the partially built plan
+export function applyPlanEvent(plan, event, data) {
+  switch (event) {
+    case 'protocol_complexity':
+      return {
+        ...plan,
+        protocol_complexity_score: data.overall_score,
+        risk_factors: data.warnings || [],
+        optimization_opportunities: data.recommendations || []
+      };
+    case 'data_sources':
+      return { ...plan, data_sources: data };
+    case 'data_quality': {
+      const byId = Object.fromEntries(
+        data.filter((assessment) => !assessment.error).map((assessment) => [assessment.source_id, assessment])
+      );
+      return {
+        ...plan,
+        data_sources: plan.data_sources.map((source) => (byId[source.source_id] ? {
+          ...source,
+          quality_assessment: {
+            overall_quality_score: byId[source.source_id].overall_quality_score,
+            quality_metrics: byId[source.source_id].quality_metrics
+          }
+        } : source))
+      };
+    }
+    case 'cohort_estimate':
+      return { ...plan, estimated_total_cohort_size: data.estimated_cohort_size };
+    case 'soa_burden':
+      return { ...plan, soa_burden: data };
+    case 'site_recommendations':
+      return {
+        ...plan,
+        recommended_sites: [...plan.recommended_sites, ...data.sites]
+          .sort((a, b) => b.feasibility_score - a.feasibility_score)
+      };
+    case 'plan':
+      return { ...plan, ...data, complete: true };
+    default:
+      return plan;
+  }
+}
+
+function parseEvent(block) {
+  let event = 'message';
+  const data = [];
+  block.split('\n').forEach((line) => {
+    if (line.startsWith('event:')) event = line.slice(6).trim();
+    else if (line.startsWith('data:')) data.push(line.slice(5).trim());
+  });
+  return { event, data: data.length ? JSON.parse(data.join('\n')) : null };
+}
+
+// Posts the study request and calls onEvent(event, data) for each section as it arrives
+export async function streamStudyPlan(apiUrl, request, onEvent, signal) {
+  const response = await fetch(`${apiUrl}/plan_rwe_study/stream`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', Accept: 'text/event-stream' },
+    body: JSON.stringify(request),
+    signal
+  });
+  if (!response.ok) {
+    const body = await response.json().catch(() => ({}));
+    throw new Error(body.detail || `Request failed with status ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary = buffer.indexOf('\n\n');
+    while (boundary !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      if (block.trim()) {
+        const { event, data } = parseEvent(block);
+        if (event === 'error') {
+          throw new Error(data.detail);
+        }
+        onEvent(event, data);
+      }
+      boundary = buffer.indexOf('\n\n');
+    }
+  }
+}
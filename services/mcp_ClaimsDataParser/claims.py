@@ -0,0 +1,450 @@
+import collections
+import io
+import itertools
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Normalized claim line schema, one fixed-width column file per field. Ids fit
+# UUIDs and typical member/claim numbers; lines with a value wider than its
+# column are rejected rather than truncated.
+COLUMNS = {
+    "claim_id": "S64",
+    "line_number": "int32",
+    "patient_id": "S64",
+    "service_date": "datetime64[D]",
+    "procedure_code": "S8",
+    "diagnosis_code": "S8",
+    "payer_id": "S64",
+    "billed_amount": "float64",
+    "paid_amount": "float64",
+    "units": "float32",
+}
+
+# Header names accepted for each column in CSV extracts (matched case-insensitively)
+CSV_ALIASES = {
+    "claim_id": ("claim_id", "clm_id", "claim_number"),
+    "line_number": ("line_number", "line_num", "clm_line_num"),
+    "patient_id": ("patient_id", "member_id", "bene_id", "subscriber_id"),
+    "service_date": ("service_date", "date_of_service", "dos", "from_date", "clm_from_dt"),
+    "procedure_code": ("procedure_code", "cpt", "hcpcs", "hcpcs_cd", "proc_code"),
+    "diagnosis_code": ("diagnosis_code", "dx", "icd10", "icd_dgns_cd1", "principal_diagnosis"),
+    "payer_id": ("payer_id", "payer", "plan_id"),
+    "billed_amount": ("billed_amount", "charge", "charge_amount", "submitted_charge"),
+    "paid_amount": ("paid_amount", "paid", "line_pmt_amt"),
+    "units": ("units", "service_units", "quantity"),
+}
+REQUIRED_COLUMNS = ("patient_id", "service_date")
+
+FORMATS = ("csv", "x12")
+
+DATASET_ID = re.compile(r"[0-9a-f]{32}")
+
+DEFAULT_BLOCK_BYTES = 4 * 1024 * 1024
+
+
+def peak_rss_mb() -> Optional[float]:
+    """High-water mark of this process's resident set size"""
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class ChunkChannel:
+    """Bounded hand-off of upload chunks from the event loop to a parsing thread.
+
+    `put` blocks while `max_chunks` chunks are waiting, so a slow parser
+    throttles how fast the upload is read instead of buffering it in memory.
+    """
+
+    def __init__(self, max_chunks: int = 16):
+        self.max_chunks = max_chunks
+        self._chunks = collections.deque()
+        self._cond = threading.Condition()
+        self._ended = False
+        self._closed = False
+
+    def offer(self, chunk: bytes) -> Optional[bool]:
+        """Non-blocking put: None if the channel is full"""
+        with self._cond:
+            if self._closed:
+                return False
+            if len(self._chunks) >= self.max_chunks:
+                return None
+            self._chunks.append(chunk)
+            self._cond.notify_all()
+            return True
+
+    def put(self, chunk: bytes) -> bool:
+        """Wait for room and queue the chunk; False once the reader has gone away"""
+        with self._cond:
+            while len(self._chunks) >= self.max_chunks and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return False
+            self._chunks.append(chunk)
+            self._cond.notify_all()
+            return True
+
+    def end(self):
+        """No more chunks will be put"""
+        with self._cond:
+            self._ended = True
+            self._cond.notify_all()
+
+    def close(self):
+        """Stop reading and drop whatever is still queued"""
+        with self._cond:
+            self._closed = True
+            self._chunks.clear()
+            self._cond.notify_all()
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            with self._cond:
+                while not self._chunks and not self._ended and not self._closed:
+                    self._cond.wait()
+                if self._closed or not self._chunks:
+                    return
+                chunk = self._chunks.popleft()
+                self._cond.notify_all()
+            yield chunk
+
+
+def split_blocks(chunks: Iterable[bytes], delimiter: bytes, block_bytes: int = DEFAULT_BLOCK_BYTES) -> Iterator[bytes]:
+    """Regroup arbitrary chunks into blocks of about `block_bytes` that end on `delimiter`"""
+    pending: List[bytes] = []
+    size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size < block_bytes:
+            continue
+        data = b"".join(pending)
+        cut = data.rfind(delimiter) + 1
+        if cut == 0:
+            pending, size = [data], len(data)
+            continue
+        yield data[:cut]
+        pending, size = [data[cut:]], len(data) - cut
+    tail = b"".join(pending)
+    if tail.strip():
+        yield tail
+
+
+def detect_format(head: bytes) -> str:
+    return "x12" if head.lstrip()[:3] == b"ISA" else "csv"
+
+
+def x12_separators(head: bytes):
+    """Element, component and segment separators declared by the ISA header"""
+    isa = head.lstrip()[:106].decode("latin-1")
+    if len(isa) < 106 or not isa.startswith("ISA"):
+        raise ValueError("X12 file must start with a complete ISA segment")
+    return isa[3], isa[104], isa[105]
+
+
+def normalize_header(line: bytes) -> List[str]:
+    """Map a CSV header line to normalized column names (None for unused columns)"""
+    lookup = {alias: name for name, aliases in CSV_ALIASES.items() for alias in aliases}
+    fields = [f.strip().strip('"').lower().replace(" ", "_") for f in line.decode("utf-8-sig").split(",")]
+    names = [lookup.get(f) for f in fields]
+    missing = [name for name in REQUIRED_COLUMNS if name not in names]
+    if missing:
+        raise ValueError(f"CSV header is missing required columns: {', '.join(missing)}")
+    return names
+
+
+def normalize_frame(frame: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """Vectorized conversion of raw string columns to the normalized schema.
+
+    The extra "oversized" mask flags lines with a text value wider than its
+    column; the writer rejects them.
+    """
+    n = len(frame)
+    oversized = np.zeros(n, dtype=bool)
+
+    def text(name: str, upper: bool = False) -> np.ndarray:
+        if name not in frame:
+            return np.zeros(n, dtype=COLUMNS[name])
+        # Converted at the batch's own width first so that nothing is cut off unseen
+        try:
+            values = frame[name].to_numpy(dtype="S")
+        except UnicodeEncodeError:
+            values = frame[name].str.encode("utf-8").to_numpy(dtype="S")
+        values = np.char.strip(values)
+        if upper:
+            values = np.char.replace(np.char.upper(values), b".", b"")
+        oversized[np.char.str_len(values) > np.dtype(COLUMNS[name]).itemsize] = True
+        return values.astype(COLUMNS[name])
+
+    def number(name: str, default: float) -> np.ndarray:
+        if name not in frame:
+            return np.full(n, default, dtype=COLUMNS[name])
+        values = frame[name]
+        if not pd.api.types.is_numeric_dtype(values):
+            # Only columns the CSV reader could not parse as numbers go through the slow path
+            values = pd.to_numeric(values, errors="coerce")
+        return values.to_numpy(dtype=COLUMNS[name], na_value=default)
+
+    return {
+        "claim_id": text("claim_id"),
+        "line_number": number("line_number", 1),
+        "patient_id": text("patient_id"),
+        "service_date": pd.to_datetime(frame["service_date"], errors="coerce").to_numpy(dtype="datetime64[D]"),
+        "procedure_code": text("procedure_code", upper=True),
+        "diagnosis_code": text("diagnosis_code", upper=True),
+        "payer_id": text("payer_id"),
+        "billed_amount": number("billed_amount", np.nan),
+        "paid_amount": number("paid_amount", np.nan),
+        "units": number("units", 1),
+        "oversized": oversized,
+    }
+
+
+def parse_csv_blocks(blocks: Iterable[bytes]) -> Iterator[Dict[str, np.ndarray]]:
+    """Parse a CSV claim line extract block by block; the first line is the header.
+
+    Each block is parsed by pandas on its own, so memory stays proportional to
+    the block size. Records must not contain embedded newlines.
+    """
+    names: Optional[List[str]] = None
+    for block in blocks:
+        if names is None:
+            header, _, block = block.partition(b"\n")
+            names = normalize_header(header.rstrip(b"\r"))
+            usecols = [i for i, name in enumerate(names) if name is not None]
+        if not block.strip():
+            continue
+        frame = pd.read_csv(
+            io.BytesIO(block), header=None, usecols=usecols, names=[n or f"_{i}" for i, n in enumerate(names)],
+            dtype={name: str for name in names if name and COLUMNS[name].startswith(("S", "datetime"))},
+            keep_default_na=False, skip_blank_lines=True
+        )
+        yield normalize_frame(frame)
+
+
+def parse_x12_blocks(
+    blocks: Iterable[bytes],
+    element: str = "*",
+    component: str = ":",
+    terminator: str = "~",
+    batch_rows: int = 50000,
+) -> Iterator[Dict[str, np.ndarray]]:
+    """Parse an X12 837 claim file into one record per service line (SV1/SV2).
+
+    Subscriber (NM1*IL), payer (NM1*PR), claim (CLM), principal diagnosis (HI)
+    and service date (DTP*472, falling back to the claim's DTP*434) carry over
+    from the enclosing loops. Blocks must end on a segment terminator.
+    """
+    patient_id = payer_id = claim_id = diagnosis = ""
+    claim_date = None
+    line_number = 0
+    line: Optional[Dict] = None
+    batch: Dict[str, List] = {name: [] for name in COLUMNS}
+
+    def emit(record: Dict):
+        record["service_date"] = record["service_date"] or claim_date
+        for name in COLUMNS:
+            batch[name].append(record[name])
+
+    for block in blocks:
+        text = block.decode("latin-1")
+        for segment in text.split(terminator):
+            segment = segment.strip()
+            if not segment:
+                continue
+            fields = segment.split(element)
+            tag = fields[0]
+            if tag in ("CLM", "LX", "SE", "HL") and line is not None:
+                emit(line)
+                line = None
+            if tag == "NM1" and len(fields) > 9:
+                if fields[1] in ("IL", "QC"):
+                    patient_id = fields[9]
+                elif fields[1] == "PR":
+                    payer_id = fields[9]
+            elif tag == "CLM":
+                claim_id, diagnosis, claim_date = fields[1], "", None
+                line_number = 0
+            elif tag == "HI" and not diagnosis and len(fields) > 1:
+                code = fields[1].split(component)
+                diagnosis = code[1] if len(code) > 1 else ""
+            elif tag == "DTP" and len(fields) > 3:
+                date = fields[3].split("-")[0]
+                if fields[1] == "472" and line is not None:
+                    line["service_date"] = date
+                elif fields[1] in ("434", "472"):
+                    claim_date = date
+            elif tag in ("SV1", "SV2"):
+                offset = 1 if tag == "SV1" else 2
+                procedure = fields[offset].split(component) if len(fields) > offset else []
+                line_number += 1
+                line = {
+                    "claim_id": claim_id,
+                    "line_number": line_number,
+                    "patient_id": patient_id,
+                    "service_date": None,
+                    "procedure_code": procedure[1] if len(procedure) > 1 else "",
+                    "diagnosis_code": diagnosis,
+                    "payer_id": payer_id,
+                    "billed_amount": fields[offset + 1] if len(fields) > offset + 1 else "",
+                    "paid_amount": "",
+                    "units": fields[offset + 3] if len(fields) > offset + 3 else "",
+                }
+        if len(batch["claim_id"]) >= batch_rows:
+            yield normalize_frame(pd.DataFrame(batch, dtype=str))
+            batch = {name: [] for name in COLUMNS}
+    if line is not None:
+        emit(line)
+    if batch["claim_id"]:
+        yield normalize_frame(pd.DataFrame(batch, dtype=str))
+
+
+class ColumnarWriter:
+    """Appends normalized batches to one raw column file per field.
+
+    Files are written under a temporary directory that is renamed into place by
+    `commit`, so a failed upload never leaves a partial dataset behind.
+    """
+
+    def __init__(self, root: str, dataset_id: str):
+        self.path = os.path.join(root, dataset_id)
+        self.dataset_id = dataset_id
+        self._tmp = os.path.join(root, f".{dataset_id}.tmp")
+        os.makedirs(self._tmp)
+        self._files = {name: open(os.path.join(self._tmp, f"{name}.bin"), "wb") for name in COLUMNS}
+        self.rows = 0
+        self.rejected = 0
+        self.oversized = 0
+
+    def write(self, batch: Dict[str, np.ndarray]):
+        valid = (batch["patient_id"] != b"") & ~np.isnat(batch["service_date"]) & ~batch["oversized"]
+        self.rejected += int((~valid).sum())
+        self.oversized += int(batch["oversized"].sum())
+        for name, f in self._files.items():
+            np.asarray(batch[name][valid], dtype=COLUMNS[name]).tofile(f)
+        self.rows += int(valid.sum())
+
+    def commit(self, meta: Dict) -> Dict:
+        for f in self._files.values():
+            f.close()
+        meta = {
+            "dataset_id": self.dataset_id,
+            "rows": self.rows,
+            "rejected_rows": self.rejected,
+            "oversized_rows": self.oversized,
+            "columns": COLUMNS,
+            **meta,
+        }
+        with open(os.path.join(self._tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        os.replace(self._tmp, self.path)
+        return meta
+
+    def abort(self):
+        for f in self._files.values():
+            f.close()
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+
+class DatasetNotFoundError(KeyError):
+    """Raised for an unknown claims dataset id"""
+
+
+class ClaimsDataset:
+    """Memory-mapped columns of a parsed claims upload"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        rows = self.meta["rows"]
+        self.columns = {
+            name: np.memmap(os.path.join(path, f"{name}.bin"), dtype=dtype, mode="r", shape=(rows,))
+            if rows else np.zeros(0, dtype=dtype)
+            for name, dtype in self.meta["columns"].items()
+        }
+
+    def __len__(self) -> int:
+        return self.meta["rows"]
+
+    @classmethod
+    def open(cls, root: str, dataset_id: str) -> "ClaimsDataset":
+        path = os.path.join(root, dataset_id)
+        if not DATASET_ID.fullmatch(dataset_id) or not os.path.exists(os.path.join(path, "meta.json")):
+            raise DatasetNotFoundError(dataset_id)
+        return cls(path)
+
+
+def ingest_claims(
+    chunks: Iterable[bytes],
+    root: str,
+    dataset_id: str,
+    file_format: Optional[str] = None,
+    block_bytes: int = DEFAULT_BLOCK_BYTES,
+) -> Dict:
+    """Stream a CSV or X12 837 claims file into a columnar dataset under `root`.
+
+    Chunks flow through a generator pipeline (line- or segment-aligned blocks,
+    then parsed batches, then column files), so only about one block is held in
+    memory at a time whatever the size of the file. Returns the dataset's
+    metadata with throughput and peak RSS.
+    """
+    started = time.perf_counter()
+    received = 0
+
+    def counted(source: Iterable[bytes]) -> Iterator[bytes]:
+        nonlocal received
+        for chunk in source:
+            received += len(chunk)
+            yield chunk
+
+    chunks = counted(chunks)
+    head = []
+    for chunk in chunks:
+        head.append(chunk)
+        if sum(map(len, head)) >= 512:
+            break
+    first = b"".join(head)
+    file_format = file_format or detect_format(first)
+    if file_format not in FORMATS:
+        raise ValueError(f"format must be one of: {', '.join(FORMATS)}")
+    chunks = itertools.chain([first], chunks)
+
+    if file_format == "x12":
+        element, component, terminator = x12_separators(first)
+        blocks = split_blocks(chunks, terminator.encode("latin-1"), block_bytes)
+        batches = parse_x12_blocks(blocks, element, component, terminator)
+    else:
+        batches = parse_csv_blocks(split_blocks(chunks, b"\n", block_bytes))
+
+    os.makedirs(root, exist_ok=True)
+    writer = ColumnarWriter(root, dataset_id)
+    try:
+        for batch in batches:
+            writer.write(batch)
+    except BaseException:
+        writer.abort()
+        raise
+    elapsed = time.perf_counter() - started
+    return writer.commit({
+        "format": file_format,
+        "bytes": received,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": int(writer.rows / elapsed) if elapsed > 0 else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "created_at": time.time(),
+    })
@@ -0,0 +1,364 @@
+import collections
+import json
+import os
+import re
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from costs import KeyDictionary
+
+# Code systems accepted in code-set files, and which claim field each applies to
+SYSTEMS = {"icd10": "diagnosis", "cpt": "procedure", "hcpcs": "procedure"}
+
+# Input symbols: 0 is the separator (anything that is not a letter or digit)
+SYMBOLS = np.zeros(256, dtype=np.uint8)
+for _i, _c in enumerate(b"abcdefghijklmnopqrstuvwxyz0123456789", start=1):
+    SYMBOLS[_c] = _i
+    SYMBOLS[bytes([_c]).upper()[0]] = _i
+ALPHABET_SIZE = 37
+
+MAX_RANGE_CODES = 1000
+MATCH_BATCH_ROWS = 100_000
+
+SAMPLE_CODE_SETS = [
+    {
+        "name": "type_2_diabetes",
+        "description": "Type 2 diabetes mellitus",
+        "icd10": ["E11"],
+        "terms": ["type 2 diabetes", "diabetes mellitus type 2", "t2dm"],
+    },
+    {
+        "name": "diabetes_any",
+        "description": "Diabetes mellitus, any type",
+        "icd10": ["E08", "E09", "E10", "E11", "E13"],
+        "terms": ["diabetes", "diabetic"],
+    },
+    {
+        "name": "hypertension",
+        "description": "Hypertensive diseases",
+        "icd10": ["I10-I16"],
+        "terms": ["hypertension", "high blood pressure"],
+    },
+    {
+        "name": "heart_failure",
+        "description": "Heart failure",
+        "icd10": ["I50", "I11.0", "I13.0", "I13.2"],
+        "terms": ["heart failure", "chf"],
+    },
+    {
+        "name": "chronic_kidney_disease",
+        "description": "Chronic kidney disease",
+        "icd10": ["N18"],
+        "terms": ["chronic kidney disease", "ckd"],
+    },
+    {
+        "name": "office_visit",
+        "description": "Office or other outpatient E/M visit",
+        "cpt": ["99202-99205", "99211-99215"],
+        "terms": ["office visit", "outpatient visit"],
+    },
+    {
+        "name": "hba1c_test",
+        "description": "Hemoglobin A1c testing",
+        "cpt": ["83036", "83037", "3044F-3046F"],
+        "terms": ["hemoglobin a1c", "hba1c", "glycated hemoglobin"],
+    },
+    {
+        "name": "insulin",
+        "description": "Insulin administration and supplies",
+        "hcpcs": ["J1815", "J1817", "S5550-S5553"],
+        "terms": ["insulin"],
+    },
+]
+
+
+def normalize_code(code: str) -> str:
+    return code.strip().upper().replace(".", "").rstrip("*")
+
+
+def normalize_text(text: bytes) -> bytes:
+    """Lowercase words separated by single spaces"""
+    return re.sub(rb"[^a-z0-9]+", b" ", text.lower()).strip()
+
+
+def expand_code(code: str) -> List[str]:
+    """A code or prefix, or a range like 99202-99205 with a shared non-numeric part"""
+    if "-" not in code:
+        return [normalize_code(code)]
+    low, high = (normalize_code(part) for part in code.split("-", 1))
+    low_match, high_match = re.fullmatch(r"(\D*)(\d+)(\D*)", low), re.fullmatch(r"(\D*)(\d+)(\D*)", high)
+    if (not low_match or not high_match or len(low) != len(high)
+            or low_match.group(1, 3) != high_match.group(1, 3)):
+        raise ValueError(f"Unsupported code range {code}")
+    prefix, start, suffix = low_match.groups()
+    end = int(high_match.group(2))
+    if not int(start) <= end < int(start) + MAX_RANGE_CODES:
+        raise ValueError(f"Code range {code} must be ascending and span at most {MAX_RANGE_CODES} codes")
+    return [f"{prefix}{n:0{len(start)}d}{suffix}" for n in range(int(start), end + 1)]
+
+
+def encode(texts: Sequence[bytes], pad: bool) -> np.ndarray:
+    """Texts as rows of input symbols; `pad` adds a separator on each side for whole-word matching"""
+    if pad:
+        texts = [b" " + t + b" " for t in texts]
+    width = max((len(t) for t in texts), default=1) or 1
+    raw = np.array(texts, dtype=f"S{width}")
+    return SYMBOLS[raw.view(np.uint8).reshape(len(texts), width)]
+
+
+class PatternAutomaton:
+    """Multi-pattern matcher compiled to a dense transition table.
+
+    Anchored automata are plain prefix tries: every pattern that is a prefix of
+    the input matches, which is how ICD-10 categories cover their subcodes.
+    Unanchored automata add Aho-Corasick failure transitions so patterns match
+    anywhere in the input. Either way, matching is a table lookup per input
+    symbol, run for a whole batch of inputs at once.
+    """
+
+    def __init__(self, patterns: Iterable[Tuple[Sequence[int], int]], sets: int, anchored: bool):
+        children: List[Dict[int, int]] = [{}]
+        outputs: List[set] = [set()]
+        for symbols, set_index in patterns:
+            node = 0
+            for symbol in symbols:
+                if symbol not in children[node]:
+                    children[node][symbol] = len(children)
+                    children.append({})
+                    outputs.append(set())
+                node = children[node][symbol]
+            outputs[node].add(set_index)
+
+        states = len(children) + (1 if anchored else 0)
+        delta = np.zeros((states, ALPHABET_SIZE), dtype=np.int32)
+        if anchored:
+            dead = states - 1
+            delta[:] = dead
+            for node, edges in enumerate(children):
+                for symbol, child in edges.items():
+                    delta[node, symbol] = child
+            outputs.append(set())
+        else:
+            fail = [0] * len(children)
+            queue = collections.deque()
+            for symbol in range(ALPHABET_SIZE):
+                child = children[0].get(symbol)
+                if child is not None:
+                    delta[0, symbol] = child
+                    queue.append(child)
+            while queue:
+                node = queue.popleft()
+                outputs[node] |= outputs[fail[node]]
+                for symbol in range(ALPHABET_SIZE):
+                    child = children[node].get(symbol)
+                    if child is None:
+                        delta[node, symbol] = delta[fail[node], symbol]
+                    else:
+                        fail[child] = delta[fail[node], symbol]
+                        delta[node, symbol] = child
+                        queue.append(child)
+
+        self.words = max(1, -(-sets // 64))
+        self.delta = delta
+        self.out = np.zeros((states, self.words), dtype=np.uint64)
+        for node, matched in enumerate(outputs):
+            for set_index in matched:
+                self.out[node, set_index // 64] |= np.uint64(1) << np.uint64(set_index % 64)
+
+    @property
+    def states(self) -> int:
+        return len(self.delta)
+
+    def match(self, symbols: np.ndarray) -> np.ndarray:
+        """Bitmask of the code sets matched by each input row, shape (rows, words)"""
+        rows = len(symbols)
+        state = np.zeros(rows, dtype=np.int32)
+        hits = np.zeros((rows, self.words), dtype=np.uint64)
+        for column in range(symbols.shape[1]):
+            state = self.delta[state, symbols[:, column]]
+            hits |= self.out[state]
+        return hits
+
+
+class CodeSetMatcher:
+    """Maps claim lines to code sets of interest.
+
+    Built once from the code-set files: diagnosis (ICD-10) and procedure
+    (CPT/HCPCS) codes go into two prefix tries, description terms into one
+    Aho-Corasick automaton. Batches are matched per distinct value, so a
+    million claim lines cost about as much as their few thousand distinct codes.
+    """
+
+    def __init__(self, code_sets: List[Dict]):
+        self.code_sets = code_sets
+        self.names = [code_set["name"] for code_set in code_sets]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError("Code set names must be unique")
+        patterns = {"diagnosis": [], "procedure": [], "description": []}
+        for index, code_set in enumerate(code_sets):
+            for system, field in SYSTEMS.items():
+                for code in code_set.get(system, []):
+                    patterns[field].extend((normalize_code(c).encode(), index) for c in expand_code(code))
+            for term in code_set.get("terms", []):
+                patterns["description"].append((b" " + normalize_text(term.encode()) + b" ", index))
+
+        def compile_patterns(items, anchored: bool) -> PatternAutomaton:
+            encoded = [(SYMBOLS[np.frombuffer(text, dtype=np.uint8)].tolist(), index) for text, index in items]
+            if anchored:
+                encoded = [(symbols, index) for symbols, index in encoded if symbols]
+            return PatternAutomaton(encoded, len(code_sets), anchored)
+
+        self.automata = {
+            "diagnosis": compile_patterns(patterns["diagnosis"], anchored=True),
+            "procedure": compile_patterns(patterns["procedure"], anchored=True),
+            "description": compile_patterns(patterns["description"], anchored=False),
+        }
+        self.patterns = {field: len(items) for field, items in patterns.items()}
+
+    def match_values(self, field: str, values: Sequence[bytes]) -> np.ndarray:
+        """Code-set bitmask for each value, matching each distinct value once"""
+        if not len(values):
+            return np.zeros((0, self.automata[field].words), dtype=np.uint64)
+        local, uniques = pd.factorize(np.asarray(values, dtype=object))
+        uniques = list(uniques)
+        if field == "description":
+            uniques = [normalize_text(text) for text in uniques]
+        hits = np.concatenate([
+            self.automata[field].match(encode(uniques[i:i + MATCH_BATCH_ROWS], pad=field == "description"))
+            for i in range(0, len(uniques), MATCH_BATCH_ROWS)
+        ])
+        return hits[local]
+
+    def decode(self, hits: np.ndarray) -> List[str]:
+        """Names of the code sets in one bitmask row"""
+        return [
+            name for index, name in enumerate(self.names)
+            if int(hits[index // 64]) >> (index % 64) & 1
+        ]
+
+    def set_mask(self, hits: np.ndarray, index: int) -> np.ndarray:
+        return (hits[:, index // 64] >> np.uint64(index % 64)) & np.uint64(1) == 1
+
+    def match_lines(self, lines: List[Dict]) -> List[Dict]:
+        """Code sets matched by each claim line, and the fields that matched them"""
+        fields = {
+            "procedure": [normalize_code(line.get("procedure_code") or "").encode() for line in lines],
+            "description": [(line.get("description") or "").encode("utf-8", "replace") for line in lines],
+        }
+        diagnosis_owner, diagnosis_codes = [], []
+        for row, line in enumerate(lines):
+            for code in line.get("diagnosis_codes") or []:
+                diagnosis_owner.append(row)
+                diagnosis_codes.append(normalize_code(code).encode())
+
+        words = self.automata["diagnosis"].words
+        by_field = {field: self.match_values(field, values) for field, values in fields.items()}
+        diagnosis = np.zeros((len(lines), words), dtype=np.uint64)
+        if diagnosis_codes:
+            np.bitwise_or.at(diagnosis, np.array(diagnosis_owner), self.match_values("diagnosis", diagnosis_codes))
+        by_field["diagnosis"] = diagnosis
+
+        results = []
+        for row in range(len(lines)):
+            matched_on = {
+                field: self.decode(by_field[field][row])
+                for field in ("diagnosis", "procedure", "description")
+            }
+            union = by_field["diagnosis"][row] | by_field["procedure"][row] | by_field["description"][row]
+            results.append({
+                "code_sets": self.decode(union),
+                "matched_on": {field: names for field, names in matched_on.items() if names},
+            })
+        return results
+
+    def match_dataset(self, columns: Dict[str, np.ndarray], top_codes: int = 10) -> Dict[str, Dict]:
+        """Claim lines, patients and most frequent matching codes per code set over a parsed dataset"""
+        hits = {}
+        codes = {}
+        for field, column in (("diagnosis", "diagnosis_code"), ("procedure", "procedure_code")):
+            local, uniques = pd.factorize(np.asarray(columns[column]).view(np.uint64))
+            unique_codes = uniques.view(columns[column].dtype)
+            hits[field] = (local, self.automata[field].match(SYMBOLS[unique_codes.view(np.uint8).reshape(-1, 8)]))
+            codes[field] = unique_codes
+
+        patients = KeyDictionary()
+        patient_codes = patients.lookup(np.asarray(columns["patient_id"]), add=True)
+        summary = {}
+        for index, name in enumerate(self.names):
+            line_mask = np.zeros(len(patient_codes), dtype=bool)
+            top: Dict[str, int] = {}
+            for field, (local, unique_hits) in hits.items():
+                matched_codes = self.set_mask(unique_hits, index)
+                if not matched_codes.any():
+                    continue
+                field_mask = matched_codes[local]
+                line_mask |= field_mask
+                counts = np.bincount(local[field_mask], minlength=len(matched_codes))
+                for code in np.flatnonzero(counts):
+                    key = codes[field][code].decode()
+                    top[key] = top.get(key, 0) + int(counts[code])
+            summary[name] = {
+                "lines": int(line_mask.sum()),
+                "patients": int(np.count_nonzero(np.bincount(patient_codes[line_mask], minlength=len(patients)))),
+                "top_codes": dict(sorted(top.items(), key=lambda item: -item[1])[:top_codes]),
+            }
+        return summary
+
+
+def filter_patients(columns: Dict[str, np.ndarray], filters: Dict) -> Dict:
+    """Patients of a parsed dataset passing a criteria plan's claims filters.
+
+    `filters` holds code-prefix filters over claim line columns (see
+    CriteriaPlan.claims_filters). Each code column is factorized once and
+    prefixes are tested against its distinct codes only; every filter then
+    reduces to one boolean per patient, so inclusion and exclusion combine as
+    array logic over patients rather than over claim lines.
+    """
+    patients = KeyDictionary()
+    patient_codes = patients.lookup(np.asarray(columns["patient_id"]), add=True)
+    factorized = {}
+
+    def evaluate(node: Dict) -> np.ndarray:
+        if "field" in node:
+            field = node["field"]
+            if field not in factorized:
+                local, uniques = pd.factorize(np.asarray(columns[field]).view(np.uint64))
+                factorized[field] = (local, uniques.view(columns[field].dtype))
+            local, unique_codes = factorized[field]
+            matched = np.zeros(len(unique_codes), dtype=bool)
+            for prefix in node["prefixes"]:
+                matched |= np.char.startswith(unique_codes, normalize_code(prefix).encode())
+            return np.bincount(patient_codes[matched[local]], minlength=len(patients)) > 0
+        if "all" in node:
+            return np.logical_and.reduce([evaluate(child) for child in node["all"]])
+        return np.logical_or.reduce([evaluate(child) for child in node["any"]])
+
+    cohort = np.ones(len(patients), dtype=bool)
+    for node in filters.get("inclusion", []):
+        cohort &= evaluate(node)
+    for node in filters.get("exclusion", []):
+        cohort &= ~evaluate(node)
+    return {"patient_count": int(cohort.sum()), "dataset_patients": len(patients)}
+
+
+def load_code_sets(path: str) -> List[Dict]:
+    """Code sets from every .json file under `path` (each a set or a list of sets)"""
+    code_sets = []
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(path, name)) as f:
+            content = json.load(f)
+        code_sets.extend(content if isinstance(content, list) else [content])
+    return code_sets
+
+
+def load_or_create_matcher(path: str) -> CodeSetMatcher:
+    """Compile the code sets under `path`, writing the sample code sets first if it is empty"""
+    os.makedirs(path, exist_ok=True)
+    if not any(name.endswith(".json") for name in os.listdir(path)):
+        with open(os.path.join(path, "sample.json"), "w") as f:
+            json.dump(SAMPLE_CODE_SETS, f, indent=2)
+    return CodeSetMatcher(load_code_sets(path))
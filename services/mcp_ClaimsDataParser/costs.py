@@ -0,0 +1,409 @@
+import collections
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from claims import ClaimsDataset
+
+# Rollup name -> claims column it groups by
+GROUPINGS = {
+    "patient": "patient_id",
+    "procedure_code": "procedure_code",
+    "month": "service_date",
+    "payer": "payer_id",
+}
+MEASURES = ("lines", "billed_amount", "paid_amount", "paid_lines", "units")
+METRICS = ("paid_amount", "billed_amount", "lines", "units")
+
+# The cube holds one row per (procedure code, payer, month) with lines; every
+# rollup except per-patient is re-aggregated from it instead of the claim lines
+CUBE_DIMENSIONS = ("procedure_code", "payer", "month")
+CUBE_CODE_BITS = 21
+
+AGGREGATES_VERSION = 1
+BUILD_CHUNK_ROWS = 4_000_000
+MAX_TOP = 1000
+
+_HASH_MULTIPLIERS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9], dtype=np.uint64)
+
+
+def key_hash(values: np.ndarray) -> np.ndarray:
+    """64-bit hash of fixed-width keys; exact (the value itself) for 8-byte keys"""
+    if values.dtype.itemsize == 8:
+        return np.ascontiguousarray(values).view(np.uint64)
+    width = -(-values.dtype.itemsize // 8) * 8
+    words = np.ascontiguousarray(values, dtype=f"S{width}").view(np.uint64).reshape(len(values), -1)
+    hashes = np.zeros(len(values), dtype=np.uint64)
+    for i in range(words.shape[1]):
+        hashes ^= words[:, i] * _HASH_MULTIPLIERS[i % len(_HASH_MULTIPLIERS)]
+        hashes = (hashes << np.uint64(31)) | (hashes >> np.uint64(33))
+    return hashes
+
+
+class KeyDictionary:
+    """Dense integer codes for the distinct values of one column.
+
+    Built chunk by chunk: each chunk is factorized by key hash and only its
+    distinct keys are looked up in (and appended to) the dictionary. Every
+    lookup is checked against the stored key bytes, so a hash collision fails
+    loudly instead of merging two groups.
+    """
+
+    def __init__(self, keys: Optional[np.ndarray] = None):
+        self._parts: List[np.ndarray] = [] if keys is None else [keys]
+        self._index = pd.Index(key_hash(keys) if keys is not None else np.array([], dtype=np.uint64))
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def keys(self) -> np.ndarray:
+        if len(self._parts) > 1:
+            self._parts = [np.concatenate(self._parts)]
+        return self._parts[0]
+
+    def lookup(self, values: np.ndarray, add: bool = False) -> np.ndarray:
+        """Code of each value; -1 for values not in the dictionary unless `add`"""
+        if not len(values):
+            return np.zeros(0, dtype=np.int64)
+        local, unique_hashes = pd.factorize(key_hash(values))
+        exact = values.dtype.itemsize == 8
+        if exact:
+            unique_values = unique_hashes.view(values.dtype)
+        else:
+            first = np.empty(len(unique_hashes), dtype=np.int64)
+            first[local[::-1]] = np.arange(len(values) - 1, -1, -1)
+            unique_values = values[first]
+            if not np.array_equal(unique_values[local], values):
+                raise ValueError("Hash collision between claim keys")
+
+        codes = self._index.get_indexer(unique_hashes).astype(np.int64)
+        new = codes < 0
+        if add and new.any():
+            codes[new] = len(self) + np.arange(new.sum())
+            self._parts.append(unique_values[new])
+            self._index = self._index.append(pd.Index(unique_hashes[new]))
+        known = codes >= 0
+        if not exact and len(self) and not np.array_equal(self.keys[codes[known]], unique_values[known]):
+            raise ValueError("Hash collision between claim keys")
+        return codes[local]
+
+
+def chunk_keys(columns: Dict[str, np.ndarray], grouping: str, rows: slice) -> np.ndarray:
+    values = np.asarray(columns[GROUPINGS[grouping]][rows])
+    return values.astype("datetime64[M]") if grouping == "month" else values
+
+
+def chunk_measures(columns: Dict[str, np.ndarray], rows: slice) -> Dict[str, np.ndarray]:
+    billed = np.asarray(columns["billed_amount"][rows])
+    paid = np.asarray(columns["paid_amount"][rows])
+    return {
+        "lines": np.ones(len(billed)),
+        "billed_amount": np.nan_to_num(billed),
+        "paid_amount": np.nan_to_num(paid),
+        "paid_lines": (~np.isnan(paid)).astype(np.float64),
+        "units": np.asarray(columns["units"][rows], dtype=np.float64),
+    }
+
+
+def add_bincounts(totals: Dict[str, np.ndarray], codes: np.ndarray, measures: Dict[str, np.ndarray], size: int):
+    """Add per-code sums of each measure into `totals`, growing it to `size` groups"""
+    for name in MEASURES:
+        sums = np.bincount(codes, weights=measures[name], minlength=size)
+        current = totals.get(name, np.zeros(0))
+        grown = np.zeros(size)
+        grown[:len(current)] = current
+        totals[name] = grown + sums
+
+
+def subset(values: Dict[str, np.ndarray], selector) -> Dict[str, np.ndarray]:
+    return {name: column[selector] for name, column in values.items()}
+
+
+class CostQuery:
+    """Validated /analyze_costs parameters"""
+
+    def __init__(self, data: Dict):
+        self.group_by = data.get("group_by") or list(GROUPINGS)
+        unknown = [g for g in self.group_by if g not in GROUPINGS]
+        if unknown:
+            raise ValueError(f"Unknown group_by {unknown}; expected any of {list(GROUPINGS)}")
+        self.metric = data.get("metric")
+        if self.metric is not None and self.metric not in METRICS:
+            raise ValueError(f"metric must be one of {list(METRICS)}")
+        self.top = data.get("top", 20)
+        if not isinstance(self.top, int) or not 0 < self.top <= MAX_TOP:
+            raise ValueError(f"top must be an integer between 1 and {MAX_TOP}")
+
+        filters = data.get("filters") or {}
+        try:
+            self.start_month = np.datetime64(filters["start_month"], "M") if filters.get("start_month") else None
+            self.end_month = np.datetime64(filters["end_month"], "M") if filters.get("end_month") else None
+        except ValueError:
+            raise ValueError("start_month and end_month must be formatted YYYY-MM")
+        self.procedure_codes = filters.get("procedure_codes")
+        self.payers = filters.get("payers")
+        for values in (self.procedure_codes, self.payers):
+            if values is not None and not (isinstance(values, list) and all(isinstance(v, str) for v in values)):
+                raise ValueError("procedure_codes and payers must be lists of strings")
+
+    @property
+    def filtered(self) -> bool:
+        return any(f is not None for f in (self.start_month, self.end_month, self.procedure_codes, self.payers))
+
+    def key_masks(self, keys: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Per-dimension boolean masks over dictionary keys"""
+        masks = {}
+        if self.procedure_codes is not None:
+            codes = [c.strip().upper().replace(".", "").encode() for c in self.procedure_codes]
+            masks["procedure_code"] = np.isin(keys["procedure_code"], np.array(codes, dtype="S"))
+        if self.payers is not None:
+            masks["payer"] = np.isin(keys["payer"], np.array([p.encode() for p in self.payers], dtype="S"))
+        if self.start_month is not None or self.end_month is not None:
+            months = keys["month"]
+            mask = np.ones(len(months), dtype=bool)
+            if self.start_month is not None:
+                mask &= months >= self.start_month
+            if self.end_month is not None:
+                mask &= months <= self.end_month
+            masks["month"] = mask
+        return masks
+
+
+class CostAggregates:
+    """Precomputed cost tables for one claims dataset.
+
+    Holds per-patient totals and a procedure code x payer x month cube, both
+    built in one chunked pass over the claim lines. Procedure, payer and month
+    rollups (filtered or not) are re-aggregated from the cube, which is orders
+    of magnitude smaller than the claim lines; only filtered per-patient
+    rollups go back to the lines.
+    """
+
+    def __init__(self, dataset: ClaimsDataset, keys: Dict[str, np.ndarray],
+                 patients: Dict[str, np.ndarray], cube: Dict[str, np.ndarray], meta: Dict):
+        self.dataset = dataset
+        self.keys = keys
+        self.patients = patients
+        self.cube = cube
+        self.meta = meta
+        self._patient_dictionary: Optional[KeyDictionary] = None
+
+    @classmethod
+    def build(cls, dataset: ClaimsDataset, chunk_rows: int = BUILD_CHUNK_ROWS) -> "CostAggregates":
+        started = time.perf_counter()
+        dictionaries = {grouping: KeyDictionary() for grouping in GROUPINGS}
+        cells = KeyDictionary()
+        patients: Dict[str, np.ndarray] = {}
+        cube: Dict[str, np.ndarray] = {}
+
+        for start in range(0, len(dataset), chunk_rows):
+            rows = slice(start, start + chunk_rows)
+            codes = {
+                grouping: dictionary.lookup(chunk_keys(dataset.columns, grouping, rows), add=True)
+                for grouping, dictionary in dictionaries.items()
+            }
+            if max(len(dictionaries[d]) for d in CUBE_DIMENSIONS) >= 1 << CUBE_CODE_BITS:
+                raise ValueError(f"More than {1 << CUBE_CODE_BITS} distinct values in a cost dimension")
+            measures = chunk_measures(dataset.columns, rows)
+            add_bincounts(patients, codes["patient"], measures, len(dictionaries["patient"]))
+
+            packed = np.zeros(len(measures["lines"]), dtype=np.int64)
+            for dimension in CUBE_DIMENSIONS:
+                packed = (packed << CUBE_CODE_BITS) | codes[dimension]
+            cell_codes = cells.lookup(packed, add=True)
+            add_bincounts(cube, cell_codes, measures, len(cells))
+
+        packed = cells.keys if len(cells) else np.zeros(0, dtype=np.int64)
+        for i, dimension in enumerate(reversed(CUBE_DIMENSIONS)):
+            cube[dimension] = ((packed >> (i * CUBE_CODE_BITS)) & ((1 << CUBE_CODE_BITS) - 1)).astype(np.int32)
+        keys = {
+            grouping: dictionary.keys if len(dictionary) else np.zeros(0, dtype=dataset.columns[GROUPINGS[grouping]].dtype)
+            for grouping, dictionary in dictionaries.items()
+        }
+        keys["month"] = keys["month"].astype("datetime64[M]")
+        patients = patients or {name: np.zeros(0) for name in MEASURES}
+        for name in MEASURES:
+            cube.setdefault(name, np.zeros(0))
+        meta = {
+            "version": AGGREGATES_VERSION,
+            "rows": len(dataset),
+            "cells": len(packed),
+            "build_seconds": round(time.perf_counter() - started, 3),
+        }
+        return cls(dataset, keys, patients, cube, meta)
+
+    def save(self, path: str):
+        tmp = f"{path}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        tables = {"keys": self.keys, "patients": self.patients, "cube": self.cube}
+        for table, columns in tables.items():
+            for name, values in columns.items():
+                np.save(os.path.join(tmp, f"{table}.{name}.npy"), values)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(self.meta, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, dataset: ClaimsDataset, path: str) -> "CostAggregates":
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != AGGREGATES_VERSION or meta.get("rows") != len(dataset):
+            raise FileNotFoundError(f"Stale cost aggregates at {path}")
+
+        def table(name: str, columns) -> Dict[str, np.ndarray]:
+            return {c: np.load(os.path.join(path, f"{name}.{c}.npy"), mmap_mode="r") for c in columns}
+
+        return cls(
+            dataset,
+            table("keys", GROUPINGS),
+            table("patients", MEASURES),
+            table("cube", (*CUBE_DIMENSIONS, *MEASURES)),
+            meta,
+        )
+
+    def cube_mask(self, query: CostQuery) -> Optional[np.ndarray]:
+        masks = query.key_masks(self.keys)
+        if not masks:
+            return None
+        mask = np.ones(len(self.cube["lines"]), dtype=bool)
+        for dimension, key_mask in masks.items():
+            mask &= key_mask[self.cube[dimension]]
+        return mask
+
+    def filtered_patients(self, query: CostQuery) -> Dict[str, np.ndarray]:
+        """Per-patient totals over the claim lines that pass the query's filters"""
+        if self._patient_dictionary is None:
+            self._patient_dictionary = KeyDictionary(np.asarray(self.keys["patient"]))
+        masks = query.key_masks(self.keys)
+        dictionaries = {d: KeyDictionary(np.asarray(self.keys[d])) for d in masks}
+        totals: Dict[str, np.ndarray] = {}
+        columns = self.dataset.columns
+        size = len(self.keys["patient"])
+        for start in range(0, len(self.dataset), BUILD_CHUNK_ROWS):
+            rows = slice(start, start + BUILD_CHUNK_ROWS)
+            keep = np.ones(len(columns["patient_id"][rows]), dtype=bool)
+            for dimension, key_mask in masks.items():
+                keep &= key_mask[dictionaries[dimension].lookup(chunk_keys(columns, dimension, rows))]
+            codes = self._patient_dictionary.lookup(np.asarray(columns["patient_id"][rows])[keep])
+            add_bincounts(totals, codes, subset(chunk_measures(columns, rows), keep), size)
+        return totals or {name: np.zeros(size) for name in MEASURES}
+
+    def rollup(self, grouping: str, query: CostQuery, cube: Dict[str, np.ndarray]) -> Tuple[Dict[str, np.ndarray], str]:
+        """Totals per key of `grouping` and whether they came from the precomputed tables"""
+        if grouping == "patient":
+            if query.filtered:
+                return self.filtered_patients(query), "claim_lines"
+            return self.patients, "precomputed"
+        size = len(self.keys[grouping])
+        return {
+            name: np.bincount(cube[grouping], weights=cube[name], minlength=size) for name in MEASURES
+        }, "precomputed"
+
+    def analyze(self, query: CostQuery) -> Dict:
+        started = time.perf_counter()
+        cube_mask = self.cube_mask(query)
+        cube = self.cube if cube_mask is None else subset(self.cube, cube_mask)
+        totals = {name: measure_value(name, np.sum(cube[name])) for name in MEASURES}
+        metric = query.metric or ("paid_amount" if totals["paid_lines"] else "billed_amount")
+
+        rollups = {}
+        for grouping in query.group_by:
+            sums, source = self.rollup(grouping, query, cube)
+            present = np.flatnonzero(sums["lines"])
+            if grouping == "month":
+                selected = present[np.argsort(self.keys["month"][present])]
+            else:
+                values = sums[metric][present]
+                keep = np.arange(len(values))
+                if len(values) > query.top:
+                    keep = np.argpartition(-values, query.top - 1)[:query.top]
+                selected = present[keep[np.argsort(-values[keep], kind="stable")]]
+            if grouping == "patient":
+                totals["patients"] = len(present)
+            rollups[grouping] = {
+                "groups": len(present),
+                "source": source,
+                "rows": [
+                    {
+                        "key": format_key(self.keys[grouping][i]),
+                        **{name: measure_value(name, sums[name][i]) for name in MEASURES},
+                        "share": round(float(sums[metric][i]) / totals[metric], 4) if totals[metric] else 0.0,
+                    }
+                    for i in selected
+                ],
+            }
+
+        if "patients" not in totals and not query.filtered:
+            totals["patients"] = int(np.count_nonzero(self.patients["lines"]))
+        if totals.get("patients"):
+            totals["cost_per_patient"] = round(totals[metric] / totals["patients"], 2)
+        return {
+            "metric": metric,
+            "totals": totals,
+            "rollups": rollups,
+            "query_ms": round((time.perf_counter() - started) * 1000, 2),
+        }
+
+
+def measure_value(name: str, value):
+    return int(value) if name in ("lines", "paid_lines") else round(float(value), 2)
+
+
+def format_key(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+
+class AggregateStore:
+    """Cost aggregates per dataset, kept in memory for the most recently used datasets.
+
+    Aggregates are built on the first query of a dataset and saved next to its
+    columns, so later queries (and restarts) reuse them. Datasets are immutable
+    once uploaded, so saved aggregates never go stale.
+    """
+
+    def __init__(self, root: str, capacity: int = 8):
+        self.root = root
+        self.capacity = capacity
+        self._loaded: "collections.OrderedDict[str, CostAggregates]" = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._building: Dict[str, threading.Lock] = collections.defaultdict(threading.Lock)
+
+    def get(self, dataset_id: str) -> Tuple[CostAggregates, str]:
+        """Aggregates for the dataset and how they were obtained: cached, loaded or built"""
+        with self._lock:
+            if dataset_id in self._loaded:
+                self._loaded.move_to_end(dataset_id)
+                return self._loaded[dataset_id], "cached"
+            build_lock = self._building[dataset_id]
+
+        with build_lock:
+            with self._lock:
+                if dataset_id in self._loaded:
+                    return self._loaded[dataset_id], "cached"
+            try:
+                dataset = ClaimsDataset.open(self.root, dataset_id)
+                path = os.path.join(dataset.path, "aggregates")
+                try:
+                    aggregates, source = CostAggregates.load(dataset, path), "loaded"
+                except FileNotFoundError:
+                    aggregates, source = CostAggregates.build(dataset), "built"
+                    aggregates.save(path)
+                with self._lock:
+                    self._loaded[dataset_id] = aggregates
+                    while len(self._loaded) > self.capacity:
+                        self._loaded.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._building.pop(dataset_id, None)
+        return aggregates, source
@@ -1,11 +1,46 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Dict, List, Optional
 from datetime import datetime
+from contextlib import asynccontextmanager
+import asyncio
+import os
 import random
+import uuid
 
-app = FastAPI(title="Claims Data Parser MCP Service")
+from claims import DEFAULT_BLOCK_BYTES, FORMATS, ChunkChannel, ClaimsDataset, DatasetNotFoundError, ingest_claims
+from codesets import CodeSetMatcher, filter_patients, load_or_create_matcher
+from costs import AggregateStore, CostQuery
+from utils.criteria import CriteriaError, CriteriaPlan
+
+# Parsed uploads are stored here as one columnar dataset per upload
+CLAIMS_DATA_DIR = os.getenv("CLAIMS_DATA_DIR", "data/claims")
+CLAIMS_BLOCK_BYTES = int(os.getenv("CLAIMS_BLOCK_BYTES", DEFAULT_BLOCK_BYTES))
+
+# Precomputed cost tables, built on a dataset's first /analyze_costs and saved with it
+cost_store = AggregateStore(CLAIMS_DATA_DIR, capacity=int(os.getenv("COST_CACHE_DATASETS", 8)))
+
+# Code sets matched by /identify_procedures, compiled once from the .json files here;
+# sample code sets are written if the directory has none
+CODESET_PATH = os.getenv("CODESET_PATH", "data/codesets")
+IDENTIFY_BATCH_MAX = int(os.getenv("IDENTIFY_BATCH_MAX", 100000))
+
+_matcher: Optional[CodeSetMatcher] = None
+
+def get_matcher() -> CodeSetMatcher:
+    global _matcher
+    if _matcher is None:
+        _matcher = load_or_create_matcher(CODESET_PATH)
+    return _matcher
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_matcher()
+    yield
+
+app = FastAPI(title="Claims Data Parser MCP Service", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -39,40 +74,186 @@ async def parse_claims(data: Dict):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/parse_claims/upload")
+async def upload_claims(request: Request, format: Optional[str] = None):
+    """Stream a CSV or X12 837 claims file into a columnar dataset.
+
+    The request body is the raw file. It is read chunk by chunk and handed to a
+    parsing thread through a bounded channel, so the file is never held in
+    memory and a slow parser slows the upload down rather than piling it up.
+    """
+    if format is not None and format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(FORMATS)}")
+
+    dataset_id = uuid.uuid4().hex
+    channel = ChunkChannel()
+
+    def parse():
+        try:
+            return ingest_claims(channel, CLAIMS_DATA_DIR, dataset_id, format, CLAIMS_BLOCK_BYTES)
+        finally:
+            channel.close()
+
+    parsing = asyncio.ensure_future(run_in_threadpool(parse))
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            accepted = channel.offer(chunk)
+            if accepted is None:
+                accepted = await run_in_threadpool(channel.put, chunk)
+            if not accepted:
+                break
+    except BaseException:
+        channel.close()
+        await asyncio.gather(parsing, return_exceptions=True)
+        raise
+    channel.end()
+
+    try:
+        summary = await parsing
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {
+        "status": "success",
+        "service": "mcp_ClaimsDataParser",
+        "endpoint": "parse_claims/upload",
+        "timestamp": datetime.now().isoformat(),
+        "data": summary
+    }
+
 @app.post("/analyze_costs")
 async def analyze_costs(data: Dict):
-    """"Analyze healthcare costs from claims"""
+    """"Analyze healthcare costs from claims.
+
+    Rolls up the claim lines of an uploaded dataset per patient, procedure
+    code, month and payer. Rollups are served from aggregate tables built on
+    the dataset's first analysis and reused by every later query.
+    """
+    dataset_id = data.get("dataset_id")
+    if not dataset_id:
+        raise HTTPException(status_code=400, detail="dataset_id is required (see /parse_claims/upload)")
     try:
-        # Mock implementation
-        # In production, this would call actual dcri-mcp-tools
+        query = CostQuery(data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        aggregates, source = await run_in_threadpool(cost_store.get, dataset_id)
+    except DatasetNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset_id {dataset_id}")
+    try:
+        analysis = await run_in_threadpool(aggregates.analyze, query)
         result = {
             "status": "success",
             "service": "mcp_ClaimsDataParser",
             "endpoint": "analyze_costs",
             "timestamp": datetime.now().isoformat(),
             "data": {
-                "mock_result": f"Processed by analyze_costs",
-                "confidence": round(random.uniform(0.7, 0.95), 2)
+                "dataset_id": dataset_id,
+                **analysis,
+                "aggregates": {"source": source, **aggregates.meta}
             }
         }
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/code_sets")
+async def list_code_sets():
+    matcher = get_matcher()
+    return {
+        "code_sets": [
+            {"name": code_set["name"], "description": code_set.get("description")}
+            for code_set in matcher.code_sets
+        ],
+        "patterns": matcher.patterns
+    }
+
 @app.post("/identify_procedures")
 async def identify_procedures(data: Dict):
-    """"Identify procedures and diagnoses from claims"""
+    """"Identify procedures and diagnoses from claims.
+
+    Maps claim lines to the loaded ICD-10/CPT/HCPCS code sets. Accepts one line
+    (`procedure_code`, `diagnosis_codes`, `description`), a batch under `lines`,
+    or a parsed upload's `dataset_id` for per-code-set line and patient counts.
+    """
+    dataset_id = data.get("dataset_id")
+    lines = data.get("lines")
+    single = lines is None and any(k in data for k in ("procedure_code", "diagnosis_codes", "description"))
+    if single:
+        lines = [data]
+    if lines is None and not dataset_id:
+        raise HTTPException(status_code=400, detail="Provide a claim line, a list of lines or a dataset_id")
+    if lines is not None:
+        if not isinstance(lines, list) or not all(isinstance(line, dict) for line in lines):
+            raise HTTPException(status_code=400, detail="lines must be a list of objects")
+        if len(lines) > IDENTIFY_BATCH_MAX:
+            raise HTTPException(status_code=400, detail=f"At most {IDENTIFY_BATCH_MAX} lines per request")
+
+    matcher = get_matcher()
+    if lines is None:
+        try:
+            dataset = ClaimsDataset.open(CLAIMS_DATA_DIR, dataset_id)
+        except DatasetNotFoundError:
+            raise HTTPException(status_code=404, detail=f"Unknown dataset_id {dataset_id}")
     try:
-        # Mock implementation
-        # In production, this would call actual dcri-mcp-tools
+        if lines is None:
+            matches = {"dataset_id": dataset_id, "code_sets": await run_in_threadpool(matcher.match_dataset, dataset.columns)}
+        else:
+            results = await run_in_threadpool(matcher.match_lines, lines)
+            matches = results[0] if single else {"results": results}
         result = {
             "status": "success",
             "service": "mcp_ClaimsDataParser",
             "endpoint": "identify_procedures",
             "timestamp": datetime.now().isoformat(),
+            "data": matches
+        }
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/count_patients")
+async def count_patients(data: Dict):
+    """"Count the patients of a parsed upload meeting a cohort definition.
+
+    Takes a `dataset_id` and a shared `criteria_plan` (or free-text
+    `inclusion_criteria`/`exclusion_criteria`, compiled here). Diagnosis and
+    procedure predicates are evaluated as code-prefix filters over the claim
+    lines; predicates claims cannot express (demographics, drugs, labs, free
+    text) are returned as `not_applied`.
+    """
+    dataset_id = data.get("dataset_id")
+    if not dataset_id:
+        raise HTTPException(status_code=400, detail="dataset_id is required (see /parse_claims/upload)")
+    try:
+        if data.get("criteria_plan") is not None:
+            plan = CriteriaPlan.from_dict(data["criteria_plan"])
+        else:
+            plan = CriteriaPlan.from_text(data.get("inclusion_criteria") or [], data.get("exclusion_criteria") or [])
+    except CriteriaError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        dataset = ClaimsDataset.open(CLAIMS_DATA_DIR, dataset_id)
+    except DatasetNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset_id {dataset_id}")
+    try:
+        filters = plan.claims_filters()
+        counts = await run_in_threadpool(filter_patients, dataset.columns, filters)
+        result = {
+            "status": "success",
+            "service": "mcp_ClaimsDataParser",
+            "endpoint": "count_patients",
+            "timestamp": datetime.now().isoformat(),
             "data": {
-                "mock_result": f"Processed by identify_procedures",
-                "confidence": round(random.uniform(0.7, 0.95), 2)
+                "dataset_id": dataset_id,
+                **counts,
+                "plan_hash": plan.hash,
+                "not_applied": filters["not_applied"]
             }
         }
         return result
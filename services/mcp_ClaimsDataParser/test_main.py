@@ -1,6 +1,16 @@
 import pytest
+import os
+import tempfile
 from fastapi.testclient import TestClient
+
+DATA_DIR = tempfile.mkdtemp()
+os.environ.setdefault("CLAIMS_DATA_DIR", os.path.join(DATA_DIR, "claims"))
+os.environ.setdefault("CLAIMS_BLOCK_BYTES", "1024")
+os.environ.setdefault("CODESET_PATH", os.path.join(DATA_DIR, "codesets"))
+
 from main import app
+from claims import ClaimsDataset
+from utils.criteria import CriteriaPlan
 
 client = TestClient(app)
 
@@ -38,6 +48,237 @@ def test_all_endpoints():
     for endpoint in endpoints:
         response = client.post(f"/{endpoint}", json=test_data)
         assert response.status_code in [200, 400, 422, 500]
-        
+
+
+X12_837 = (
+    "ISA*00*          *00*          *ZZ*SUBMITTER      *ZZ*RECEIVER       "
+    "*230101*1200*^*00501*000000001*0*P*:~\n"
+    "GS*HC*SUBMITTER*RECEIVER*20230101*1200*1*X*005010X222A1~ST*837*0001~"
+    "HL*1**20*1~HL*2*1*22*0~SBR*P*18~NM1*IL*1*DOE*JOHN****MI*M123~NM1*PR*2*ACME*****PI*PAYER9~"
+    "CLM*CL1*300***11:B:1~DTP*434*RD8*20230105-20230106~HI*ABK:E119*ABF:I10~"
+    "LX*1~SV1*HC:99213:25*125*UN*1***1~DTP*472*D8*20230110~"
+    "LX*2~SV1*HC:80053*175*UN*2***1~SE*20*0001~"
+)
+
+def test_upload_claims_csv_streams_into_columns():
+    lines = ["Member_ID,Claim_ID,DOS,CPT,DX,Payer,Charge,Paid,Units"]
+    lines += [f"P{i % 7},C{i},2023-03-{1 + i % 28:02d},9921{i % 5},E11.9,PAY{i % 3},{100 + i}.5,80,1" for i in range(500)]
+    lines.append(",C999,2023-01-01,99213,,PAY1,10,5,1")
+
+    def body():
+        data = ("\n".join(lines) + "\n").encode()
+        for i in range(0, len(data), 300):
+            yield data[i:i + 300]
+
+    response = client.post("/parse_claims/upload", content=body())
+    assert response.status_code == 200
+    summary = response.json()["data"]
+    assert summary["format"] == "csv"
+    assert summary["rows"] == 500
+    assert summary["rejected_rows"] == 1
+    assert summary["rows_per_second"] > 0
+    assert "peak_rss_mb" in summary
+
+    dataset = ClaimsDataset(os.path.join(os.environ["CLAIMS_DATA_DIR"], summary["dataset_id"]))
+    assert len(dataset) == 500
+    assert dataset.columns["claim_id"][499] == b"C499"
+    assert dataset.columns["patient_id"][10] == b"P3"
+    assert str(dataset.columns["service_date"][30]) == "2023-03-03"
+    assert dataset.columns["diagnosis_code"][0] == b"E119"
+    assert dataset.columns["billed_amount"].sum() == sum(100 + i + 0.5 for i in range(500))
+
+def test_upload_claims_x12_837():
+    response = client.post("/parse_claims/upload", content=X12_837.encode())
+    assert response.status_code == 200
+    summary = response.json()["data"]
+    assert summary["format"] == "x12"
+    assert summary["rows"] == 2
+
+    dataset = ClaimsDataset(os.path.join(os.environ["CLAIMS_DATA_DIR"], summary["dataset_id"]))
+    assert list(dataset.columns["procedure_code"]) == [b"99213", b"80053"]
+    assert list(dataset.columns["patient_id"]) == [b"M123", b"M123"]
+    assert list(dataset.columns["payer_id"]) == [b"PAYER9", b"PAYER9"]
+    # The second line has no DTP*472 and falls back to the claim's statement date
+    assert [str(d) for d in dataset.columns["service_date"]] == ["2023-01-10", "2023-01-05"]
+    assert list(dataset.columns["units"]) == [1, 2]
+
+def test_upload_claims_rejects_bad_input():
+    response = client.post("/parse_claims/upload", content=b"claim_id,cpt\nC1,99213\n")
+    assert response.status_code == 400
+    assert "patient_id" in response.json()["detail"]
+
+    response = client.post("/parse_claims/upload?format=xml", content=b"<claims/>")
+    assert response.status_code == 400
+
+    # Nothing is left behind by failed uploads
+    assert not [name for name in os.listdir(os.environ["CLAIMS_DATA_DIR"]) if name.startswith(".")]
+
+def upload_csv(lines):
+    response = client.post("/parse_claims/upload", content=("\n".join(lines) + "\n").encode())
+    assert response.status_code == 200
+    return response.json()["data"]["dataset_id"]
+
+def test_analyze_costs_rollups():
+    lines = ["patient_id,claim_id,service_date,procedure_code,payer_id,billed_amount,paid_amount,units"]
+    lines += [
+        "P1,C1,2023-01-05,99213,AETNA,100,80,1",
+        "P1,C2,2023-01-20,80053,AETNA,50,40,1",
+        "P2,C3,2023-02-03,99213,CIGNA,120,90,1",
+        "P3,C4,2023-02-14,99214,AETNA,200,150,2",
+        "P2,C5,2023-03-01,99213,AETNA,100,70,1",
+    ]
+    dataset_id = upload_csv(lines)
+
+    response = client.post("/analyze_costs", json={"dataset_id": dataset_id, "top": 2})
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert data["metric"] == "paid_amount"
+    assert data["aggregates"]["source"] == "built"
+    assert data["totals"]["paid_amount"] == 430
+    assert data["totals"]["lines"] == 5
+    assert data["totals"]["patients"] == 3
+
+    rollups = data["rollups"]
+    assert [(r["key"], r["paid_amount"]) for r in rollups["patient"]["rows"]] == [("P2", 160), ("P3", 150)]
+    assert rollups["patient"]["groups"] == 3
+    assert [(r["key"], r["lines"]) for r in rollups["procedure_code"]["rows"]] == [("99213", 3), ("99214", 1)]
+    assert [(r["key"], r["paid_amount"]) for r in rollups["month"]["rows"]] == [
+        ("2023-01", 120), ("2023-02", 240), ("2023-03", 70)
+    ]
+    assert [(r["key"], r["paid_amount"]) for r in rollups["payer"]["rows"]] == [("AETNA", 340), ("CIGNA", 90)]
+
+    # Later queries reuse the aggregate tables; filters are applied to them
+    response = client.post("/analyze_costs", json={
+        "dataset_id": dataset_id,
+        "group_by": ["patient", "procedure_code"],
+        "metric": "billed_amount",
+        "filters": {"start_month": "2023-02", "payers": ["AETNA"]}
+    })
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert data["aggregates"]["source"] == "cached"
+    assert data["totals"]["billed_amount"] == 300
+    assert set(data["rollups"]) == {"patient", "procedure_code"}
+    assert [(r["key"], r["billed_amount"]) for r in data["rollups"]["patient"]["rows"]] == [("P3", 200), ("P2", 100)]
+    assert data["rollups"]["patient"]["source"] == "claim_lines"
+
+def test_upload_claims_keeps_long_ids_and_rejects_oversized_values():
+    # Two UUIDs sharing their first 24 characters
+    first, second = "123e4567-e89b-12d3-a456-426614174000", "123e4567-e89b-12d3-a456-426614174999"
+    lines = ["patient_id,claim_id,service_date,procedure_code,payer_id,paid_amount"]
+    lines += [
+        f"{first},CLAIM-{'A' * 40},2023-01-05,99213,AETNA,80",
+        f"{second},C2,2023-01-06,99213,AETNA,40",
+        f"{'X' * 65},C3,2023-01-07,99213,AETNA,10",
+        "P4,C4,2023-01-08,99213-25-XYZ,AETNA,10",
+    ]
+    dataset_id = upload_csv(lines)
+    dataset = ClaimsDataset(os.path.join(os.environ["CLAIMS_DATA_DIR"], dataset_id))
+    assert dataset.meta["rejected_rows"] == 2
+    assert dataset.meta["oversized_rows"] == 2
+    assert list(dataset.columns["patient_id"]) == [first.encode(), second.encode()]
+    assert dataset.columns["claim_id"][0] == f"CLAIM-{'A' * 40}".encode()
+
+    data = client.post("/analyze_costs", json={"dataset_id": dataset_id}).json()["data"]
+    assert data["totals"]["patients"] == 2
+    assert {r["key"] for r in data["rollups"]["patient"]["rows"]} == {first, second}
+
+def test_analyze_costs_validation():
+    assert client.post("/analyze_costs", json={}).status_code == 400
+    assert client.post("/analyze_costs", json={"dataset_id": "0" * 32}).status_code == 404
+    assert client.post("/analyze_costs", json={"dataset_id": "../etc"}).status_code == 404
+    response = client.post("/analyze_costs", json={"dataset_id": "0" * 32, "group_by": ["zip"]})
+    assert response.status_code == 400
+    response = client.post("/analyze_costs", json={"dataset_id": "0" * 32, "filters": {"start_month": "Jan"}})
+    assert response.status_code == 400
+
+def test_identify_procedures_single_line():
+    response = client.post("/identify_procedures", json={
+        "procedure_code": "99213",
+        "diagnosis_codes": ["E11.65", "I10"],
+        "description": "Follow-up for type-2 diabetes"
+    })
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert data["code_sets"] == ["type_2_diabetes", "diabetes_any", "hypertension", "office_visit"]
+    assert data["matched_on"]["procedure"] == ["office_visit"]
+    assert data["matched_on"]["diagnosis"] == ["type_2_diabetes", "diabetes_any", "hypertension"]
+    assert data["matched_on"]["description"] == ["type_2_diabetes", "diabetes_any"]
+
+def test_identify_procedures_batch():
+    lines = [
+        {"procedure_code": "J1815"},
+        {"description": "Insulinoma resection"},
+        {"description": "CHF exacerbation; HbA1c drawn"},
+        {"diagnosis_codes": ["I50.9"], "procedure_code": "83036"},
+        {"diagnosis_codes": ["J18.9"]},
+    ]
+    response = client.post("/identify_procedures", json={"lines": lines})
+    assert response.status_code == 200
+    results = response.json()["data"]["results"]
+    assert [r["code_sets"] for r in results] == [
+        ["insulin"],
+        [],
+        ["heart_failure", "hba1c_test"],
+        ["heart_failure", "hba1c_test"],
+        [],
+    ]
+
+    assert client.post("/identify_procedures", json={"lines": "E11"}).status_code == 400
+    assert client.post("/identify_procedures", json={"dataset_id": "0" * 32}).status_code == 404
+
+def test_identify_procedures_dataset():
+    lines = ["patient_id,service_date,procedure_code,diagnosis_code"]
+    lines += [
+        "P1,2023-01-05,99213,E11.9",
+        "P1,2023-02-05,83036,E11.9",
+        "P2,2023-01-09,99214,I10",
+        "P3,2023-01-12,J1815,E10.9",
+        "P4,2023-03-02,71045,J18.9",
+    ]
+    dataset_id = upload_csv(lines)
+    response = client.post("/identify_procedures", json={"dataset_id": dataset_id})
+    assert response.status_code == 200
+    code_sets = response.json()["data"]["code_sets"]
+    assert code_sets["diabetes_any"]["lines"] == 3
+    assert code_sets["diabetes_any"]["patients"] == 2
+    assert code_sets["office_visit"] == {"lines": 2, "patients": 2, "top_codes": {"99213": 1, "99214": 1}}
+    assert code_sets["hypertension"]["patients"] == 1
+    assert code_sets["chronic_kidney_disease"]["lines"] == 0
+
+def test_list_code_sets():
+    response = client.get("/code_sets")
+    assert response.status_code == 200
+    assert "type_2_diabetes" in [code_set["name"] for code_set in response.json()["code_sets"]]
+
+def test_count_patients_with_criteria_plan():
+    lines = ["patient_id,service_date,procedure_code,diagnosis_code"]
+    lines += [
+        "P1,2023-01-05,99213,E11.9",
+        "P1,2023-02-05,90935,N18.3",
+        "P2,2023-01-09,99214,E11.65",
+        "P3,2023-01-12,99213,E10.9",
+        "P4,2023-03-02,99213,I10",
+        "P5,2023-03-04,99213,O24.4",
+        "P5,2023-03-09,99213,E11.9",
+    ]
+    dataset_id = upload_csv(lines)
+    plan = CriteriaPlan.from_text(["Type 2 diabetes", "Age 18-75 years"], ["Dialysis", "Pregnancy"])
+    response = client.post("/count_patients", json={"dataset_id": dataset_id, "criteria_plan": plan.to_dict()})
+    assert response.status_code == 200
+    data = response.json()["data"]
+    # P1 is excluded by dialysis, P5 by pregnancy, P3 and P4 lack type 2 diabetes
+    assert data["patient_count"] == 1
+    assert data["dataset_patients"] == 5
+    assert data["plan_hash"] == plan.hash
+    assert data["not_applied"] == [{"type": "age", "min": 18, "max": 75}]
+
+    response = client.post("/count_patients", json={
+        "dataset_id": dataset_id, "inclusion_criteria": ["Diabetes or hypertension"]
+    })
+    assert response.json()["data"]["patient_count"] == 5
+    assert client.post("/count_patients", json={"inclusion_criteria": ["Diabetes"]}).status_code == 400
+    assert client.post("/count_patients", json={"dataset_id": "0" * 32}).status_code == 404
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -19,26 +19,59 @@ app.add_middleware(
 async def health_check():
     return {"status": "healthy", "service": "mcp_DiversityIndexMapper"}
 
+def _calculate_country_diversity(country: Optional[str], data: Dict) -> Dict:
+    """Diversity indices for a single country"""
+    # Mock implementation
+    # In production, this would call actual dcri-mcp-tools
+    return {
+        "mock_result": f"Processed by calculate_diversity",
+        "confidence": round(random.uniform(0.7, 0.95), 2)
+    }
+
 @app.post("/calculate_diversity")
 async def calculate_diversity(data: Dict):
     """"Calculate diversity indices for sites"""
     try:
-        # Mock implementation
-        # In production, this would call actual dcri-mcp-tools
         result = {
             "status": "success",
             "service": "mcp_DiversityIndexMapper",
             "endpoint": "calculate_diversity",
             "timestamp": datetime.now().isoformat(),
-            "data": {
-                "mock_result": f"Processed by calculate_diversity",
-                "confidence": round(random.uniform(0.7, 0.95), 2)
-            }
+            "data": _calculate_country_diversity(data.get("country"), data)
         }
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/calculate_diversity_batch")
+async def calculate_diversity_batch(data: Dict):
+    """Calculate diversity indices for several countries in one call.
+
+    Expects "countries" (list) and optionally "sites" mapping each country to
+    candidate site ids; the remaining fields apply to every country.
+    """
+    countries = data.get("countries")
+    if not isinstance(countries, list):
+        raise HTTPException(status_code=400, detail="countries must be a list")
+    try:
+        sites = data.get("sites") or {}
+        shared = {k: v for k, v in data.items() if k not in ("countries", "sites")}
+        results = {}
+        for country in countries:
+            country_data = {**shared, "country": country}
+            results[country] = _calculate_country_diversity(country, country_data)
+            if country in sites:
+                results[country]["sites"] = sites[country]
+        return {
+            "status": "success",
+            "service": "mcp_DiversityIndexMapper",
+            "endpoint": "calculate_diversity_batch",
+            "timestamp": datetime.now().isoformat(),
+            "results": results
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/map_demographics")
 async def map_demographics(data: Dict):
     """"Map demographic distribution"""
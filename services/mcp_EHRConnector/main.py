@@ -1,11 +1,73 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from typing import Dict, List, Optional
-from datetime import datetime
-import random
+from typing import Dict, List, Optional, Tuple
+from datetime import date, datetime
+from contextlib import asynccontextmanager
+import inspect
+import json
+import os
+import threading
+import time
+from functools import partial
 
-app = FastAPI(title="EHR Data Connector MCP Service")
+from omop import (
+    DOMAINS, CriteriaError, compile_criteria, connect, count_patients, decode_cursor, encode_cursor,
+    ensure_store, extract_cursor, extract_key, extract_rows
+)
+from utils.criteria import CriteriaPlan
+from pool import PoolTimeout, SessionNotFoundError, SourcePools, ping
+
+# OMOP-style patient store queried by /query_patients and /extract_clinical_data;
+# a synthetic store of EHR_SAMPLE_PATIENTS patients is generated if none exists
+EHR_DB_PATH = os.getenv("EHR_DB_PATH", "data/ehr.db")
+EHR_SAMPLE_PATIENTS = int(os.getenv("EHR_SAMPLE_PATIENTS", 100000))
+EXTRACT_MAX_ROWS = int(os.getenv("EXTRACT_MAX_ROWS", 1000))
+# Rows fetched from SQLite and written per NDJSON chunk by /extract_clinical_data/stream
+EXTRACT_PAGE_ROWS = int(os.getenv("EXTRACT_PAGE_ROWS", 5000))
+
+def connect_source(path: str, generate: bool = False):
+    """Read-only connection to one EHR source; only the local store is generated if missing"""
+    if generate:
+        ensure_store(path, EHR_SAMPLE_PATIENTS)
+    return connect(path)
+
+# EHR sources by name: the local store as EHR_DEFAULT_SOURCE, plus any read-only
+# stores listed in EHR_SOURCES as comma-separated name=path pairs
+EHR_DEFAULT_SOURCE = os.getenv("EHR_DEFAULT_SOURCE", "omop")
+EHR_SOURCES = {EHR_DEFAULT_SOURCE: partial(connect_source, EHR_DB_PATH, generate=True)}
+for entry in filter(None, os.getenv("EHR_SOURCES", "").split(",")):
+    name, _, path = entry.partition("=")
+    EHR_SOURCES[name.strip()] = partial(connect_source, path.strip())
+
+# One connection pool per source; sessions from /connect_ehr pick the source of later queries
+pools = SourcePools(
+    EHR_SOURCES,
+    pool_settings={
+        "min_size": int(os.getenv("EHR_POOL_MIN_SIZE", 1)),
+        "max_size": int(os.getenv("EHR_POOL_MAX_SIZE", 8)),
+        "idle_timeout": float(os.getenv("EHR_POOL_IDLE_SECONDS", 300)),
+        "max_lifetime": float(os.getenv("EHR_POOL_MAX_LIFETIME_SECONDS", 3600)),
+        "ping_interval": float(os.getenv("EHR_POOL_PING_SECONDS", 30)),
+        "acquire_timeout": float(os.getenv("EHR_POOL_ACQUIRE_TIMEOUT", 10)),
+    },
+    session_ttl=float(os.getenv("EHR_SESSION_TTL_SECONDS", 1800)),
+    interval=float(os.getenv("EHR_POOL_PING_SECONDS", 30))
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ensure_store(EHR_DB_PATH, EHR_SAMPLE_PATIENTS)
+    # Open the default source's min_size connections before the first request
+    pools.pool(EHR_DEFAULT_SOURCE).maintain()
+    pools.start()
+    yield
+    pools.stop()
+
+app = FastAPI(title="EHR Data Connector MCP Service", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,68 +79,295 @@ app.add_middleware(
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "mcp_EHRConnector"}
+    return {"status": "healthy", "service": "mcp_EHRConnector", "connections": pools.status()}
 
 @app.post("/connect_ehr")
 async def connect_ehr(data: Dict):
-    """"Establish connection to EHR system"""
+    """"Establish connection to EHR system.
+
+    Opens a session on `source` (the local store by default) backed by that
+    source's connection pool. Pass the returned `session_id` to /query_patients
+    and /extract_clinical_data to run them against the session's source.
+    """
+    source = data.get("source", EHR_DEFAULT_SOURCE)
+    if source not in EHR_SOURCES:
+        raise HTTPException(status_code=404, detail=f"Unknown EHR source {source}; available: {list(EHR_SOURCES)}")
     try:
-        # Mock implementation
-        # In production, this would call actual dcri-mcp-tools
+        session = await run_in_threadpool(pools.open_session, source)
         result = {
             "status": "success",
             "service": "mcp_EHRConnector",
             "endpoint": "connect_ehr",
             "timestamp": datetime.now().isoformat(),
             "data": {
-                "mock_result": f"Processed by connect_ehr",
-                "confidence": round(random.uniform(0.7, 0.95), 2)
+                "session_id": session.session_id,
+                "source": source,
+                "expires_after_idle_seconds": pools.session_ttl,
+                "pool": pools.pool(source).status()
             }
         }
         return result
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def source_of(data: Dict) -> str:
+    """EHR source of a request: its session's, or the default source without one"""
+    session_id = data.get("session_id")
+    if session_id is None:
+        return EHR_DEFAULT_SOURCE
+    try:
+        return pools.session(str(session_id)).source
+    except SessionNotFoundError:
+        raise HTTPException(status_code=404, detail="Unknown or expired session_id; call /connect_ehr again")
+
+def plan_of(data: Dict) -> Optional[CriteriaPlan]:
+    """Shared criteria plan of a request: a compiled `criteria_plan`, or free-text criteria compiled here"""
+    if data.get("criteria_plan") is not None:
+        return CriteriaPlan.from_dict(data["criteria_plan"])
+    if "inclusion_criteria" in data or "exclusion_criteria" in data:
+        return CriteriaPlan.from_text(data.get("inclusion_criteria") or [], data.get("exclusion_criteria") or [])
+    return None
+
+def criteria_of(data: Dict) -> Tuple[Dict, Dict]:
+    """Structured inclusion/exclusion criteria of a request, checked by compiling them.
+
+    Requests may instead carry a criteria plan; plan predicates holding free
+    text cannot be applied in SQL and are reported back as `not_applied`.
+    """
+    try:
+        plan = plan_of(data)
+    except CriteriaError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if plan is not None:
+        criteria, not_applied = plan.ehr_criteria()
+        return criteria, {"plan_hash": plan.hash, "not_applied": not_applied}
+    criteria = {"inclusion": data.get("inclusion") or [], "exclusion": data.get("exclusion") or []}
+    if not isinstance(criteria["inclusion"], list) or not isinstance(criteria["exclusion"], list):
+        raise HTTPException(status_code=400, detail="inclusion and exclusion must be lists of criteria")
+    try:
+        compile_criteria(criteria)
+    except (CriteriaError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return criteria, {}
+
+# Reference years accepted for age criteria and age bands
+MIN_REFERENCE_YEAR = 1900
+
+def valid_reference_year(year) -> bool:
+    return isinstance(year, int) and not isinstance(year, bool) and MIN_REFERENCE_YEAR <= year <= date.today().year + 1
+
+def reference_year_of(data: Dict) -> int:
+    """Year ages are computed for: the request's `reference_year`, or this year"""
+    year = data.get("reference_year")
+    if year is None:
+        return date.today().year
+    if not valid_reference_year(year):
+        raise HTTPException(
+            status_code=400,
+            detail=f"reference_year must be an integer between {MIN_REFERENCE_YEAR} and {date.today().year + 1}"
+        )
+    return year
+
+def query_store(source: str, run, *args):
+    """Run `run(conn, *args)` on a pooled connection to `source`"""
+    with pools.pool(source).connection() as conn:
+        return run(conn, *args)
+
 @app.post("/query_patients")
 async def query_patients(data: Dict):
-    """"Query patient records from EHR"""
+    """"Query patient records from EHR.
+
+    Counts the patients meeting every `inclusion` criterion and no `exclusion`
+    criterion. Criteria compile to a single SQL query, so no patient rows are
+    read into the service. A shared `criteria_plan` (or free-text
+    `inclusion_criteria`/`exclusion_criteria`) can be sent instead.
+    """
+    criteria, plan_info = criteria_of(data)
+    source = source_of(data)
+    breakdown = data.get("breakdown") or []
+    reference_year = reference_year_of(data)
     try:
-        # Mock implementation
-        # In production, this would call actual dcri-mcp-tools
+        started = time.perf_counter()
+        counts = await run_in_threadpool(query_store, source, count_patients, criteria, breakdown, reference_year)
         result = {
             "status": "success",
             "service": "mcp_EHRConnector",
             "endpoint": "query_patients",
             "timestamp": datetime.now().isoformat(),
             "data": {
-                "mock_result": f"Processed by query_patients",
-                "confidence": round(random.uniform(0.7, 0.95), 2)
+                **counts,
+                **plan_info,
+                "query_ms": round((time.perf_counter() - started) * 1000, 2)
             }
         }
         return result
+    except CriteriaError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def extract_position(data: Dict, criteria: Dict, domain: str):
+    """(key, after, reference_year) of an extract request, resumed from its `cursor` if given"""
+    key = extract_key(criteria, domain, data.get("fields"))
+    cursor = data.get("cursor")
+    if cursor is None:
+        return key, 0, reference_year_of(data)
+    if not isinstance(cursor, str):
+        raise HTTPException(status_code=400, detail="cursor must be a string returned by a previous extract")
+    try:
+        # The cursor pins the reference year so ages cannot shift between pages
+        after, reference_year = decode_cursor(cursor, key)
+    except CriteriaError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not valid_reference_year(reference_year):
+        raise HTTPException(status_code=400, detail="Malformed cursor")
+    return key, after, reference_year
+
 @app.post("/extract_clinical_data")
 async def extract_clinical_data(data: Dict):
-    """"Extract specific clinical data elements"""
+    """"Extract specific clinical data elements.
+
+    Returns the requested `fields` of one `domain` (person, condition, drug,
+    procedure or measurement) for the patients matching the criteria. Only the
+    requested columns are read. Rows come in id order, `limit` at a time; pass
+    `next_cursor` back as `cursor` to fetch the following page.
+    """
+    criteria, plan_info = criteria_of(data)
+    domain = data.get("domain", "person")
+    limit = data.get("limit", 100)
+    if not isinstance(limit, int) or not 0 < limit <= EXTRACT_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"limit must be an integer between 1 and {EXTRACT_MAX_ROWS}")
+    key, after, reference_year = extract_position(data, criteria, domain)
+    source = source_of(data)
     try:
-        # Mock implementation
-        # In production, this would call actual dcri-mcp-tools
+        fields, rows = await run_in_threadpool(
+            query_store, source, extract_rows, criteria, domain, data.get("fields"), limit, reference_year, after
+        )
+        next_cursor = None
+        if len(rows) == limit:
+            next_cursor = encode_cursor(key, rows[-1][fields.index(DOMAINS[domain].id_column)], reference_year)
         result = {
             "status": "success",
             "service": "mcp_EHRConnector",
             "endpoint": "extract_clinical_data",
             "timestamp": datetime.now().isoformat(),
             "data": {
-                "mock_result": f"Processed by extract_clinical_data",
-                "confidence": round(random.uniform(0.7, 0.95), 2)
+                "domain": domain,
+                "fields": fields,
+                "rows": [dict(zip(fields, row)) for row in rows],
+                "next_cursor": next_cursor,
+                **plan_info
             }
         }
         return result
+    except CriteriaError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def open_extract(source: str, criteria: Dict, domain: str, fields, after: int, limit, reference_year: int):
+    """Open cursor of an extract and the callback returning its pooled connection.
+
+    The callback can be called more than once; only the first call closes the
+    cursor and returns the connection.
+    """
+    pool = pools.pool(source)
+    item = pool.acquire()
+    try:
+        fields, cursor = extract_cursor(item.conn, criteria, domain, fields, after, limit, reference_year)
+    except Exception:
+        pool.release(item, broken=not ping(item.conn))
+        raise
+
+    released = threading.Lock()
+
+    def release():
+        if not released.acquire(blocking=False):
+            return
+        cursor.close()
+        pool.release(item)
+    return release, fields, cursor
+
+def ndjson_extract(release, cursor, fields: List[str], id_index: int, key: str, after: int,
+                   reference_year: int, max_rows: Optional[int]):
+    """NDJSON lines of an open extract, EXTRACT_PAGE_ROWS rows per chunk.
+
+    Starlette pulls the next chunk only once the previous one has been handed to
+    the transport, so a slow client pauses the SQLite cursor rather than rows
+    piling up in the service; memory stays at one page whatever the extract size.
+    The pooled connection goes back to the pool once the rows are exhausted or
+    the generator is closed, never while a chunk is being fetched. The last line is a trailer with the row count and, when `max_rows`
+    cut the extract short, the cursor to resume from.
+    """
+    rows_sent = 0
+    try:
+        while True:
+            rows = cursor.fetchmany(EXTRACT_PAGE_ROWS)
+            if not rows:
+                break
+            rows_sent += len(rows)
+            after = rows[-1][id_index]
+            yield "".join(json.dumps(dict(zip(fields, row))) + "\n" for row in rows)
+    finally:
+        release()
+    truncated = max_rows is not None and rows_sent == max_rows
+    yield json.dumps({
+        "rows": rows_sent,
+        "next_cursor": encode_cursor(key, after, reference_year) if truncated else None
+    }) + "\n"
+
+@app.post("/extract_clinical_data/stream")
+async def extract_clinical_data_stream(data: Dict):
+    """"Stream a clinical data extract as NDJSON.
+
+    Same request as /extract_clinical_data, but every matching row is streamed
+    (up to `max_rows` if given) as one JSON object per line, followed by a
+    `{"rows", "next_cursor"}` trailer line.
+    """
+    criteria, _ = criteria_of(data)
+    domain = data.get("domain", "person")
+    max_rows = data.get("max_rows")
+    if max_rows is not None and (not isinstance(max_rows, int) or max_rows <= 0):
+        raise HTTPException(status_code=400, detail="max_rows must be a positive integer")
+    key, after, reference_year = extract_position(data, criteria, domain)
+    source = source_of(data)
+    try:
+        # Open the cursor before responding so bad requests still get a status code
+        release, fields, cursor = await run_in_threadpool(
+            open_extract, source, criteria, domain, data.get("fields"), after, max_rows, reference_year
+        )
+    except CriteriaError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except PoolTimeout as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    id_index = fields.index(DOMAINS[domain].id_column)
+    lines = ndjson_extract(release, cursor, fields, id_index, key, after, reference_year, max_rows)
+
+    def close_extract():
+        """Close the stream once the response is over, even if it was never iterated"""
+        state = inspect.getgeneratorstate(lines)
+        if state == inspect.GEN_CREATED:
+            # An unstarted generator skips its finally block when closed
+            lines.close()
+            release()
+        elif state == inspect.GEN_SUSPENDED:
+            lines.close()
+        # A chunk still being fetched releases the connection when the generator is collected
+
+    return StreamingResponse(
+        lines,
+        media_type="application/x-ndjson",
+        headers={"X-Extract-Fields": ",".join(fields)},
+        background=BackgroundTask(close_extract)
+    )
 
 if __name__ == "__main__":
     import uvicorn
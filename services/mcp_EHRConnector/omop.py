@@ -0,0 +1,313 @@
+import base64
+import binascii
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from datetime import date
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils.criteria import CriteriaError, compile_criteria
+
+SCHEMA = [
+    """CREATE TABLE person (
+        person_id INTEGER PRIMARY KEY,
+        gender_concept_id INTEGER NOT NULL,
+        year_of_birth INTEGER NOT NULL,
+        race_source_value TEXT,
+        ethnicity_source_value TEXT,
+        care_site_id INTEGER
+    )""",
+    """CREATE TABLE condition_occurrence (
+        condition_occurrence_id INTEGER PRIMARY KEY,
+        person_id INTEGER NOT NULL,
+        condition_source_value TEXT NOT NULL,
+        condition_start_date TEXT NOT NULL
+    )""",
+    """CREATE TABLE drug_exposure (
+        drug_exposure_id INTEGER PRIMARY KEY,
+        person_id INTEGER NOT NULL,
+        drug_source_value TEXT NOT NULL,
+        drug_exposure_start_date TEXT NOT NULL
+    )""",
+    """CREATE TABLE procedure_occurrence (
+        procedure_occurrence_id INTEGER PRIMARY KEY,
+        person_id INTEGER NOT NULL,
+        procedure_source_value TEXT NOT NULL,
+        procedure_date TEXT NOT NULL
+    )""",
+    """CREATE TABLE measurement (
+        measurement_id INTEGER PRIMARY KEY,
+        person_id INTEGER NOT NULL,
+        measurement_source_value TEXT NOT NULL,
+        value_as_number REAL,
+        measurement_date TEXT NOT NULL
+    )""",
+]
+
+# Covering indexes: every criterion is answered from an index range scan
+INDEXES = [
+    "CREATE INDEX person_demographics ON person (gender_concept_id, year_of_birth)",
+    "CREATE INDEX person_birth ON person (year_of_birth)",
+    "CREATE INDEX condition_code ON condition_occurrence (condition_source_value, person_id)",
+    "CREATE INDEX drug_code ON drug_exposure (drug_source_value, person_id)",
+    "CREATE INDEX procedure_code ON procedure_occurrence (procedure_source_value, person_id)",
+    "CREATE INDEX measurement_code ON measurement (measurement_source_value, value_as_number, person_id)",
+]
+
+
+class Domain:
+    """One OMOP table that criteria can test and extracts can read"""
+
+    def __init__(self, table: str, id_column: str, code_column: str, date_column: str, fields: Sequence[str]):
+        self.table = table
+        self.id_column = id_column
+        self.code_column = code_column
+        self.date_column = date_column
+        self.fields = tuple(fields)
+
+
+DOMAINS = {
+    "person": Domain(
+        "person", "person_id", None, None,
+        ("person_id", "gender_concept_id", "year_of_birth", "race_source_value", "ethnicity_source_value", "care_site_id"),
+    ),
+    "condition": Domain(
+        "condition_occurrence", "condition_occurrence_id", "condition_source_value", "condition_start_date",
+        ("condition_occurrence_id", "person_id", "condition_source_value", "condition_start_date"),
+    ),
+    "drug": Domain(
+        "drug_exposure", "drug_exposure_id", "drug_source_value", "drug_exposure_start_date",
+        ("drug_exposure_id", "person_id", "drug_source_value", "drug_exposure_start_date"),
+    ),
+    "procedure": Domain(
+        "procedure_occurrence", "procedure_occurrence_id", "procedure_source_value", "procedure_date",
+        ("procedure_occurrence_id", "person_id", "procedure_source_value", "procedure_date"),
+    ),
+    "measurement": Domain(
+        "measurement", "measurement_id", "measurement_source_value", "measurement_date",
+        ("measurement_id", "person_id", "measurement_source_value", "value_as_number", "measurement_date"),
+    ),
+}
+
+BREAKDOWNS = {
+    "gender": "p.gender_concept_id",
+    "age_band": "((? - p.year_of_birth) / 10) * 10",
+}
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Read-only connection to a patient store"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+    conn.execute("PRAGMA query_only = 1")
+    conn.execute("PRAGMA cache_size = -65536")
+    conn.execute("PRAGMA mmap_size = 1073741824")
+    return conn
+
+
+def count_patients(conn: sqlite3.Connection, criteria: Dict, breakdown: Sequence[str] = (),
+                   reference_year: Optional[int] = None) -> Dict:
+    """Number of matching patients, optionally broken down by gender and/or age band"""
+    reference_year = reference_year or date.today().year
+    where, params = compile_criteria(criteria, reference_year)
+    unknown = [b for b in breakdown if b not in BREAKDOWNS]
+    if unknown:
+        raise CriteriaError(f"Unknown breakdown {unknown}; expected any of {list(BREAKDOWNS)}")
+
+    total = conn.execute(f"SELECT COUNT(*) FROM person p WHERE {where}", params).fetchone()[0]
+    result = {"patient_count": total}
+    if breakdown:
+        columns = [BREAKDOWNS[b] for b in breakdown]
+        column_params = [reference_year for b in breakdown if b == "age_band"]
+        rows = conn.execute(
+            f"SELECT {', '.join(columns)}, COUNT(*) FROM person p WHERE {where} "
+            f"GROUP BY {', '.join(str(i + 1) for i in range(len(columns)))} ORDER BY 1",
+            column_params + params,
+        ).fetchall()
+        result["breakdown"] = [dict(zip([*breakdown, "patient_count"], row)) for row in rows]
+    return result
+
+
+def extract_query(criteria: Dict, domain: str, fields: Optional[Sequence[str]] = None,
+                  reference_year: Optional[int] = None) -> Tuple[str, List, List[str]]:
+    """SELECT of the requested columns of `domain` for the matching patients, ordered by row id"""
+    if domain not in DOMAINS:
+        raise CriteriaError(f"domain must be one of {list(DOMAINS)}")
+    table = DOMAINS[domain]
+    fields = list(fields or table.fields)
+    unknown = [f for f in fields if f not in table.fields]
+    if unknown:
+        raise CriteriaError(f"Unknown {domain} fields {unknown}")
+    if table.id_column not in fields:
+        fields.insert(0, table.id_column)
+    where, params = compile_criteria(criteria, reference_year)
+    if domain == "person":
+        # Criteria already apply to the person alias; no join needed
+        columns = ", ".join(f"p.{f}" for f in fields)
+        return f"SELECT {columns} FROM person p WHERE {where}", params, fields
+    columns = ", ".join(f"t.{f}" for f in fields)
+    sql = (
+        f"SELECT {columns} FROM {table.table} t "
+        f"WHERE t.person_id IN (SELECT p.person_id FROM person p WHERE {where})"
+    )
+    return sql, params, fields
+
+
+def extract_cursor(conn: sqlite3.Connection, criteria: Dict, domain: str, fields: Optional[Sequence[str]] = None,
+                   after: int = 0, limit: Optional[int] = None,
+                   reference_year: Optional[int] = None) -> Tuple[List[str], sqlite3.Cursor]:
+    """Open cursor over the extract rows with id > `after`, in id order.
+
+    Keyset pagination: ids are the table's integer primary key, so resuming
+    from `after` is a rowid seek rather than an OFFSET scan, and walking the
+    rowid in order needs no sort buffer however large the extract.
+    """
+    sql, params, fields = extract_query(criteria, domain, fields, reference_year)
+    column = f"{'p' if domain == 'person' else 't'}.{DOMAINS[domain].id_column}"
+    sql = f"{sql} AND {column} > ? ORDER BY {column}"
+    params = [*params, after]
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return fields, conn.execute(sql, params)
+
+
+def extract_rows(conn: sqlite3.Connection, criteria: Dict, domain: str, fields: Optional[Sequence[str]] = None,
+                 limit: int = 100, reference_year: Optional[int] = None,
+                 after: int = 0) -> Tuple[List[str], List[tuple]]:
+    fields, cursor = extract_cursor(conn, criteria, domain, fields, after, limit, reference_year)
+    return fields, cursor.fetchall()
+
+
+def extract_key(criteria: Dict, domain: str, fields: Optional[Sequence[str]]) -> str:
+    """Digest of an extract's definition; cursors are only valid for the extract that issued them"""
+    body = json.dumps({"criteria": criteria, "domain": domain, "fields": list(fields or [])}, sort_keys=True)
+    return hashlib.sha256(body.encode()).hexdigest()[:16]
+
+
+def encode_cursor(key: str, after: int, reference_year: int) -> str:
+    """Opaque token for resuming an extract after row id `after`"""
+    body = json.dumps({"k": key, "a": after, "y": reference_year}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(body.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str, key: str) -> Tuple[int, int]:
+    """(after, reference_year) of a cursor issued for the extract `key`"""
+    try:
+        body = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        after, reference_year = int(body["a"]), int(body["y"])
+        issued_for = body["k"]
+    except (TypeError, ValueError, KeyError, binascii.Error):
+        raise CriteriaError("Malformed cursor")
+    if issued_for != key:
+        raise CriteriaError("Cursor was issued for a different extract")
+    return after, reference_year
+
+
+# Synthetic store: code, prevalence among patients
+SAMPLE_CONDITIONS = [
+    ("E119", 0.10), ("E109", 0.01), ("I10", 0.30), ("I509", 0.04), ("N183", 0.06), ("J449", 0.06),
+    ("C509", 0.02), ("F329", 0.08), ("E785", 0.25), ("M545", 0.10), ("G309", 0.01), ("J45909", 0.07),
+]
+SAMPLE_DRUGS = {
+    # RxNorm ingredient -> condition that makes it likely
+    "6809": "E119",      # metformin
+    "274783": "E109",    # insulin glargine
+    "1545653": "E119",   # empagliflozin
+    "29046": "I10",      # lisinopril
+    "83367": "E785",     # atorvastatin
+    "36437": "F329",     # sertraline
+}
+SAMPLE_PROCEDURES = [("99213", 0.70), ("83036", 0.15), ("93000", 0.20), ("71046", 0.10), ("45378", 0.05)]
+SAMPLE_RACES = ["White", "Black or African American", "Asian", "Other"]
+SAMPLE_RACE_SHARES = [0.62, 0.14, 0.07, 0.17]
+HBA1C = "4548-4"
+SAMPLE_MEASUREMENTS = [("2160-0", 1.0, 0.3), ("8480-6", 128.0, 16.0), ("39156-5", 28.5, 5.5)]
+
+
+def _random_dates(rng: np.random.Generator, n: int) -> List[str]:
+    days = rng.integers(0, 5 * 365, n)
+    return np.datetime_as_string(np.datetime64("2019-01-01") + days).tolist()
+
+
+def generate_sample_store(path: str, patients: int = 100000, seed: int = 0, chunk: int = 100000):
+    """Write a synthetic OMOP-style patient store with correlated conditions, drugs and labs"""
+    rng = np.random.default_rng(seed)
+    tmp = f"{path}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(tmp)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    for ddl in SCHEMA:
+        conn.execute(ddl)
+
+    for start in range(1, patients + 1, chunk):
+        ids = np.arange(start, min(start + chunk, patients + 1))
+        n = len(ids)
+        conn.executemany(
+            "INSERT INTO person VALUES (?, ?, ?, ?, ?, ?)",
+            zip(
+                ids.tolist(),
+                rng.choice([8507, 8532], n).tolist(),
+                rng.integers(1935, 2020, n).tolist(),
+                rng.choice(SAMPLE_RACES, n, p=SAMPLE_RACE_SHARES).tolist(),
+                rng.choice(["Hispanic or Latino", "Not Hispanic or Latino"], n, p=[0.18, 0.82]).tolist(),
+                rng.integers(1, 200, n).tolist(),
+            ),
+        )
+        has = {}
+        for code, prevalence in SAMPLE_CONDITIONS:
+            has[code] = rng.random(n) < prevalence
+            people = ids[has[code]]
+            conn.executemany(
+                "INSERT INTO condition_occurrence (person_id, condition_source_value, condition_start_date) VALUES (?, ?, ?)",
+                zip(people.tolist(), [code] * len(people), _random_dates(rng, len(people))),
+            )
+        for drug, condition in SAMPLE_DRUGS.items():
+            people = ids[(has[condition] & (rng.random(n) < 0.6)) | (rng.random(n) < 0.01)]
+            conn.executemany(
+                "INSERT INTO drug_exposure (person_id, drug_source_value, drug_exposure_start_date) VALUES (?, ?, ?)",
+                zip(people.tolist(), [drug] * len(people), _random_dates(rng, len(people))),
+            )
+        for code, share in SAMPLE_PROCEDURES:
+            people = ids[rng.random(n) < share]
+            conn.executemany(
+                "INSERT INTO procedure_occurrence (person_id, procedure_source_value, procedure_date) VALUES (?, ?, ?)",
+                zip(people.tolist(), [code] * len(people), _random_dates(rng, len(people))),
+            )
+        diabetic = has["E119"] | has["E109"]
+        tested = diabetic | (rng.random(n) < 0.2)
+        hba1c = np.where(diabetic, rng.normal(7.8, 1.3, n), rng.normal(5.4, 0.4, n)).round(1)
+        rows = [(ids[tested], hba1c[tested], HBA1C)]
+        for code, mean, sd in SAMPLE_MEASUREMENTS:
+            measured = rng.random(n) < 0.5
+            rows.append((ids[measured], rng.normal(mean, sd, n)[measured].round(1), code))
+        for people, values, code in rows:
+            conn.executemany(
+                "INSERT INTO measurement (person_id, measurement_source_value, value_as_number, measurement_date) "
+                "VALUES (?, ?, ?, ?)",
+                zip(people.tolist(), [code] * len(people), values.tolist(), _random_dates(rng, len(people))),
+            )
+        conn.commit()
+
+    for ddl in INDEXES:
+        conn.execute(ddl)
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    os.replace(tmp, path)
+
+
+_generate_lock = threading.Lock()
+
+
+def ensure_store(path: str, patients: int = 100000):
+    """Generate the synthetic store at `path` unless a store already exists there"""
+    with _generate_lock:
+        if not os.path.exists(path):
+            generate_sample_store(path, patients)
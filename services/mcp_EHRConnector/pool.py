@@ -0,0 +1,324 @@
+import logging
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """No connection became free within the acquire timeout"""
+
+
+class SessionNotFoundError(KeyError):
+    pass
+
+
+def ping(conn) -> bool:
+    """True if the connection still answers a trivial query"""
+    try:
+        conn.execute("SELECT 1").fetchone()
+        return True
+    except Exception:
+        return False
+
+
+class PooledConnection:
+    __slots__ = ("conn", "created_at", "last_used", "last_checked")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = self.last_used = self.last_checked = time.monotonic()
+
+
+class ConnectionPool:
+    """Bounded pool of connections to one EHR source.
+
+    Idle connections are handed out most-recently-used first, so the ones left
+    at the back of the queue are the ones idle eviction should close. `maintain`
+    closes connections idle for `idle_timeout` (down to `min_size`) or older
+    than `max_lifetime`, pings the rest once per `ping_interval` and tops the
+    pool back up to `min_size`. A connection that fails its ping, or fails one
+    after a query raised, is discarded instead of returned to the pool.
+    """
+
+    def __init__(self, name: str, connect: Callable[[], Any], min_size: int = 1, max_size: int = 8,
+                 idle_timeout: float = 300.0, max_lifetime: float = 3600.0, ping_interval: float = 30.0,
+                 acquire_timeout: float = 10.0):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError("Pool sizes need 0 <= min_size <= max_size and max_size >= 1")
+        self.name = name
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+        self.acquire_timeout = acquire_timeout
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self.counters = {"created": 0, "acquired": 0, "waited": 0, "timeouts": 0,
+                         "evicted_idle": 0, "expired": 0, "broken": 0}
+
+    def _expired(self, item: PooledConnection, now: float) -> bool:
+        return now - item.created_at >= self.max_lifetime
+
+    def _open(self) -> PooledConnection:
+        item = PooledConnection(self.connect())
+        with self._cond:
+            self.counters["created"] += 1
+        return item
+
+    def _discard(self, item: PooledConnection, reason: str):
+        """Close a connection already taken out of the pool's size"""
+        with self._cond:
+            self.counters[reason] += 1
+        try:
+            item.conn.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout: Optional[float] = None) -> PooledConnection:
+        deadline = time.monotonic() + (self.acquire_timeout if timeout is None else timeout)
+        stale = []
+        waited = False
+        try:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout(f"EHR source {self.name} pool is closed")
+                    now = time.monotonic()
+                    while self._idle:
+                        item = self._idle.pop()
+                        if self._expired(item, now):
+                            self._size -= 1
+                            stale.append(item)
+                            continue
+                        self.counters["acquired"] += 1
+                        return item
+                    if self._size < self.max_size:
+                        self._size += 1
+                        self.counters["acquired"] += 1
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.counters["timeouts"] += 1
+                        raise PoolTimeout(f"No connection to EHR source {self.name} free within the timeout")
+                    if not waited:
+                        waited = True
+                        self.counters["waited"] += 1
+                    self._cond.wait(remaining)
+        finally:
+            for item in stale:
+                self._discard(item, "expired")
+        # Open the new connection outside the lock; setup is the slow part
+        try:
+            return self._open()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, item: PooledConnection, broken: bool = False):
+        now = time.monotonic()
+        with self._cond:
+            keep = not (broken or self._closed or self._expired(item, now))
+            if keep:
+                item.last_used = now
+                self._idle.append(item)
+            else:
+                self._size -= 1
+            self._cond.notify()
+        if not keep:
+            self._discard(item, "broken" if broken else "expired")
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of the block"""
+        item = self.acquire()
+        broken = False
+        try:
+            yield item.conn
+        except Exception:
+            # Most errors are bad queries; only drop the connection if it stopped answering
+            broken = not ping(item.conn)
+            raise
+        finally:
+            self.release(item, broken)
+
+    def maintain(self):
+        """Evict idle and expired connections, ping the rest, refill to min_size"""
+        now = time.monotonic()
+        with self._cond:
+            if self._closed:
+                return
+            idle, self._idle = list(self._idle), deque()
+            # Everything taken out is still counted in _size until decided
+            size = self._size
+        evicted, kept = [], []
+        # Oldest-used first, so idle eviction stops once min_size connections remain
+        for item in idle:
+            if self._expired(item, now):
+                evicted.append((item, "expired"))
+            elif now - item.last_used >= self.idle_timeout and size - len(evicted) > self.min_size:
+                evicted.append((item, "evicted_idle"))
+            elif now - item.last_checked >= self.ping_interval and not ping(item.conn):
+                evicted.append((item, "broken"))
+            else:
+                item.last_checked = now
+                kept.append(item)
+        with self._cond:
+            self._size -= len(evicted)
+            # Connections released meanwhile were used more recently; keep them in front
+            self._idle.extendleft(reversed(kept))
+            missing = max(0, self.min_size - self._size) if not self._closed else 0
+            self._size += missing
+            self._cond.notify_all()
+        for item, reason in evicted:
+            self._discard(item, reason)
+        for _ in range(missing):
+            try:
+                item = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                logger.exception("Could not open connection to EHR source %s", self.name)
+                continue
+            self.release(item)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for item in idle:
+            item.conn.close()
+
+    def status(self) -> Dict:
+        with self._cond:
+            idle = len(self._idle)
+            return {
+                "size": self._size,
+                "idle": idle,
+                "in_use": self._size - idle,
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                **self.counters,
+            }
+
+
+class Session:
+    __slots__ = ("session_id", "source", "created_at", "last_used", "queries")
+
+    def __init__(self, session_id: str, source: str):
+        self.session_id = session_id
+        self.source = source
+        self.created_at = datetime.now()
+        self.last_used = time.monotonic()
+        self.queries = 0
+
+
+class SourcePools:
+    """Connection pools keyed by EHR source, plus the sessions handed out by /connect_ehr.
+
+    Pools are created on first use. A background thread runs pool maintenance
+    and drops sessions unused for `session_ttl` seconds every `interval`
+    seconds, off the request path.
+    """
+
+    def __init__(self, sources: Dict[str, Callable[[], Any]], pool_settings: Optional[Dict] = None,
+                 session_ttl: float = 1800.0, interval: float = 30.0):
+        self.sources = sources
+        self.pool_settings = pool_settings or {}
+        self.session_ttl = session_ttl
+        self.interval = interval
+        self._pools: Dict[str, ConnectionPool] = {}
+        self._sessions: Dict[str, Session] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def pool(self, source: str) -> ConnectionPool:
+        pool = self._pools.get(source)
+        if pool is None:
+            if source not in self.sources:
+                raise KeyError(source)
+            with self._lock:
+                pool = self._pools.get(source)
+                if pool is None:
+                    pool = self._pools[source] = ConnectionPool(source, self.sources[source], **self.pool_settings)
+        return pool
+
+    def open_session(self, source: str) -> Session:
+        """New session on `source`, after checking a pooled connection answers"""
+        pool = self.pool(source)
+        with pool.connection() as conn:
+            if not ping(conn):
+                raise ConnectionError(f"EHR source {source} did not answer")
+        session = Session(secrets.token_urlsafe(16), source)
+        with self._lock:
+            self._sessions[session.session_id] = session
+        return session
+
+    def session(self, session_id: str) -> Session:
+        """Live session for a handle, marked as used"""
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or now - session.last_used >= self.session_ttl:
+                self._sessions.pop(session_id, None)
+                raise SessionNotFoundError(session_id)
+            session.last_used = now
+            session.queries += 1
+        return session
+
+    def maintain(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [sid for sid, s in self._sessions.items() if now - s.last_used >= self.session_ttl]
+            for sid in expired:
+                del self._sessions[sid]
+            pools = list(self._pools.values())
+        for pool in pools:
+            pool.maintain()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.maintain()
+            except Exception:
+                logger.exception("EHR pool maintenance failed")
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="ehr-pool-maintenance", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+            self._sessions.clear()
+        for pool in pools:
+            pool.close()
+
+    def status(self) -> Dict:
+        with self._lock:
+            pools = dict(self._pools)
+            sessions = len(self._sessions)
+        return {
+            "sessions": sessions,
+            "pools": {source: pool.status() for source, pool in pools.items()},
+        }
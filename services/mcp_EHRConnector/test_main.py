@@ -1,6 +1,19 @@
 import pytest
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import time
 from fastapi.testclient import TestClient
-from main import app
+
+DATA_DIR = tempfile.mkdtemp()
+os.environ.setdefault("EHR_DB_PATH", os.path.join(DATA_DIR, "ehr.db"))
+os.environ.setdefault("EHR_SAMPLE_PATIENTS", "3000")
+
+from main import app, extract_clinical_data_stream
+from pool import ConnectionPool, PoolTimeout
+from utils.criteria import CriteriaPlan
 
 client = TestClient(app)
 
@@ -38,6 +51,238 @@ def test_all_endpoints():
     for endpoint in endpoints:
         response = client.post(f"/{endpoint}", json=test_data)
         assert response.status_code in [200, 400, 422, 500]
-        
+
+
+def store_query(sql, params=()):
+    conn = sqlite3.connect(os.environ["EHR_DB_PATH"])
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+def test_query_patients_counts_match_store():
+    response = client.post("/query_patients", json={
+        "inclusion": [
+            {"type": "condition", "codes": ["E11"]},
+            {"type": "age", "min": 18, "max": 75},
+        ],
+        "exclusion": [{"type": "condition", "codes": ["N18.3"]}],
+        "reference_year": 2024
+    })
+    assert response.status_code == 200
+    expected = store_query(
+        "SELECT COUNT(*) FROM person WHERE year_of_birth BETWEEN 1949 AND 2006 "
+        "AND person_id IN (SELECT person_id FROM condition_occurrence WHERE condition_source_value LIKE 'E11%') "
+        "AND person_id NOT IN (SELECT person_id FROM condition_occurrence WHERE condition_source_value LIKE 'N183%')"
+    )[0][0]
+    assert 0 < expected < 3000
+    assert response.json()["data"]["patient_count"] == expected
+
+def test_query_patients_breakdown_and_measurements():
+    criteria = {
+        "inclusion": [
+            {"type": "measurement", "code": "4548-4", "min": 7.0},
+            {"type": "gender", "value": "female"},
+        ],
+        "breakdown": ["age_band"]
+    }
+    response = client.post("/query_patients", json=criteria)
+    assert response.status_code == 200
+    data = response.json()["data"]
+    expected = store_query(
+        "SELECT COUNT(DISTINCT m.person_id) FROM measurement m JOIN person p USING (person_id) "
+        "WHERE m.measurement_source_value = '4548-4' AND m.value_as_number >= 7.0 AND p.gender_concept_id = 8532"
+    )[0][0]
+    assert data["patient_count"] == expected
+    assert sum(band["patient_count"] for band in data["breakdown"]) == expected
+
+def test_query_patients_rejects_bad_criteria():
+    assert client.post("/query_patients", json={"inclusion": [{"type": "zodiac"}]}).status_code == 400
+    assert client.post("/query_patients", json={"inclusion": [{"type": "condition"}]}).status_code == 400
+    assert client.post("/query_patients", json={"inclusion": "diabetes"}).status_code == 400
+    assert client.post("/query_patients", json={"breakdown": ["zip"]}).status_code == 400
+
+def test_reference_year_must_be_a_sensible_integer():
+    age = {"inclusion": [{"type": "age", "min": 40}]}
+    for year in ["2020", 2020.5, True, 1066, 99999, "1; DROP TABLE person"]:
+        assert client.post("/query_patients", json={**age, "reference_year": year}).status_code == 400
+        assert client.post("/query_patients", json={"breakdown": ["age_band"], "reference_year": year}).status_code == 400
+        assert client.post("/extract_clinical_data", json={**age, "domain": "person", "reference_year": year}).status_code == 400
+    assert client.post("/query_patients", json={**age, "reference_year": 2020}).status_code == 200
+
+def test_extract_clinical_data_projects_fields():
+    response = client.post("/extract_clinical_data", json={
+        "inclusion": [{"type": "condition", "codes": ["E11"]}],
+        "domain": "measurement",
+        "fields": ["measurement_source_value", "value_as_number"],
+        "limit": 50
+    })
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert data["fields"] == ["measurement_id", "measurement_source_value", "value_as_number"]
+    rows = data["rows"]
+    assert 0 < len(rows) <= 50
+    assert set(rows[0]) == {"measurement_id", "measurement_source_value", "value_as_number"}
+    assert [r["measurement_id"] for r in rows] == sorted(r["measurement_id"] for r in rows)
+    diabetic = {row[0] for row in store_query(
+        "SELECT person_id FROM condition_occurrence WHERE condition_source_value LIKE 'E11%'"
+    )}
+    owners = dict(store_query("SELECT measurement_id, person_id FROM measurement"))
+    assert all(owners[r["measurement_id"]] in diabetic for r in rows)
+
+    response = client.post("/extract_clinical_data", json={"domain": "person", "fields": ["ssn"]})
+    assert response.status_code == 400
+
+def test_extract_clinical_data_pages_with_cursor():
+    request = {"inclusion": [{"type": "condition", "codes": ["E11"]}], "domain": "condition", "limit": 200}
+    expected = [row[0] for row in store_query(
+        "SELECT condition_occurrence_id FROM condition_occurrence WHERE person_id IN "
+        "(SELECT person_id FROM condition_occurrence WHERE condition_source_value LIKE 'E11%') "
+        "ORDER BY condition_occurrence_id"
+    )]
+    assert len(expected) > 200
+
+    ids, cursor = [], None
+    while True:
+        response = client.post("/extract_clinical_data", json={**request, "cursor": cursor})
+        assert response.status_code == 200
+        data = response.json()["data"]
+        ids += [r["condition_occurrence_id"] for r in data["rows"]]
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+    assert ids == expected
+
+    first = client.post("/extract_clinical_data", json=request).json()["data"]["next_cursor"]
+    other = {**request, "domain": "drug", "cursor": first}
+    assert client.post("/extract_clinical_data", json=other).status_code == 400
+    assert client.post("/extract_clinical_data", json={**request, "cursor": "not-a-cursor"}).status_code == 400
+
+def test_extract_clinical_data_stream_ndjson():
+    request = {"inclusion": [{"type": "gender", "value": "female"}], "domain": "measurement",
+               "fields": ["value_as_number"]}
+    response = client.post("/extract_clinical_data/stream", json=request)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    rows, trailer = lines[:-1], lines[-1]
+    expected = store_query(
+        "SELECT measurement_id, value_as_number FROM measurement WHERE person_id IN "
+        "(SELECT person_id FROM person WHERE gender_concept_id = 8532) ORDER BY measurement_id"
+    )
+    assert [(r["measurement_id"], r["value_as_number"]) for r in rows] == expected
+    assert trailer == {"rows": len(expected), "next_cursor": None}
+
+    # max_rows cuts the stream short; the trailer cursor resumes it
+    head = client.post("/extract_clinical_data/stream", json={**request, "max_rows": 100}).text.splitlines()
+    trailer = json.loads(head[-1])
+    assert trailer["rows"] == 100 and trailer["next_cursor"]
+    rest = client.post("/extract_clinical_data/stream", json={**request, "cursor": trailer["next_cursor"]})
+    resumed = [json.loads(line) for line in head[:-1] + rest.text.splitlines()[:-1]]
+    assert resumed == rows
+
+    assert client.post("/extract_clinical_data/stream", json={**request, "max_rows": 0}).status_code == 400
+    assert client.post("/extract_clinical_data/stream", json={"domain": "visits"}).status_code == 400
+
+def test_extract_clinical_data_stream_releases_connection_when_never_streamed():
+    def in_use():
+        return client.get("/health").json()["connections"]["pools"]["omop"]["in_use"]
+
+    request = {"inclusion": [{"type": "condition", "codes": ["E11"]}], "domain": "condition"}
+    response = asyncio.run(extract_clinical_data_stream(request))
+    assert in_use() == 1
+    # The client dropped before the body was iterated; only the background task runs
+    asyncio.run(response.background())
+    assert in_use() == 0
+    asyncio.run(response.background())
+    pool = client.get("/health").json()["connections"]["pools"]["omop"]
+    assert pool["in_use"] == 0 and pool["idle"] == pool["size"]
+
+    # Dropped after the first chunk: the connection comes back when the generator is closed
+    response = asyncio.run(extract_clinical_data_stream(request))
+    first = asyncio.run(response.body_iterator.__anext__())
+    assert json.loads(first.splitlines()[0]) and in_use() == 1
+    asyncio.run(response.background())
+    assert in_use() == 0
+
+def test_connect_ehr_session_reuses_pooled_connections():
+    response = client.post("/connect_ehr", json={"source": "omop"})
+    assert response.status_code == 200
+    session_id = response.json()["data"]["session_id"]
+    request = {"inclusion": [{"type": "condition", "codes": ["I10"]}], "session_id": session_id}
+    created = client.get("/health").json()["connections"]["pools"]["omop"]["created"]
+    counts = [client.post("/query_patients", json=request).json()["data"]["patient_count"] for _ in range(5)]
+    assert len(set(counts)) == 1
+    pool = client.get("/health").json()["connections"]["pools"]["omop"]
+    assert pool["created"] == created
+    assert pool["in_use"] == 0
+
+    assert client.post("/query_patients", json={**request, "session_id": "expired"}).status_code == 404
+    assert client.post("/connect_ehr", json={"source": "epic-prod"}).status_code == 404
+
+def test_connection_pool_eviction_lifetime_and_pings():
+    opened = []
+    def connect():
+        opened.append(sqlite3.connect(":memory:", check_same_thread=False))
+        return opened[-1]
+
+    pool = ConnectionPool("test", connect, min_size=1, max_size=2, idle_timeout=0.05,
+                          max_lifetime=60, ping_interval=0, acquire_timeout=0.05)
+    first, second = pool.acquire(), pool.acquire()
+    with pytest.raises(PoolTimeout):
+        pool.acquire()
+    pool.release(first)
+    pool.release(second)
+    assert pool.acquire() is second  # most recently used first
+    pool.release(second)
+
+    # Idle connections beyond min_size are closed; a dead one is replaced
+    time.sleep(0.06)
+    pool.maintain()
+    assert pool.status()["size"] == 1 and pool.status()["evicted_idle"] == 1
+    pool.acquire_timeout = 1
+    survivor = pool.acquire()
+    survivor.conn.close()
+    pool.release(survivor)
+    pool.idle_timeout = 60
+    pool.maintain()
+    status = pool.status()
+    assert status["broken"] == 1 and status["size"] == 1 and len(opened) == 3
+
+    # Connections past max_lifetime are closed instead of handed out again
+    pool.max_lifetime = 0.05
+    time.sleep(0.06)
+    fresh = pool.acquire()
+    assert fresh.conn is opened[-1] and len(opened) == 4
+    assert pool.status()["expired"] == 1
+    pool.release(fresh)
+    pool.close()
+
+
+def test_query_patients_with_shared_criteria_plan():
+    plan = CriteriaPlan.from_text(["Type 2 diabetes", "Age 18-75 years"], ["CKD stage 3", "Unable to consent"])
+    structured = client.post("/query_patients", json={
+        "inclusion": [{"type": "condition", "codes": ["E11"]}, {"type": "age", "min": 18, "max": 75}],
+        "exclusion": [{"type": "condition", "codes": ["N183"]}],
+        "reference_year": 2024
+    }).json()["data"]
+    response = client.post("/query_patients", json={"criteria_plan": plan.to_dict(), "reference_year": 2024})
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert data["patient_count"] == structured["patient_count"]
+    assert data["plan_hash"] == plan.hash
+    assert data["not_applied"] == [{"type": "text", "text": "unable to consent"}]
+
+    tampered = {**plan.to_dict(), "exclusion": []}
+    assert client.post("/query_patients", json={"criteria_plan": tampered}).status_code == 400
+
+def test_query_patients_men_and_women_matches_either_gender():
+    def count(criteria):
+        plan = CriteriaPlan.from_text(criteria, [])
+        return client.post("/query_patients", json={"criteria_plan": plan.to_dict(), "reference_year": 2024}).json()["data"]
+    both = count(["Men and women aged 18 to 65"])
+    assert both["not_applied"] == []
+    assert both["patient_count"] == count(["Aged 18 to 65"])["patient_count"] > 0
+
 if __name__ == "__main__":
     pytest.main([__file__])
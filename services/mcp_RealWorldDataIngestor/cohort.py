@@ -0,0 +1,99 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils.criteria import CriteriaPlan
+
+# Share of the population kept by one criterion, drawn uniformly from these ranges
+INCLUSION_SELECTIVITY = (0.3, 0.8)
+EXCLUSION_RETENTION = (0.7, 0.95)
+
+DEFAULT_SAMPLES = 10000
+MAX_SAMPLES = 200000
+
+# Upper bound on criterion x sample draws per call (~160 MB of float64)
+MAX_DRAWS = 20_000_000
+
+
+class CriteriaSet:
+    """One cohort definition to estimate: a compiled criteria plan and its base population"""
+
+    def __init__(self, plan: CriteriaPlan, base_population: int = 100000):
+        self.plan = plan
+        self.inclusion_criteria = plan.inclusion
+        self.exclusion_criteria = plan.exclusion
+        self.base_population = base_population
+
+    def selectivity_ranges(self) -> List[Tuple[float, float]]:
+        return (
+            [INCLUSION_SELECTIVITY] * len(self.inclusion_criteria)
+            + [EXCLUSION_RETENTION] * len(self.exclusion_criteria)
+        )
+
+
+def simulate_cohort_sizes(criteria_sets: List[CriteriaSet], samples: int, rng: np.random.Generator) -> np.ndarray:
+    """Monte Carlo cohort sizes, shape (len(criteria_sets), samples).
+
+    Every criterion of every set is sampled in one pass: the per-criterion
+    retention draws are summed in log space and the running sum is split back
+    into sets, so the cost does not depend on how the criteria are grouped.
+    """
+    ranges = [r for criteria_set in criteria_sets for r in criteria_set.selectivity_ranges()]
+    counts = np.array([len(criteria_set.selectivity_ranges()) for criteria_set in criteria_sets])
+    bases = np.array([criteria_set.base_population for criteria_set in criteria_sets], dtype=np.float64)
+
+    if ranges:
+        low, high = np.array(ranges, dtype=np.float64).T
+        draws = rng.random((len(ranges), samples))
+        log_retention = np.log(low[:, None] + (high - low)[:, None] * draws)
+        cumulative = np.vstack([np.zeros((1, samples)), np.cumsum(log_retention, axis=0)])
+    else:
+        cumulative = np.zeros((1, samples))
+
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    log_sizes = cumulative[ends] - cumulative[starts]
+    return bases[:, None] * np.exp(log_sizes)
+
+
+def summarize_cohort_sizes(sizes: np.ndarray, confidence: float) -> List[Dict]:
+    """Median estimate and percentile confidence interval for each simulated set"""
+    tail = (1 - confidence) / 2 * 100
+    lower, median, upper = np.percentile(sizes, [tail, 50, 100 - tail], axis=1)
+    means = sizes.mean(axis=1)
+    return [
+        {
+            "estimated_cohort_size": int(median[i]),
+            "mean_cohort_size": int(means[i]),
+            "confidence_interval": {
+                "lower": int(lower[i]),
+                "upper": int(upper[i]),
+                "level": confidence
+            }
+        }
+        for i in range(len(sizes))
+    ]
+
+
+def estimate_cohort_sizes(
+    criteria_sets: List[CriteriaSet],
+    samples: int = DEFAULT_SAMPLES,
+    confidence: float = 0.95,
+    seed: Optional[int] = None,
+) -> List[Dict]:
+    """Estimate cohort sizes for many criteria sets with one vectorized simulation.
+
+    Passing the same `seed` reproduces the same estimates.
+    """
+    if not 0 < samples <= MAX_SAMPLES:
+        raise ValueError(f"samples must be between 1 and {MAX_SAMPLES}")
+    if not 0 < confidence < 1:
+        raise ValueError("confidence must be between 0 and 1")
+    total_criteria = sum(len(criteria_set.selectivity_ranges()) for criteria_set in criteria_sets)
+    if total_criteria * samples > MAX_DRAWS:
+        raise ValueError(f"Too many criteria x samples in one call (limit {MAX_DRAWS} draws)")
+    if not criteria_sets:
+        return []
+
+    sizes = simulate_cohort_sizes(criteria_sets, samples, np.random.default_rng(seed))
+    return summarize_cohort_sizes(sizes, confidence)
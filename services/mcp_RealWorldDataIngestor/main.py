@@ -1,11 +1,71 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
 from typing import Dict, List, Optional
-from datetime import datetime
-import random
+from contextlib import asynccontextmanager
+import json
+import os
 
-app = FastAPI(title="Real World Data Ingestor MCP Service")
+from cohort import DEFAULT_SAMPLES, CriteriaSet, estimate_cohort_sizes
+from patients import CohortBitmapCache, load_or_create_patient_table
+from quality import QualityTable, load_or_create_quality_table
+from registry import RegistryLoader, RegistrySnapshot
+from utils.criteria import CriteriaPlan
+
+# Columnar data source catalog; a synthetic one is generated if the path is empty.
+# Changed partitions are picked up in the background every REGISTRY_REFRESH_SECONDS.
+registry_loader = RegistryLoader(
+    os.getenv("REGISTRY_PATH", "data/registry"),
+    interval=float(os.getenv("REGISTRY_REFRESH_SECONDS", 30)),
+    sample_rows=int(os.getenv("REGISTRY_SAMPLE_ROWS", 100000))
+)
+
+def get_registry() -> RegistrySnapshot:
+    return registry_loader.snapshot
+
+# Stored audit counts behind /data_quality_assessment; sample counts for the
+# registry's sources are generated if the path is empty. The table is reloaded
+# whenever the registry version changes.
+QUALITY_PATH = os.getenv("QUALITY_PATH", "data/quality")
+QUALITY_BATCH_MAX = int(os.getenv("QUALITY_BATCH_MAX", 10000))
+NDJSON_CHUNK_ROWS = 500
+
+_quality_table: Optional[QualityTable] = None
+_quality_registry_version: Optional[str] = None
+
+def get_quality_table() -> QualityTable:
+    global _quality_table, _quality_registry_version
+    registry = get_registry()
+    if _quality_table is None or _quality_registry_version != registry.version:
+        _quality_table = load_or_create_quality_table(QUALITY_PATH, registry)
+        _quality_registry_version = registry.version
+    return _quality_table
+
+# Patient-level records behind /count_cohort; a synthetic population is generated
+# if the path is empty. Per-predicate bitmaps are cached up to COHORT_CACHE_MB.
+PATIENTS_PATH = os.getenv("PATIENTS_PATH", "data/patients")
+PATIENT_SAMPLE_ROWS = int(os.getenv("PATIENT_SAMPLE_ROWS", 200000))
+COHORT_CACHE_MB = int(os.getenv("COHORT_CACHE_MB", 256))
+
+_cohort_cache: Optional[CohortBitmapCache] = None
+
+def get_cohort_cache() -> CohortBitmapCache:
+    global _cohort_cache
+    if _cohort_cache is None:
+        table = load_or_create_patient_table(PATIENTS_PATH, PATIENT_SAMPLE_ROWS)
+        _cohort_cache = CohortBitmapCache(table, max_bytes=COHORT_CACHE_MB * 1024 * 1024)
+    return _cohort_cache
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    registry_loader.start()
+    get_quality_table()
+    get_cohort_cache()
+    yield
+    registry_loader.stop()
+
+app = FastAPI(title="Real World Data Ingestor MCP Service", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -20,118 +80,204 @@ class DataSourceQuery(BaseModel):
     geography: Optional[List[str]] = None
     data_types: Optional[List[str]] = ["EHR", "Claims"]
     minimum_patient_count: Optional[int] = 100
+    limit: int = Field(20, ge=1, le=1000)
 
 class DataSource(BaseModel):
     source_id: str
     source_name: str
+    disease_area: Optional[str] = None
     data_type: str
     geography: str
     patient_count: int
     last_updated: str
     quality_score: float
     availability: str
+    # False if the disease area matched no registry area and sources of all areas were returned
+    disease_area_matched: bool = True
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "service": "mcp_RealWorldDataIngestor"}
+    registry = registry_loader.status()
+    return {
+        "status": "healthy",
+        "service": "mcp_RealWorldDataIngestor",
+        "registry_version": registry["version"],
+        "registry": registry,
+        "cohort_cache": _cohort_cache.status() if _cohort_cache else None
+    }
 
 @app.post("/identify_sources", response_model=List[DataSource])
 async def identify_data_sources(query: DataSourceQuery):
+    """Top data sources in the registry matching the query, largest first"""
+    if not query.disease_area.strip():
+        raise HTTPException(status_code=400, detail="disease_area must not be empty")
     try:
-        # Mock data source identification
-        # In production, this would query actual data source registries
-        
-        mock_sources = []
-        geographies = query.geography or ["USA", "UK", "Germany", "Japan"]
-        
-        for geo in geographies:
-            for data_type in query.data_types:
-                patient_count = random.randint(query.minimum_patient_count, 50000)
-                quality_score = round(random.uniform(7.0, 9.5), 1)
-                
-                source = DataSource(
-                    source_id=f"{geo}_{data_type}_{random.randint(100, 999)}",
-                    source_name=f"{geo} National {data_type} Database",
-                    data_type=data_type,
-                    geography=geo,
-                    patient_count=patient_count,
-                    last_updated=datetime.now().isoformat(),
-                    quality_score=quality_score,
-                    availability="Available" if quality_score > 7.5 else "Limited"
-                )
-                mock_sources.append(source)
-        
-        # Sort by patient count and quality score
-        mock_sources.sort(key=lambda x: (x.patient_count, x.quality_score), reverse=True)
-        
-        return mock_sources
+        records = get_registry().search(
+            query.disease_area,
+            geography=query.geography,
+            data_types=query.data_types,
+            minimum_patient_count=query.minimum_patient_count or 0,
+            limit=query.limit
+        )
+        return [
+            DataSource(**record, availability="Available" if record["quality_score"] > 7.5 else "Limited")
+            for record in records
+        ]
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+DEFAULT_BASE_POPULATION = 100000
+
+def _criteria_set(data: Dict, default_base_population: int = DEFAULT_BASE_POPULATION) -> CriteriaSet:
+    """Criteria set of a request: a shared `criteria_plan`, or free-text criteria compiled here"""
+    if not isinstance(data, dict):
+        raise ValueError("Each criteria set must be an object")
+    if data.get("criteria_plan") is not None:
+        plan = CriteriaPlan.from_dict(data["criteria_plan"])
+    else:
+        plan = CriteriaPlan.from_text(data.get("inclusion_criteria", []), data.get("exclusion_criteria", []))
+    base_population = data.get("base_population", default_base_population)
+    if isinstance(base_population, bool) or not isinstance(base_population, int) or base_population <= 0:
+        raise ValueError("base_population must be a positive integer")
+    return CriteriaSet(plan, base_population=base_population)
+
+def _cohort_result(criteria_set: CriteriaSet, estimate: Dict, samples: int) -> Dict:
+    return {
+        **estimate,
+        "factors_considered": {
+            "inclusion_criteria_count": len(criteria_set.inclusion_criteria),
+            "exclusion_criteria_count": len(criteria_set.exclusion_criteria),
+            "base_population": criteria_set.base_population
+        },
+        "plan_hash": criteria_set.plan.hash,
+        "method": "monte_carlo",
+        "samples": samples
+    }
+
 @app.post("/estimate_cohort_size")
 async def estimate_cohort_size(data: Dict):
+    """Estimate cohort size from inclusion/exclusion criteria by Monte Carlo simulation.
+
+    Accepts a single criteria set (inclusion_criteria, exclusion_criteria,
+    base_population) or a list of them as "criteria_sets", all simulated in
+    one vectorized pass. A compiled "criteria_plan" can replace the free-text
+    criteria; each criterion is one normalized predicate of the plan.
+    Optional: "samples" (default 10000), "confidence" (default 0.95) and
+    "seed" for reproducible estimates.
+    """
     try:
-        # Estimate potential cohort size based on inclusion/exclusion criteria
-        base_population = data.get("base_population", 100000)
-        inclusion_criteria = data.get("inclusion_criteria", [])
-        exclusion_criteria = data.get("exclusion_criteria", [])
-        
-        # Apply mock filters (in reality would use actual data queries)
-        estimated_size = base_population
-        
-        # Apply inclusion criteria reductions
-        for _ in inclusion_criteria:
-            estimated_size *= random.uniform(0.3, 0.8)
-            
-        # Apply exclusion criteria reductions  
-        for _ in exclusion_criteria:
-            estimated_size *= random.uniform(0.7, 0.95)
-            
-        return {
-            "estimated_cohort_size": int(estimated_size),
-            "confidence_interval": {
-                "lower": int(estimated_size * 0.8),
-                "upper": int(estimated_size * 1.2)
-            },
-            "factors_considered": {
-                "inclusion_criteria_count": len(inclusion_criteria),
-                "exclusion_criteria_count": len(exclusion_criteria),
-                "base_population": base_population
-            }
-        }
-        
+        base_population = data.get("base_population", DEFAULT_BASE_POPULATION)
+        samples = int(data.get("samples", DEFAULT_SAMPLES))
+        confidence = float(data.get("confidence", 0.95))
+        seed = data.get("seed")
+
+        if "criteria_sets" in data:
+            if not isinstance(data["criteria_sets"], list):
+                raise ValueError("criteria_sets must be a list")
+            criteria_sets = [_criteria_set(item, base_population) for item in data["criteria_sets"]]
+        else:
+            criteria_sets = [_criteria_set(data, base_population)]
+
+        estimates = estimate_cohort_sizes(criteria_sets, samples=samples, confidence=confidence, seed=seed)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        results = [
+            _cohort_result(criteria_set, estimate, samples)
+            for criteria_set, estimate in zip(criteria_sets, estimates)
+        ]
+        if "criteria_sets" in data:
+            return {"results": results, "samples": samples, "seed": seed}
+        return results[0]
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/count_cohort")
+async def count_cohort(data: Dict):
+    """Count the patients meeting a criteria set in the patient-level records.
+
+    Takes the same criteria as /estimate_cohort_size (a "criteria_plan" or
+    free-text criteria, or a list of them as "criteria_sets"). Counts come
+    from intersecting cached per-predicate bitmaps, so re-running a criteria
+    set with one criterion changed only evaluates that criterion. Free-text
+    predicates that cannot be evaluated are listed as "not_applied".
+    """
+    try:
+        if "criteria_sets" in data:
+            if not isinstance(data["criteria_sets"], list):
+                raise ValueError("criteria_sets must be a list")
+            criteria_sets = [_criteria_set(item) for item in data["criteria_sets"]]
+        else:
+            criteria_sets = [_criteria_set(data)]
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        cache = get_cohort_cache()
+        results = [cache.count(criteria_set.plan) for criteria_set in criteria_sets]
+        if "criteria_sets" in data:
+            return {"results": results}
+        return results[0]
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/data_quality_assessment")
 async def assess_data_quality(data: Dict):
+    """Quality metrics of one data source, computed from its stored audit counts.
+
+    Sources without stored audit counts are a 404; only sources in the
+    registry can be assessed.
+    """
+    source_id = data.get("source_id")
+    if not isinstance(source_id, str):
+        raise HTTPException(status_code=400, detail="source_id is required")
     try:
-        source_id = data.get("source_id", "unknown")
-        
-        # Mock data quality metrics
-        quality_metrics = {
-            "completeness": round(random.uniform(85, 98), 1),
-            "accuracy": round(random.uniform(88, 96), 1),
-            "timeliness": round(random.uniform(90, 99), 1),
-            "consistency": round(random.uniform(87, 95), 1),
-            "validity": round(random.uniform(89, 97), 1)
-        }
-        
-        overall_quality = sum(quality_metrics.values()) / len(quality_metrics)
-        
-        return {
-            "source_id": source_id,
-            "quality_metrics": quality_metrics,
-            "overall_quality_score": round(overall_quality, 1),
-            "recommendations": [
-                "Data quality is suitable for RWE studies" if overall_quality > 90 
-                else "Consider data cleaning and validation procedures"
-            ]
-        }
-        
+        table = get_quality_table()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if len(source_id.encode()) > table.id_width:
+        raise HTTPException(status_code=400, detail=f"source_id must be at most {table.id_width} bytes")
+    try:
+        result = table.assess([source_id])[0]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if "error" in result:
+        raise HTTPException(status_code=404, detail=f"{result['error']}: {source_id}")
+    return result
+
+@app.post("/data_quality_assessment_batch")
+async def assess_data_quality_batch(data: Dict):
+    """Quality metrics for many data sources, streamed as NDJSON.
+
+    Expects "source_ids" (list). Metrics for all sources are computed in one
+    vectorized pass; one JSON line per source is streamed back in request
+    order, with an "error" field instead of metrics for unknown ids.
+    """
+    source_ids = data.get("source_ids")
+    if not isinstance(source_ids, list) or not all(isinstance(i, str) for i in source_ids):
+        raise HTTPException(status_code=400, detail="source_ids must be a list of strings")
+    if len(source_ids) > QUALITY_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {QUALITY_BATCH_MAX} source_ids per call")
+    try:
+        table = get_quality_table()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if any(len(source_id.encode()) > table.id_width for source_id in source_ids):
+        raise HTTPException(status_code=400, detail=f"source_ids must be at most {table.id_width} bytes each")
+    try:
+        results = table.assess(source_ids)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    def lines():
+        for i in range(0, len(results), NDJSON_CHUNK_ROWS):
+            yield "".join(json.dumps(result) + "\n" for result in results[i:i + NDJSON_CHUNK_ROWS])
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,276 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from utils.criteria import EVENT_TABLES, CriteriaError, CriteriaPlan, has_text, predicate_hash, prefix_range
+
+# One row per patient; row number is the patient's bit in every cohort bitmap
+PATIENT_COLUMNS = {"age": "int16", "gender": "S6"}
+
+# One row per (patient, code) event, sorted by code so that every code prefix
+# is one contiguous slice found by binary search
+EVENT_KINDS = ("condition", "drug", "procedure", "measurement")
+EVENT_COLUMNS = {"code": "S12", "patient": "int32"}
+MEASUREMENT_VALUE = "float64"
+
+# Synthetic population: normalized codes and the share of patients who have them
+SAMPLE_EVENTS = {
+    "condition": [
+        ("E119", 0.10), ("E1165", 0.03), ("E109", 0.01), ("I10", 0.30), ("I509", 0.03), ("N183", 0.05),
+        ("N184", 0.01), ("I219", 0.02), ("I639", 0.02), ("J449", 0.06), ("J459", 0.08), ("C509", 0.02),
+        ("C349", 0.01), ("F329", 0.08), ("F331", 0.03), ("E785", 0.20), ("M545", 0.10), ("G309", 0.02),
+        ("O249", 0.005), ("Z3301", 0.01), ("Z391", 0.005),
+    ],
+    "drug": [
+        ("6809", 0.08), ("5856", 0.03), ("274783", 0.01), ("1545653", 0.02), ("29046", 0.12),
+        ("83367", 0.18), ("36437", 0.05),
+    ],
+    "procedure": [("90935", 0.005), ("45378", 0.06), ("93000", 0.25), ("71046", 0.15)],
+}
+# LOINC code -> share of patients with a result, and the mean and spread of the value
+SAMPLE_MEASUREMENTS = [
+    ("4548-4", 0.35, 6.2, 1.3),
+    ("33914-3", 0.40, 80.0, 22.0),
+    ("2160-0", 0.40, 1.0, 0.3),
+    ("8480-6", 0.60, 130.0, 16.0),
+    ("39156-5", 0.50, 28.0, 5.5),
+]
+
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_CACHED_PLANS = 10000
+
+
+class PatientTable:
+    """Patient-level demographics and coded events the cohort bitmaps are computed from"""
+
+    def __init__(self, columns: Dict[str, np.ndarray], version: str):
+        self.columns = columns
+        self.version = version
+
+    def __len__(self) -> int:
+        return len(self.columns["age"])
+
+    @classmethod
+    def load(cls, path: str) -> "PatientTable":
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        names = list(PATIENT_COLUMNS) + [f"{kind}_{name}" for kind in EVENT_KINDS for name in EVENT_COLUMNS]
+        columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in names + ["measurement_value"]}
+        return cls(columns, meta["version"])
+
+    def _code_rows(self, kind: str, code: str) -> slice:
+        """Event rows whose code starts with `code`"""
+        codes = self.columns[f"{kind}_code"]
+        low, high = (value.encode() for value in prefix_range(code))
+        return slice(int(np.searchsorted(codes, low)), int(np.searchsorted(codes, high)))
+
+    def leaf_bitmap(self, predicate: Dict) -> np.ndarray:
+        """Patients matching one normalized leaf predicate, one bool per patient"""
+        kind = predicate["type"]
+        if kind == "age":
+            age = self.columns["age"]
+            bitmap = np.ones(len(self), dtype=bool)
+            if "min" in predicate:
+                bitmap &= age >= predicate["min"]
+            if "max" in predicate:
+                bitmap &= age <= predicate["max"]
+            return bitmap
+        if kind == "gender":
+            return self.columns["gender"] == predicate["value"].encode()
+        bitmap = np.zeros(len(self), dtype=bool)
+        if kind in EVENT_TABLES:
+            patients = self.columns[f"{kind}_patient"]
+            for code in predicate["codes"]:
+                bitmap[patients[self._code_rows(kind, code)]] = True
+            return bitmap
+        if kind == "measurement":
+            rows = self._code_rows("measurement", predicate["code"])
+            codes = self.columns["measurement_code"][rows]
+            # A prefix slice can hold longer codes; measurements match the code exactly
+            keep = codes == predicate["code"].encode()
+            values = self.columns["measurement_value"][rows]
+            if "min" in predicate:
+                keep &= values > predicate["min"] if predicate.get("min_exclusive") else values >= predicate["min"]
+            if "max" in predicate:
+                keep &= values < predicate["max"] if predicate.get("max_exclusive") else values <= predicate["max"]
+            bitmap[self.columns["measurement_patient"][rows][keep]] = True
+            return bitmap
+        raise CriteriaError(f"Criterion type {kind!r} cannot be evaluated against patient records")
+
+
+class CohortBitmapCache:
+    """Cohort counts computed from cached per-predicate patient bitmaps.
+
+    Every predicate, including each group and its children, is evaluated
+    against the patient table at most once and kept as a bool array keyed by
+    its predicate hash. A cohort is the AND of its inclusion bitmaps minus
+    the OR of its exclusion bitmaps, so a criteria set that differs from
+    earlier ones by one criterion only evaluates that criterion. Counts are
+    also kept per plan hash. Both caches are LRU; bitmaps are bounded by
+    `max_bytes`.
+    """
+
+    def __init__(self, table: PatientTable, max_bytes: int = DEFAULT_CACHE_BYTES,
+                 max_plans: int = DEFAULT_CACHED_PLANS):
+        self.table = table
+        self.max_bytes = max_bytes
+        self.max_plans = max_plans
+        self._bitmaps: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._counts: "OrderedDict[str, Dict]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"bitmap_hits": 0, "bitmap_misses": 0, "bitmaps_evicted": 0, "plan_hits": 0, "plan_misses": 0}
+
+    def _store(self, key: str, bitmap: np.ndarray):
+        bitmap.flags.writeable = False
+        with self._lock:
+            if key in self._bitmaps:
+                return
+            self._bitmaps[key] = bitmap
+            self._bytes += bitmap.nbytes
+            while self._bytes > self.max_bytes and len(self._bitmaps) > 1:
+                _, evicted = self._bitmaps.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.counters["bitmaps_evicted"] += 1
+
+    def bitmap(self, predicate: Dict, evaluated: Optional[List[str]] = None) -> np.ndarray:
+        """Read-only bitmap of the patients matching a normalized predicate.
+
+        Hashes of predicates evaluated (not found in the cache) are appended
+        to `evaluated`.
+        """
+        key = predicate_hash(predicate)
+        with self._lock:
+            bitmap = self._bitmaps.get(key)
+            if bitmap is not None:
+                self._bitmaps.move_to_end(key)
+                self.counters["bitmap_hits"] += 1
+                return bitmap
+            self.counters["bitmap_misses"] += 1
+        if predicate["type"] in ("all", "any"):
+            children = [self.bitmap(child, evaluated) for child in predicate["predicates"]]
+            combine = np.logical_and if predicate["type"] == "all" else np.logical_or
+            bitmap = children[0].copy()
+            for child in children[1:]:
+                combine(bitmap, child, out=bitmap)
+        else:
+            bitmap = self.table.leaf_bitmap(predicate)
+        if evaluated is not None:
+            evaluated.append(key)
+        self._store(key, bitmap)
+        return bitmap
+
+    def count(self, plan: CriteriaPlan) -> Dict:
+        """Patients meeting every inclusion and no exclusion predicate of the plan.
+
+        Top-level predicates holding free text cannot be evaluated and are
+        returned as `not_applied`, as the EHR connector does.
+        """
+        with self._lock:
+            cached = self._counts.get(plan.hash)
+            if cached is not None:
+                self._counts.move_to_end(plan.hash)
+                self.counters["plan_hits"] += 1
+                return {**cached, "predicates_evaluated": 0, "plan_cached": True, "count_ms": 0.0}
+            self.counters["plan_misses"] += 1
+
+        started = time.perf_counter()
+        evaluated: List[str] = []
+        not_applied = []
+        cohort = np.ones(len(self.table), dtype=bool)
+        excluded = np.zeros(len(self.table), dtype=bool)
+        for side, target, combine in (("inclusion", cohort, np.logical_and), ("exclusion", excluded, np.logical_or)):
+            for predicate in getattr(plan, side):
+                if has_text(predicate):
+                    not_applied.append(predicate)
+                    continue
+                combine(target, self.bitmap(predicate, evaluated), out=target)
+        np.logical_and(cohort, ~excluded, out=cohort)
+
+        result = {
+            "patient_count": int(np.count_nonzero(cohort)),
+            "population": len(self.table),
+            "plan_hash": plan.hash,
+            "not_applied": not_applied,
+            "patient_table_version": self.table.version,
+        }
+        with self._lock:
+            self._counts[plan.hash] = result
+            while len(self._counts) > self.max_plans:
+                self._counts.popitem(last=False)
+        return {
+            **result,
+            "predicates_evaluated": len(evaluated),
+            "plan_cached": False,
+            "count_ms": round((time.perf_counter() - started) * 1000, 3),
+        }
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                "patient_table_version": self.table.version,
+                "patients": len(self.table),
+                "bitmaps": len(self._bitmaps),
+                "bitmap_bytes": self._bytes,
+                "plans": len(self._counts),
+                **self.counters,
+            }
+
+
+def write_patient_table(path: str, columns: Dict[str, np.ndarray], version: str):
+    """Write a patient table directory; event rows are sorted by code, then patient"""
+    os.makedirs(path, exist_ok=True)
+    arrays = {name: np.asarray(columns[name], dtype=dtype) for name, dtype in PATIENT_COLUMNS.items()}
+    for kind in EVENT_KINDS:
+        codes = np.asarray(columns[f"{kind}_code"], dtype=EVENT_COLUMNS["code"])
+        patients = np.asarray(columns[f"{kind}_patient"], dtype=EVENT_COLUMNS["patient"])
+        order = np.lexsort((patients, codes))
+        arrays[f"{kind}_code"] = codes[order]
+        arrays[f"{kind}_patient"] = patients[order]
+        if kind == "measurement":
+            arrays["measurement_value"] = np.asarray(columns["measurement_value"], dtype=MEASUREMENT_VALUE)[order]
+    for name, values in arrays.items():
+        tmp = os.path.join(path, f".{name}.npy.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, values)
+        os.replace(tmp, os.path.join(path, f"{name}.npy"))
+    tmp = os.path.join(path, ".meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump({"version": version, "patients": len(arrays["age"])}, f)
+    os.replace(tmp, os.path.join(path, "meta.json"))
+
+
+def generate_sample_patients(path: str, patients: int, seed: int = 0):
+    """Write a synthetic patient population for development and tests"""
+    rng = np.random.default_rng(seed)
+    columns = {
+        "age": rng.integers(0, 96, patients),
+        "gender": rng.choice(np.array([b"male", b"female"]), patients),
+    }
+
+    def events(codes, shares):
+        rows = [np.flatnonzero(rng.random(patients) < share) for share in shares]
+        return np.repeat(np.array(codes, dtype="S12"), [len(r) for r in rows]), np.concatenate(rows)
+
+    for kind, sample in SAMPLE_EVENTS.items():
+        codes, shares = zip(*sample)
+        columns[f"{kind}_code"], columns[f"{kind}_patient"] = events(codes, shares)
+    codes, shares, means, spreads = zip(*SAMPLE_MEASUREMENTS)
+    columns["measurement_code"], columns["measurement_patient"] = events(codes, shares)
+    columns["measurement_value"] = np.concatenate([
+        rng.normal(mean, spread, np.count_nonzero(columns["measurement_code"] == code.encode())).clip(0).round(1)
+        for code, mean, spread in zip(codes, means, spreads)
+    ])
+    write_patient_table(path, columns, version=f"sample-{patients}-{seed}")
+
+
+def load_or_create_patient_table(path: str, sample_patients: int = 200000) -> PatientTable:
+    """Load the patient table at `path`, generating a sample population there if none exists"""
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        generate_sample_patients(path, sample_patients)
+    return PatientTable.load(path)
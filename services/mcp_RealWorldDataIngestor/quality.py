@@ -0,0 +1,168 @@
+import json
+import os
+from typing import Dict, List, Sequence
+
+import numpy as np
+
+# Raw audit counts per data source, one memory-mapped .npy file per column,
+# rows sorted by source_id
+COLUMNS = {
+    "source_id": "S24",
+    "fields_expected": "int64",
+    "fields_populated": "int64",
+    "records_audited": "int32",
+    "records_accurate": "int32",
+    "days_since_refresh": "float32",
+    "checks_run": "int32",
+    "checks_passed": "int32",
+    "values_checked": "int64",
+    "values_valid": "int64",
+}
+
+METRICS = ("completeness", "accuracy", "timeliness", "consistency", "validity")
+
+# Timeliness drops one point per 10 days since the last refresh
+TIMELINESS_DAYS_PER_POINT = 10.0
+
+
+class QualityTable:
+    """Stored audit counts from which the data quality metrics are computed"""
+
+    def __init__(self, columns: Dict[str, np.ndarray], version: str):
+        self.columns = columns
+        self.version = version
+
+    def __len__(self) -> int:
+        return len(self.columns["source_id"])
+
+    @classmethod
+    def load(cls, path: str) -> "QualityTable":
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in COLUMNS}
+        return cls(columns, meta["version"])
+
+    @property
+    def id_width(self) -> int:
+        """Longest source id the table can hold, in bytes"""
+        return self.columns["source_id"].dtype.itemsize
+
+    def lookup(self, source_ids: Sequence[str]):
+        """Row of each source id and whether it was found.
+
+        Ids longer than the id column are never found, rather than being
+        truncated into a match with another source.
+        """
+        encoded = [source_id.encode() if isinstance(source_id, str) else bytes(source_id) for source_id in source_ids]
+        fits = np.array([len(key) <= self.id_width for key in encoded], dtype=bool)
+        keys = np.array([key if ok else b"" for key, ok in zip(encoded, fits)], dtype=self.columns["source_id"].dtype)
+        ids = self.columns["source_id"]
+        rows = np.searchsorted(ids, keys).clip(0, max(len(ids) - 1, 0))
+        found = (ids[rows] == keys) & fits if len(ids) else np.zeros(len(keys), dtype=bool)
+        return rows, found
+
+    def metrics(self, rows: np.ndarray) -> Dict[str, np.ndarray]:
+        """The five quality metrics (0-100) and their mean for the given rows"""
+        c = {name: np.asarray(self.columns[name][rows], dtype=np.float64) for name in COLUMNS if name != "source_id"}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metrics = {
+                "completeness": 100 * c["fields_populated"] / c["fields_expected"],
+                "accuracy": 100 * c["records_accurate"] / c["records_audited"],
+                "timeliness": np.clip(100 - c["days_since_refresh"] / TIMELINESS_DAYS_PER_POINT, 0, 100),
+                "consistency": 100 * c["checks_passed"] / c["checks_run"],
+                "validity": 100 * c["values_valid"] / c["values_checked"],
+            }
+        metrics = {name: np.nan_to_num(values, nan=0.0).round(1) for name, values in metrics.items()}
+        metrics["overall"] = np.mean([metrics[name] for name in METRICS], axis=0).round(1)
+        return metrics
+
+    def assess(self, source_ids: Sequence[str]) -> List[Dict]:
+        """Quality assessment of each source id, in request order"""
+        rows, found = self.lookup(source_ids)
+        metrics = self.metrics(rows)
+        columns = {name: metrics[name].tolist() for name in (*METRICS, "overall")}
+        results = []
+        for i, source_id in enumerate(source_ids):
+            if not found[i]:
+                results.append({"source_id": source_id, "error": "Unknown source_id"})
+                continue
+            overall = columns["overall"][i]
+            results.append({
+                "source_id": source_id,
+                "quality_metrics": {name: columns[name][i] for name in METRICS},
+                "overall_quality_score": overall,
+                "recommendations": [
+                    "Data quality is suitable for RWE studies" if overall > 90
+                    else "Consider data cleaning and validation procedures"
+                ]
+            })
+        return results
+
+
+def write_quality_table(path: str, columns: Dict[str, np.ndarray], version: str):
+    os.makedirs(path, exist_ok=True)
+    order = np.argsort(np.asarray(columns["source_id"], dtype="S24"), kind="stable")
+    for name, dtype in COLUMNS.items():
+        tmp = os.path.join(path, f".{name}.npy.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, np.asarray(columns[name], dtype=dtype)[order])
+        os.replace(tmp, os.path.join(path, f"{name}.npy"))
+    tmp = os.path.join(path, ".meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump({"version": version, "rows": len(order)}, f)
+    os.replace(tmp, os.path.join(path, "meta.json"))
+
+
+def sample_quality_columns(source_ids: np.ndarray, seed: int = 0) -> Dict[str, np.ndarray]:
+    """Synthetic audit counts for the given sources"""
+    rng = np.random.default_rng(seed)
+    n = len(source_ids)
+
+    def counts(low: int, high: int, share_low: float, share_high: float):
+        total = rng.integers(low, high, n)
+        return total, (total * rng.uniform(share_low, share_high, n)).astype(np.int64)
+
+    fields_expected, fields_populated = counts(10_000, 1_000_000, 0.85, 0.98)
+    records_audited, records_accurate = counts(200, 5_000, 0.88, 0.96)
+    checks_run, checks_passed = counts(50, 500, 0.87, 0.95)
+    values_checked, values_valid = counts(10_000, 1_000_000, 0.89, 0.97)
+    return {
+        "source_id": source_ids,
+        "fields_expected": fields_expected,
+        "fields_populated": fields_populated,
+        "records_audited": records_audited,
+        "records_accurate": records_accurate,
+        "days_since_refresh": rng.uniform(10, 100, n),
+        "checks_run": checks_run,
+        "checks_passed": checks_passed,
+        "values_checked": values_checked,
+        "values_valid": values_valid,
+    }
+
+
+def generate_sample_quality_table(path: str, source_ids: np.ndarray, seed: int = 0):
+    """Write synthetic audit counts for the given sources"""
+    write_quality_table(path, sample_quality_columns(source_ids, seed), version=f"sample-{len(source_ids)}-{seed}")
+
+
+def load_or_create_quality_table(path: str, registry) -> QualityTable:
+    """Load the table at `path`, generating sample counts for the registry's sources if none exists.
+
+    A sample table is extended with counts for sources registered since it
+    was generated, so sources added by a registry reload can be assessed too.
+    """
+    source_ids = [partition.columns["source_id"] for partition in registry.partitions.values()]
+    source_ids = np.concatenate(source_ids) if source_ids else np.array([], dtype=COLUMNS["source_id"])
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        generate_sample_quality_table(path, source_ids)
+    table = QualityTable.load(path)
+    if not table.version.startswith("sample-"):
+        return table
+    missing = np.unique(source_ids[~table.lookup(source_ids)[1]]) if len(source_ids) else source_ids
+    if not len(missing):
+        return table
+    seed = len(table)
+    added = sample_quality_columns(missing, seed)
+    columns = {name: np.concatenate([np.asarray(table.columns[name]), added[name]]) for name in COLUMNS}
+    write_quality_table(path, columns, version=f"sample-{len(columns['source_id'])}-{seed}")
+    return QualityTable.load(path)
@@ -0,0 +1,479 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Fixed-width columns stored one .npy file each and memory-mapped on load
+COLUMNS = {
+    "source_id": "S24",
+    "source_name": "S64",
+    "disease_area": "int16",
+    "geography": "int16",
+    "data_type": "int8",
+    "patient_count": "int32",
+    "quality_score": "float32",
+    "last_updated": "datetime64[D]",
+}
+
+# Columns stored as codes into the category lists kept in meta.json
+CATEGORICAL = ("disease_area", "geography", "data_type")
+
+SAMPLE_DISEASE_AREAS = [
+    "Diabetes", "Oncology", "Cardiovascular", "Respiratory", "Neurology", "Rheumatology",
+    "Infectious Disease", "Nephrology", "Hepatology", "Dermatology", "Psychiatry",
+    "Rare Disease", "Obesity", "Hematology", "Ophthalmology", "Gastroenterology",
+]
+SAMPLE_GEOGRAPHIES = [
+    "USA", "UK", "Germany", "Japan", "France", "Canada", "Italy", "Spain", "Brazil", "India",
+    "China", "Australia", "Netherlands", "Sweden", "South Korea", "Mexico", "Poland", "Israel",
+]
+SAMPLE_DATA_TYPES = ["EHR", "Claims", "Registry", "Lab"]
+
+# Free-text disease terms -> registry disease area, for disease areas that
+# share no words with an area name ("Breast Cancer" is an Oncology source)
+DISEASE_AREA_SYNONYMS = [
+    (r"cancer|tumou?r|carcinoma|lymphoma|leuka?emia|melanoma|sarcoma|myeloma|neoplas\w*|malignan\w*|oncolog\w*", "Oncology"),
+    (r"heart|cardi\w*|coronary|hypertension|stroke|atrial|vascular|myocardial", "Cardiovascular"),
+    (r"asthma|copd|pulmonary|lungs?|respirat\w*|bronch\w*|pneumon\w*", "Respiratory"),
+    (r"alzheimer'?s?|parkinson'?s?|dementia|epilep\w*|multiple sclerosis|migraine|neuro\w*", "Neurology"),
+    (r"arthritis|lupus|rheumat\w*|spondyl\w*|gout", "Rheumatology"),
+    (r"covid(?:-?19)?|sars-cov-?2|influenza|hiv|hepatitis [abc]|infect\w*|tubercul\w*|sepsis|viral|bacterial", "Infectious Disease"),
+    (r"kidney|renal|nephr\w*|ckd|dialysis", "Nephrology"),
+    (r"liver|hepat\w*|cirrho\w*|nash|nafld", "Hepatology"),
+    (r"psoria\w*|eczema|dermat\w*|acne|skin", "Dermatology"),
+    (r"depress\w*|schizo\w*|bipolar|anxiety|psychi\w*|adhd|autism", "Psychiatry"),
+    (r"rare|orphan|cystic fibrosis|duchenne|huntington'?s?|spinal muscular atrophy", "Rare Disease"),
+    (r"obes\w*|overweight", "Obesity"),
+    (r"an(?:a)?emi\w*|ha?emophilia|sickle cell|thalass\w*|ha?ematolog\w*", "Hematology"),
+    (r"eyes?|retin\w*|macular|glaucoma|cataract|ophthalm\w*", "Ophthalmology"),
+    (r"crohn'?s?|colitis|bowel|gastr\w*|ibd|ibs|coeliac|celiac", "Gastroenterology"),
+    (r"diabet\w*|t[12]dm|glyc\w*", "Diabetes"),
+]
+DISEASE_AREA_PATTERNS = [(re.compile(rf"\b(?:{pattern})\b"), area) for pattern, area in DISEASE_AREA_SYNONYMS]
+
+
+# Rows unpacked per step when scanning a bitmap for the first matches
+BITMAP_WINDOW_ROWS = 65536
+
+
+class RegistryIndex:
+    """Inverted indexes from category codes to the rows that hold them.
+
+    Disease areas map to row ranges, since rows are clustered by disease
+    area. Geography and data type map to bitmaps with one bit per row: a
+    query ORs the bitmaps of the values it accepts for a column and ANDs the
+    result across columns, touching only the bytes of the rows in range.
+    """
+
+    BITMAP_COLUMNS = ("geography", "data_type")
+
+    def __init__(self, columns: Dict[str, np.ndarray], categories: Dict[str, List[str]], disease_offsets: List[int]):
+        self.disease_ranges = [
+            (disease_offsets[code], disease_offsets[code + 1]) for code in range(len(categories["disease_area"]))
+        ]
+        self.bitmaps = {
+            column: [np.packbits(np.asarray(columns[column]) == code) for code in range(len(categories[column]))]
+            for column in self.BITMAP_COLUMNS
+        }
+
+    def _window(self, filters: List[Tuple[str, List[int]]], lo: int, hi: int) -> np.ndarray:
+        """Intersected filter bitmaps for bytes lo:hi"""
+        combined = None
+        for column, codes in filters:
+            accepted = self.bitmaps[column][codes[0]][lo:hi].copy()
+            for code in codes[1:]:
+                accepted |= self.bitmaps[column][code][lo:hi]
+            combined = accepted if combined is None else combined & accepted
+        return combined
+
+    def matching_rows(self, start: int, end: int, filters: List[Tuple[str, List[int]]], limit: int) -> np.ndarray:
+        """First `limit` rows in [start, end) accepted by every bitmap filter"""
+        if not filters:
+            return np.arange(start, min(end, start + limit))
+        found = []
+        remaining = limit
+        window_start = start
+        while window_start < end and remaining > 0:
+            window_end = min(end, window_start + BITMAP_WINDOW_ROWS)
+            lo, hi = window_start // 8, (window_end + 7) // 8
+            bits = np.unpackbits(self._window(filters, lo, hi))
+            rows = np.flatnonzero(bits[window_start - lo * 8:window_end - lo * 8]) + window_start
+            found.append(rows[:remaining])
+            remaining -= len(found[-1])
+            window_start = window_end
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+
+class DataSourceRegistry:
+    """Columnar data source catalog queried with vectorized filters.
+
+    Each column is a NumPy array memory-mapped from its own .npy file, so
+    loading is cheap and only the pages a query touches are read. Disease
+    area, geography and data type are stored as small integer codes; a query
+    resolves its filter values to codes once and is answered from the
+    RegistryIndex built at load.
+
+    Rows are clustered by disease area and ranked within each cluster by
+    patient count, then quality score (see write_registry). A query for one
+    disease area therefore only reads that cluster's slice, and its matches
+    are already in result order.
+    """
+
+    def __init__(
+        self,
+        columns: Dict[str, np.ndarray],
+        categories: Dict[str, List[str]],
+        version: str,
+        disease_offsets: List[int],
+    ):
+        self.columns = columns
+        self.categories = categories
+        self.version = version
+        self.disease_offsets = disease_offsets
+        self._codes = {name: {value: i for i, value in enumerate(values)} for name, values in categories.items()}
+        self.index = RegistryIndex(columns, categories, disease_offsets)
+
+    def __len__(self) -> int:
+        return len(self.columns["patient_count"])
+
+    @classmethod
+    def load(cls, path: str) -> "DataSourceRegistry":
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in COLUMNS}
+        if any(len(column) != meta["rows"] for column in columns.values()):
+            raise ValueError(f"Registry partition {path} is incomplete")
+        return cls(columns, meta["categories"], meta["version"], meta["disease_offsets"])
+
+    def disease_codes(self, disease_area: str) -> Tuple[List[int], bool]:
+        """Codes of the registry disease areas matching a free-text disease area, and whether any matched.
+
+        "Type 2 Diabetes Mellitus" matches "Diabetes": either name may contain
+        the other. Otherwise DISEASE_AREA_SYNONYMS maps common terms to areas
+        ("Breast Cancer" to "Oncology"). A disease area matching nothing
+        falls back to every area rather than to no sources, as does an empty one.
+        """
+        query = disease_area.strip().lower()
+        names = self.categories["disease_area"]
+        if not query:
+            return list(range(len(names))), False
+        codes = [code for code, name in enumerate(names) if name.lower() in query or query in name.lower()]
+        if not codes:
+            areas = {area for pattern, area in DISEASE_AREA_PATTERNS if pattern.search(query)}
+            codes = [code for code, name in enumerate(names) if name in areas]
+        if codes:
+            return codes, True
+        return list(range(len(names))), False
+
+    def _codes_for(self, column: str, values: Sequence[str]) -> List[int]:
+        return [self._codes[column][value] for value in values if value in self._codes[column]]
+
+    def search(
+        self,
+        disease_area: str,
+        geography: Optional[Sequence[str]] = None,
+        data_types: Optional[Sequence[str]] = None,
+        minimum_patient_count: int = 0,
+        limit: int = 20,
+    ) -> np.ndarray:
+        """Row ids of the top `limit` matching sources by patient count, then quality score"""
+        filters = [("disease_area", self.disease_codes(disease_area)[0])]
+        if geography:
+            filters.append(("geography", self._codes_for("geography", geography)))
+        if data_types:
+            filters.append(("data_type", self._codes_for("data_type", data_types)))
+        if any(not codes for _, codes in filters):
+            return np.empty(0, dtype=np.int64)
+
+        # Each matching disease area is a contiguous, already ranked slice
+        candidates = []
+        for code in filters[0][1]:
+            start, end = self.index.disease_ranges[code]
+            if minimum_patient_count > 0:
+                # Ranked by patient count, so the qualifying rows form a prefix
+                counts = self.columns["patient_count"][start:end]
+                end -= np.searchsorted(counts[::-1], minimum_patient_count)
+            candidates.append(self.index.matching_rows(start, end, filters[1:], limit))
+
+        if len(candidates) == 1:
+            return candidates[0]
+        return self.top_k(np.concatenate(candidates), limit)
+
+    def top_k(self, rows: np.ndarray, limit: int) -> np.ndarray:
+        """Best `limit` rows, ordered by patient count then quality score, without a full sort"""
+        if len(rows) == 0 or limit <= 0:
+            return rows[:0]
+        # Quality scores are below 10, so they only break patient count ties
+        keys = self.columns["patient_count"][rows] + self.columns["quality_score"][rows].astype(np.float64) / 100
+        if len(rows) > limit:
+            best = np.argpartition(-keys, limit - 1)[:limit]
+            rows, keys = rows[best], keys[best]
+        return rows[np.argsort(-keys, kind="stable")]
+
+    def records(self, rows: np.ndarray) -> List[Dict]:
+        """Materialize rows as plain dicts"""
+        columns = {name: self.columns[name][rows] for name in COLUMNS}
+        return [
+            {
+                "source_id": columns["source_id"][i].decode(),
+                "source_name": columns["source_name"][i].decode(),
+                "disease_area": self.categories["disease_area"][columns["disease_area"][i]],
+                "data_type": self.categories["data_type"][columns["data_type"][i]],
+                "geography": self.categories["geography"][columns["geography"][i]],
+                "patient_count": int(columns["patient_count"][i]),
+                "last_updated": str(columns["last_updated"][i]),
+                "quality_score": round(float(columns["quality_score"][i]), 1),
+            }
+            for i in range(len(rows))
+        ]
+
+
+def write_registry(path: str, columns: Dict[str, np.ndarray], categories: Dict[str, List[str]], version: str):
+    """Write a registry directory; files are replaced whole, never modified in place.
+
+    Rows are sorted by disease area, then by patient count and quality score
+    descending, and the start of each disease area's cluster is recorded.
+    """
+    os.makedirs(path, exist_ok=True)
+    disease = np.asarray(columns["disease_area"])
+    order = np.lexsort((
+        -np.asarray(columns["quality_score"], dtype=np.float64),
+        -np.asarray(columns["patient_count"], dtype=np.int64),
+        disease,
+    ))
+    offsets = np.searchsorted(disease[order], np.arange(len(categories["disease_area"]) + 1))
+
+    for name, dtype in COLUMNS.items():
+        tmp = os.path.join(path, f".{name}.npy.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, np.asarray(columns[name], dtype=dtype)[order])
+        os.replace(tmp, os.path.join(path, f"{name}.npy"))
+    meta = {
+        "version": version,
+        "rows": len(order),
+        "categories": categories,
+        "disease_offsets": offsets.tolist(),
+    }
+    tmp = os.path.join(path, ".meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(path, "meta.json"))
+
+
+def generate_sample_registry(path: str, rows: int, seed: int = 0):
+    """Write a synthetic catalog for development and tests"""
+    rng = np.random.default_rng(seed)
+    disease = rng.integers(0, len(SAMPLE_DISEASE_AREAS), rows).astype(np.int16)
+    geography = rng.integers(0, len(SAMPLE_GEOGRAPHIES), rows).astype(np.int16)
+    data_type = rng.integers(0, len(SAMPLE_DATA_TYPES), rows).astype(np.int8)
+    ids = np.arange(rows)
+
+    geo_names = np.array(SAMPLE_GEOGRAPHIES)[geography]
+    type_names = np.array(SAMPLE_DATA_TYPES)[data_type]
+    columns = {
+        "source_id": np.char.add(np.char.add(np.char.add(geo_names, "_"), type_names),
+                                 np.char.mod("_%07d", ids)).astype("S24"),
+        "source_name": np.char.add(np.char.add(geo_names, " "), np.char.add(type_names, " Database")).astype("S64"),
+        "disease_area": disease,
+        "geography": geography,
+        "data_type": data_type,
+        "patient_count": rng.lognormal(8.5, 1.2, rows).clip(50, 2_000_000).astype(np.int32),
+        "quality_score": rng.uniform(6.0, 9.8, rows).round(1).astype(np.float32),
+        "last_updated": np.datetime64("2024-01-01") - rng.integers(0, 730, rows).astype("timedelta64[D]"),
+    }
+    categories = {
+        "disease_area": SAMPLE_DISEASE_AREAS,
+        "geography": SAMPLE_GEOGRAPHIES,
+        "data_type": SAMPLE_DATA_TYPES,
+    }
+    write_registry(path, columns, categories, version=f"sample-{rows}-{seed}")
+
+
+class RegistrySnapshot:
+    """Read-only view of all partitions of a registry directory.
+
+    A registry directory holds one or more partitions, each a subdirectory
+    written by write_registry (a directory that is itself a partition is
+    also accepted). Queries run on every partition and the per-partition
+    top matches are merged.
+    """
+
+    def __init__(self, partitions: Dict[str, DataSourceRegistry], signatures: Dict[str, Tuple], changed: List[str]):
+        self.partitions = partitions
+        self.signatures = signatures
+        self.changed = changed
+        digest = hashlib.sha1()
+        for name in sorted(partitions):
+            digest.update(f"{name}:{partitions[name].version};".encode())
+        self.version = digest.hexdigest()[:12]
+
+    def __len__(self) -> int:
+        return sum(len(partition) for partition in self.partitions.values())
+
+    def search(
+        self,
+        disease_area: str,
+        geography: Optional[Sequence[str]] = None,
+        data_types: Optional[Sequence[str]] = None,
+        minimum_patient_count: int = 0,
+        limit: int = 20,
+    ) -> List[Dict]:
+        """Records of the top `limit` matching sources across partitions.
+
+        Each record's `disease_area_matched` is False when the disease area
+        matched no registry area and sources of every area were searched.
+        """
+        hits = []
+        for partition in self.partitions.values():
+            rows = partition.search(disease_area, geography, data_types, minimum_patient_count, limit)
+            if len(rows):
+                matched = partition.disease_codes(disease_area)[1]
+                keys = partition.columns["patient_count"][rows] + partition.columns["quality_score"][rows] / 100
+                records = [{**record, "disease_area_matched": matched} for record in partition.records(rows)]
+                hits.extend(zip(keys.tolist(), records))
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        return [record for _, record in hits[:limit]]
+
+
+def _partition_dirs(path: str) -> Dict[str, str]:
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return {"": path}
+    if not os.path.isdir(path):
+        return {}
+    return {
+        name: os.path.join(path, name)
+        for name in sorted(os.listdir(path))
+        if os.path.exists(os.path.join(path, name, "meta.json"))
+    }
+
+
+def _signature(partition_path: str) -> Tuple:
+    stat = os.stat(os.path.join(partition_path, "meta.json"))
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def load_snapshot(path: str, previous: Optional[RegistrySnapshot] = None) -> RegistrySnapshot:
+    """Load the registry at `path`, reusing unchanged partitions of `previous`.
+
+    Only partitions whose meta.json changed are loaded and indexed again. A
+    partition that cannot be loaded (e.g. one being rewritten) keeps its
+    previous version if there is one and is skipped otherwise.
+    """
+    partitions, signatures, changed = {}, {}, []
+    for name, partition_path in _partition_dirs(path).items():
+        try:
+            signature = _signature(partition_path)
+        except OSError:
+            continue
+        if previous is not None and previous.signatures.get(name) == signature:
+            partitions[name] = previous.partitions[name]
+            signatures[name] = signature
+            continue
+        try:
+            partitions[name] = DataSourceRegistry.load(partition_path)
+            signatures[name] = signature
+            changed.append(name)
+        except (OSError, ValueError, KeyError):
+            if previous is not None and name in previous.partitions:
+                partitions[name] = previous.partitions[name]
+                signatures[name] = previous.signatures[name]
+    if previous is not None:
+        changed.extend(name for name in previous.partitions if name not in partitions)
+    return RegistrySnapshot(partitions, signatures, changed)
+
+
+def load_or_create_registry(path: str, sample_rows: int = 100000) -> RegistrySnapshot:
+    """Load the registry at `path`, generating the sample catalog there if none exists"""
+    if not _partition_dirs(path):
+        generate_sample_registry(os.path.join(path, "part-000"), sample_rows)
+    return load_snapshot(path)
+
+
+class RegistryLoader:
+    """Keeps the current registry snapshot fresh from a background thread.
+
+    The thread polls the registry directory every `interval` seconds and
+    builds a new snapshot, reloading and re-indexing only changed
+    partitions, entirely off the request path. The new snapshot replaces the
+    old one with a single reference assignment, so requests never wait on a
+    reload and each request sees one consistent snapshot.
+    """
+
+    def __init__(self, path: str, interval: float = 30.0, sample_rows: int = 100000):
+        self.path = path
+        self.interval = interval
+        self.sample_rows = sample_rows
+        self._snapshot: Optional[RegistrySnapshot] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.loaded_at: Optional[float] = None
+        self.reloads = 0
+        self.errors = 0
+
+    @property
+    def snapshot(self) -> RegistrySnapshot:
+        if self._snapshot is None:
+            self._load_initial()
+        return self._snapshot
+
+    def _load_initial(self):
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = load_or_create_registry(self.path, self.sample_rows)
+                self.loaded_at = time.time()
+
+    def refresh(self) -> bool:
+        """Load changed partitions; True if a new snapshot was swapped in"""
+        with self._lock:
+            current = self._snapshot
+            updated = load_snapshot(self.path, previous=current)
+            if current is not None and not updated.changed:
+                return False
+            self._snapshot = updated
+            self.loaded_at = time.time()
+            self.reloads += 1
+        logger.info("Registry %s loaded (changed partitions: %s)", updated.version, ", ".join(updated.changed) or "none")
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                self.errors += 1
+                logger.exception("Registry refresh failed; keeping version %s", self._snapshot and self._snapshot.version)
+
+    def start(self):
+        """Load the registry now, then watch it for changes"""
+        self._load_initial()
+        if self._thread is None and self.interval > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="registry-loader", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def status(self) -> Dict:
+        snapshot = self._snapshot
+        return {
+            "version": snapshot.version if snapshot else None,
+            "partitions": len(snapshot.partitions) if snapshot else 0,
+            "rows": len(snapshot) if snapshot else 0,
+            "loaded_at": datetime.fromtimestamp(self.loaded_at).isoformat() if self.loaded_at else None,
+            "reloads": self.reloads,
+            "errors": self.errors,
+        }
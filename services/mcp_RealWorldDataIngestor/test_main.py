@@ -1,6 +1,19 @@
 import pytest
+import os
+import tempfile
+import numpy as np
 from fastapi.testclient import TestClient
+
+DATA_DIR = tempfile.mkdtemp()
+os.environ.setdefault("REGISTRY_PATH", os.path.join(DATA_DIR, "registry"))
+os.environ.setdefault("QUALITY_PATH", os.path.join(DATA_DIR, "quality"))
+os.environ.setdefault("REGISTRY_SAMPLE_ROWS", "20000")
+os.environ.setdefault("PATIENTS_PATH", os.path.join(DATA_DIR, "patients"))
+os.environ.setdefault("PATIENT_SAMPLE_ROWS", "50000")
+
+import main
 from main import app
+from utils.criteria import CriteriaPlan
 
 client = TestClient(app)
 
@@ -39,5 +52,343 @@ def test_all_endpoints():
         response = client.post(f"/{endpoint}", json=test_data)
         assert response.status_code in [200, 400, 422, 500]
         
+def test_estimate_cohort_size_is_reproducible_with_seed():
+    payload = {
+        "base_population": 100000,
+        "inclusion_criteria": ["Age > 18", "HbA1c > 7"],
+        "exclusion_criteria": ["Pregnant"],
+        "seed": 42
+    }
+    first = client.post("/estimate_cohort_size", json=payload).json()
+    second = client.post("/estimate_cohort_size", json=payload).json()
+    assert first == second
+    interval = first["confidence_interval"]
+    assert interval["lower"] < first["estimated_cohort_size"] < interval["upper"]
+    assert interval["level"] == 0.95
+    # Two inclusion criteria keep 9%-64% of patients, one exclusion 70%-95%
+    assert 100000 * 0.3 * 0.3 * 0.7 <= interval["lower"]
+    assert interval["upper"] <= 100000 * 0.8 * 0.8 * 0.95
+    assert first["factors_considered"]["inclusion_criteria_count"] == 2
+
+def test_estimate_cohort_size_for_many_criteria_sets():
+    criteria_sets = [
+        {"inclusion_criteria": [], "exclusion_criteria": []},
+        {"inclusion_criteria": ["a"], "exclusion_criteria": []},
+        {"inclusion_criteria": ["a", "b", "c"], "exclusion_criteria": ["x"], "base_population": 5000},
+    ]
+    response = client.post("/estimate_cohort_size", json={"criteria_sets": criteria_sets, "seed": 7, "samples": 2000})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [r["estimated_cohort_size"] for r in results][0] == 100000
+    assert 30000 < results[1]["estimated_cohort_size"] < 80000
+    assert results[2]["factors_considered"]["base_population"] == 5000
+    assert results[2]["confidence_interval"]["upper"] < 5000 * 0.8 ** 3
+
+def test_estimate_cohort_size_rejects_bad_parameters():
+    assert client.post("/estimate_cohort_size", json={"samples": 0}).status_code == 400
+    assert client.post("/estimate_cohort_size", json={"criteria_sets": "x"}).status_code == 400
+    for base_population in (-5, 0, 1.5, "100000", True):
+        assert client.post("/estimate_cohort_size", json={"base_population": base_population}).status_code == 400
+    assert client.post("/estimate_cohort_size", json={"criteria_sets": [{"base_population": -5}]}).status_code == 400
+
+def test_estimate_cohort_size_reuses_compiled_plan():
+    plan = CriteriaPlan.from_text(
+        ["Type 2 diabetes diagnosis ≥6 months", "HbA1c 7.0-10.0% at screening", "Age 18-75 years"],
+        ["Type 1 diabetes", "eGFR <45 mL/min/1.73m²", "Pregnancy or lactation"]
+    )
+    assert plan.inclusion == [
+        {"type": "measurement", "code": "4548-4", "min": 7.0, "max": 10.0},
+        {"type": "condition", "codes": ["E11"]},
+        {"type": "age", "min": 18, "max": 75},
+    ]
+    assert {"type": "measurement", "code": "33914-3", "max": 45.0, "max_exclusive": True} in plan.exclusion
+    assert {"type": "condition", "codes": ["O", "Z33", "Z391"]} in plan.exclusion
+
+    # Rephrased or reordered criteria compile to the same plan
+    same = CriteriaPlan.from_text(
+        ["aged 18 to 75 years", "T2DM", "A1c between 7 and 10"],
+        ["lactation or pregnancy", "Type I diabetes", "eGFR less than 45"]
+    )
+    assert same.hash == plan.hash
+
+    by_plan = client.post("/estimate_cohort_size", json={"criteria_plan": plan.to_dict(), "seed": 3}).json()
+    by_text = client.post("/estimate_cohort_size", json={
+        "inclusion_criteria": ["aged 18 to 75 years", "T2DM", "A1c between 7 and 10"],
+        "exclusion_criteria": ["lactation or pregnancy", "Type I diabetes", "eGFR less than 45"],
+        "seed": 3
+    }).json()
+    assert by_plan == by_text
+    assert by_plan["plan_hash"] == plan.hash
+    assert by_plan["factors_considered"]["inclusion_criteria_count"] == 3
+
+    tampered = {**plan.to_dict(), "hash": "0" * 16}
+    assert client.post("/estimate_cohort_size", json={"criteria_plan": tampered}).status_code == 400
+
+def test_identify_sources_filters_and_ranks_registry():
+    query = {
+        "disease_area": "Type 2 Diabetes Mellitus",
+        "geography": ["USA", "UK"],
+        "data_types": ["EHR"],
+        "minimum_patient_count": 1000,
+        "limit": 10
+    }
+    response = client.post("/identify_sources", json=query)
+    assert response.status_code == 200
+    sources = response.json()
+    assert len(sources) == 10
+    assert all(s["geography"] in ("USA", "UK") and s["data_type"] == "EHR" for s in sources)
+    assert all(s["disease_area"] == "Diabetes" and s["patient_count"] >= 1000 for s in sources)
+    assert all(s["disease_area_matched"] for s in sources)
+    counts = [s["patient_count"] for s in sources]
+    assert counts == sorted(counts, reverse=True)
+
+def test_identify_sources_maps_disease_synonyms():
+    expected = {"Breast Cancer": "Oncology", "Rheumatoid Arthritis": "Rheumatology", "COVID-19": "Infectious Disease",
+                "Chronic Kidney Disease": "Nephrology", "Major Depressive Disorder": "Psychiatry"}
+    for disease_area, registry_area in expected.items():
+        sources = client.post("/identify_sources", json={"disease_area": disease_area, "limit": 5}).json()
+        assert len(sources) == 5
+        assert all(s["disease_area"] == registry_area and s["disease_area_matched"] for s in sources)
+
+def test_identify_sources_unknown_disease_area_searches_all_areas():
+    response = client.post("/identify_sources", json={"disease_area": "Unknownitis", "limit": 5})
+    assert response.status_code == 200
+    sources = response.json()
+    assert len(sources) == 5
+    assert not any(s["disease_area_matched"] for s in sources)
+    counts = [s["patient_count"] for s in sources]
+    assert counts == sorted(counts, reverse=True)
+
+    for empty in ("", "   "):
+        assert client.post("/identify_sources", json={"disease_area": empty}).status_code == 400
+        assert main.get_registry().search(empty, limit=3)[0]["disease_area_matched"] is False
+
+def test_registry_top_k_matches_full_sort(tmp_path):
+    from registry import DataSourceRegistry, generate_sample_registry
+
+    generate_sample_registry(str(tmp_path), rows=5000, seed=3)
+    registry = DataSourceRegistry.load(str(tmp_path))
+    assert isinstance(registry.columns["patient_count"], np.memmap)
+
+    rows = registry.search("oncology", geography=["Japan", "France"], minimum_patient_count=500, limit=7)
+    columns = registry.columns
+    mask = (
+        (columns["disease_area"] == registry.categories["disease_area"].index("Oncology"))
+        & np.isin(columns["geography"], [registry.categories["geography"].index(g) for g in ("Japan", "France")])
+        & (columns["patient_count"] >= 500)
+    )
+    expected = sorted(
+        np.flatnonzero(mask),
+        key=lambda row: (columns["patient_count"][row], columns["quality_score"][row]),
+        reverse=True
+    )[:7]
+    assert [int(columns["patient_count"][r]) for r in rows] == [int(columns["patient_count"][r]) for r in expected]
+
+def test_registry_index_bitmap_intersection_matches_scan(tmp_path):
+    from registry import DataSourceRegistry, generate_sample_registry
+
+    generate_sample_registry(str(tmp_path), rows=3001, seed=5)
+    registry = DataSourceRegistry.load(str(tmp_path))
+    columns = registry.columns
+    geos = [registry.categories["geography"].index(g) for g in ("USA", "India", "Israel")]
+    types = [registry.categories["data_type"].index(t) for t in ("Lab", "Registry")]
+    start, end = registry.index.disease_ranges[registry.categories["disease_area"].index("Neurology")]
+
+    rows = registry.index.matching_rows(start, end, [("geography", geos), ("data_type", types)], limit=10000)
+    in_range = np.arange(start, end)
+    expected = in_range[np.isin(columns["geography"][start:end], geos) & np.isin(columns["data_type"][start:end], types)]
+    assert rows.tolist() == expected.tolist()
+
+def test_registry_snapshot_reloads_only_changed_partitions(tmp_path):
+    from registry import generate_sample_registry, load_snapshot
+
+    generate_sample_registry(str(tmp_path / "part-a"), rows=1000, seed=1)
+    generate_sample_registry(str(tmp_path / "part-b"), rows=1000, seed=2)
+    first = load_snapshot(str(tmp_path))
+    assert sorted(first.changed) == ["part-a", "part-b"] and len(first) == 2000
+
+    generate_sample_registry(str(tmp_path / "part-b"), rows=500, seed=3)
+    second = load_snapshot(str(tmp_path), previous=first)
+    assert second.changed == ["part-b"]
+    assert second.partitions["part-a"] is first.partitions["part-a"]
+    assert len(second) == 1500 and second.version != first.version
+
+    results = second.search("Oncology", limit=5)
+    counts = [r["patient_count"] for r in results]
+    assert len(results) == 5 and counts == sorted(counts, reverse=True)
+
+def test_registry_loader_swaps_in_changed_partitions(tmp_path):
+    import time
+    from registry import RegistryLoader, generate_sample_registry
+
+    loader = RegistryLoader(str(tmp_path), interval=0.05, sample_rows=1000)
+    loader.start()
+    try:
+        before = loader.snapshot
+        assert list(before.partitions) == ["part-000"]
+
+        generate_sample_registry(str(tmp_path / "part-001"), rows=500, seed=9)
+        deadline = time.monotonic() + 5
+        while loader.snapshot is before and time.monotonic() < deadline:
+            time.sleep(0.02)
+        after = loader.snapshot
+        assert sorted(after.partitions) == ["part-000", "part-001"]
+        assert after.partitions["part-000"] is before.partitions["part-000"]
+        assert loader.status()["version"] == after.version != before.version
+        assert loader.status()["rows"] == 1500
+    finally:
+        loader.stop()
+
+def test_health_reports_registry_version():
+    with TestClient(app) as lifespan_client:
+        health = lifespan_client.get("/health").json()
+    assert health["registry_version"]
+    assert health["registry"]["rows"] == 20000
+
+def test_data_quality_assessment_batch_streams_ndjson():
+    import json
+
+    sources = client.post("/identify_sources", json={"disease_area": "Oncology", "limit": 3}).json()
+    source_ids = [s["source_id"] for s in sources] + ["missing_source"]
+    response = client.post("/data_quality_assessment_batch", json={"source_ids": source_ids})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert [r["source_id"] for r in results] == source_ids
+    assert results[-1]["error"] == "Unknown source_id"
+    for result in results[:-1]:
+        metrics = result["quality_metrics"]
+        assert set(metrics) == {"completeness", "accuracy", "timeliness", "consistency", "validity"}
+        assert all(80 <= value <= 100 for value in metrics.values())
+        assert result["overall_quality_score"] == pytest.approx(sum(metrics.values()) / 5, abs=0.1)
+
+    single = client.post("/data_quality_assessment", json={"source_id": source_ids[0]}).json()
+    assert single == results[0]
+    assert client.post("/data_quality_assessment", json={"source_id": "missing_source"}).status_code == 404
+    assert client.post("/data_quality_assessment_batch", json={"source_ids": "x"}).status_code == 400
+    # Ids are never truncated into a match with another source
+    assert client.post("/data_quality_assessment", json={"source_id": source_ids[0] + "x" * 24}).status_code == 400
+    assert client.post("/data_quality_assessment_batch", json={"source_ids": [source_ids[0] + "x" * 24]}).status_code == 400
+
+def test_quality_table_follows_registry_reloads(tmp_path):
+    from quality import load_or_create_quality_table
+    from registry import generate_sample_registry, load_snapshot
+
+    generate_sample_registry(str(tmp_path / "registry" / "part-000"), 50, seed=1)
+    first = load_or_create_quality_table(str(tmp_path / "quality"), load_snapshot(str(tmp_path / "registry")))
+    assert len(first) == 50
+    before = first.assess([first.columns["source_id"][0].decode()])[0]
+
+    generate_sample_registry(str(tmp_path / "registry" / "part-001"), 30, seed=2)
+    registry = load_snapshot(str(tmp_path / "registry"))
+    table = load_or_create_quality_table(str(tmp_path / "quality"), registry)
+    added = registry.partitions["part-001"].columns["source_id"]
+    assert all(table.lookup(added)[1])
+    # Sources already assessed keep their counts
+    assert table.assess([before["source_id"]])[0] == before
+
+def test_quality_metrics_computed_from_audit_counts(tmp_path):
+    from quality import QualityTable, write_quality_table
+
+    write_quality_table(str(tmp_path), {
+        "source_id": np.array([b"b", b"a"]),
+        "fields_expected": np.array([200, 100]),
+        "fields_populated": np.array([150, 90]),
+        "records_audited": np.array([10, 0]),
+        "records_accurate": np.array([9, 0]),
+        "days_since_refresh": np.array([50.0, 0.0]),
+        "checks_run": np.array([4, 2]),
+        "checks_passed": np.array([3, 2]),
+        "values_checked": np.array([10, 10]),
+        "values_valid": np.array([10, 5]),
+    }, version="test")
+    table = QualityTable.load(str(tmp_path))
+    a, b = table.assess(["a", "b"])
+    assert a["quality_metrics"] == {"completeness": 90.0, "accuracy": 0.0, "timeliness": 100.0, "consistency": 100.0, "validity": 50.0}
+    assert b["quality_metrics"] == {"completeness": 75.0, "accuracy": 90.0, "timeliness": 95.0, "consistency": 75.0, "validity": 100.0}
+    assert b["overall_quality_score"] == 87.0
+
+def test_count_cohort_only_evaluates_new_predicates():
+    inclusion = ["Adults aged 18-75", "Type 2 diabetes", "HbA1c between 7% and 10%"]
+    exclusion = ["eGFR < 45", "Pregnancy"]
+    first = client.post("/count_cohort", json={"inclusion_criteria": inclusion, "exclusion_criteria": exclusion}).json()
+    assert first["plan_cached"] is False
+    assert first["not_applied"] == []
+
+    # Same count as filtering the patient records directly
+    from main import get_cohort_cache
+    c = get_cohort_cache().table.columns
+    def having(kind, prefixes):
+        codes = np.asarray(c[f"{kind}_code"]).astype(str)
+        return np.isin(np.arange(len(c["age"])), c[f"{kind}_patient"][np.char.startswith(codes, prefixes)])
+    def lab(code, keep):
+        rows = np.asarray(c["measurement_code"]) == code.encode()
+        return np.isin(np.arange(len(c["age"])), c["measurement_patient"][rows][keep(c["measurement_value"][rows])])
+    expected = (
+        (c["age"] >= 18) & (c["age"] <= 75) & having("condition", "E11")
+        & lab("4548-4", lambda v: (v >= 7) & (v <= 10))
+        & ~lab("33914-3", lambda v: v < 45) & ~having("condition", "O") & ~having("condition", "Z33")
+    )
+    assert first["patient_count"] == int(expected.sum()) > 0
+    assert first["population"] == 50000
+
+    again = client.post("/count_cohort", json={"criteria_plan": CriteriaPlan.from_text(inclusion, exclusion).to_dict()}).json()
+    assert again["plan_cached"] is True and again["predicates_evaluated"] == 0
+    assert again["patient_count"] == first["patient_count"]
+
+    # One tweaked criterion: only its bitmap is computed, the rest are intersected from cache
+    tweaked = client.post("/count_cohort", json={
+        "inclusion_criteria": ["Adults aged 18-75", "Type 2 diabetes", "HbA1c between 7% and 9%"],
+        "exclusion_criteria": exclusion
+    }).json()
+    assert tweaked["predicates_evaluated"] == 1
+    assert tweaked["patient_count"] <= first["patient_count"]
+    assert tweaked["plan_hash"] != first["plan_hash"]
+
+    health = client.get("/health").json()["cohort_cache"]
+    assert health["plan_hits"] >= 1 and health["bitmaps"] >= 6
+
+def test_count_cohort_reports_free_text_and_rejects_bad_input():
+    result = client.post("/count_cohort", json={"criteria_sets": [
+        {"inclusion_criteria": ["Type 2 diabetes", "Willing to attend monthly visits"]},
+        {"inclusion_criteria": ["Type 2 diabetes"]},
+    ]}).json()["results"]
+    assert result[0]["not_applied"] == [{"type": "text", "text": "willing to attend monthly visits"}]
+    assert result[0]["patient_count"] == result[1]["patient_count"]
+    assert client.post("/count_cohort", json={"criteria_sets": "x"}).status_code == 400
+    assert client.post("/count_cohort", json={"criteria_plan": {"inclusion": [{"type": "bogus"}]}}).status_code == 400
+
+def test_count_cohort_both_genders_and_plus_thresholds():
+    both, ages = client.post("/count_cohort", json={"criteria_sets": [
+        {"inclusion_criteria": ["Men and women aged 18 to 65"]},
+        {"inclusion_criteria": ["Aged 18 to 65"]},
+    ]}).json()["results"]
+    assert both["patient_count"] == ages["patient_count"] > 0
+
+    assert CriteriaPlan.from_text(["BMI 30+"], []).inclusion == [{"type": "measurement", "code": "39156-5", "min": 30.0}]
+    assert CriteriaPlan.from_text(["Men or women 65+ years"], []).inclusion == [
+        {"type": "age", "min": 65},
+        {"type": "any", "predicates": [{"type": "gender", "value": "female"}, {"type": "gender", "value": "male"}]},
+    ]
+
+def test_cohort_bitmap_cache_evicts_least_recently_used(tmp_path):
+    from patients import CohortBitmapCache, PatientTable, generate_sample_patients
+
+    generate_sample_patients(str(tmp_path), 1000, seed=1)
+    cache = CohortBitmapCache(PatientTable.load(str(tmp_path)), max_bytes=2000)
+    male, female, adult = ({"type": "gender", "value": "male"}, {"type": "gender", "value": "female"},
+                           {"type": "age", "min": 18})
+    assert (cache.bitmap(male) | cache.bitmap(female)).all()
+    cache.bitmap(male)
+    cache.bitmap(adult)
+    status = cache.status()
+    assert status["bitmaps"] == 2 and status["bitmaps_evicted"] == 1
+    evaluated = []
+    cache.bitmap(male, evaluated)
+    cache.bitmap(female, evaluated)
+    assert len(evaluated) == 1
+    assert not cache.bitmap(male).flags.writeable
+
 if __name__ == "__main__":
     pytest.main([__file__])
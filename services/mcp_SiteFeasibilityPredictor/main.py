@@ -19,26 +19,59 @@ app.add_middleware(
 async def health_check():
     return {"status": "healthy", "service": "mcp_SiteFeasibilityPredictor"}
 
+def _predict_country_feasibility(country: Optional[str], data: Dict) -> Dict:
+    """Feasibility prediction for a single country"""
+    # Mock implementation
+    # In production, this would call actual dcri-mcp-tools
+    return {
+        "mock_result": f"Processed by predict_feasibility",
+        "confidence": round(random.uniform(0.7, 0.95), 2)
+    }
+
 @app.post("/predict_feasibility")
 async def predict_feasibility(data: Dict):
     """"Predict site feasibility score"""
     try:
-        # Mock implementation
-        # In production, this would call actual dcri-mcp-tools
         result = {
             "status": "success",
             "service": "mcp_SiteFeasibilityPredictor",
             "endpoint": "predict_feasibility",
             "timestamp": datetime.now().isoformat(),
-            "data": {
-                "mock_result": f"Processed by predict_feasibility",
-                "confidence": round(random.uniform(0.7, 0.95), 2)
-            }
+            "data": _predict_country_feasibility(data.get("country"), data)
         }
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/predict_feasibility_batch")
+async def predict_feasibility_batch(data: Dict):
+    """Predict site feasibility for several countries in one call.
+
+    Expects "countries" (list) and optionally "sites" mapping each country to
+    candidate site ids; the remaining fields apply to every country.
+    """
+    countries = data.get("countries")
+    if not isinstance(countries, list):
+        raise HTTPException(status_code=400, detail="countries must be a list")
+    try:
+        sites = data.get("sites") or {}
+        shared = {k: v for k, v in data.items() if k not in ("countries", "sites")}
+        results = {}
+        for country in countries:
+            country_data = {**shared, "country": country}
+            results[country] = _predict_country_feasibility(country, country_data)
+            if country in sites:
+                results[country]["sites"] = sites[country]
+        return {
+            "status": "success",
+            "service": "mcp_SiteFeasibilityPredictor",
+            "endpoint": "predict_feasibility_batch",
+            "timestamp": datetime.now().isoformat(),
+            "results": results
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/assess_capabilities")
 async def assess_capabilities(data: Dict):
     """"Assess site capabilities and resources"""
@@ -38,6 +38,26 @@ def test_all_endpoints():
     for endpoint in endpoints:
         response = client.post(f"/{endpoint}", json=test_data)
         assert response.status_code in [200, 400, 422, 500]
-        
+
+
+def test_batch_endpoint():
+    """Batch endpoint returns one result per requested country"""
+    test_data = {
+        "countries": ["USA", "UK", "Japan"],
+        "sites": {"USA": ["USA_SITE_001"]}
+    }
+    response = client.post("/predict_feasibility_batch", json=test_data)
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert set(results) == {"USA", "UK", "Japan"}
+    assert results["USA"]["sites"] == ["USA_SITE_001"]
+    assert "confidence" in results["UK"]
+
+
+def test_batch_endpoint_requires_country_list():
+    response = client.post("/predict_feasibility_batch", json={"countries": "USA"})
+    assert response.status_code == 400
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,234 @@
+import hashlib
+import json
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def cache_key(service: str, endpoint: str, payload: Dict) -> str:
+    """Stable key for an upstream call; payload key order does not matter"""
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    digest = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    return f"{service}:{endpoint}:{digest}"
+
+
+class CacheBackend(ABC):
+    """Storage interface for serialized cache entries"""
+
+    name = "base"
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float):
+        ...
+
+    @abstractmethod
+    async def clear(self):
+        ...
+
+    async def aclose(self):
+        pass
+
+    def metrics(self) -> Dict:
+        return {"backend": self.name}
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Process-local store with TTL expiry and LRU eviction by total size"""
+
+    name = "memory"
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        if len(value) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._bytes += len(value)
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, value = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    async def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def metrics(self) -> Dict:
+        return {
+            "backend": self.name,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class RedisCacheBackend(CacheBackend):
+    """Shared store speaking the Redis protocol.
+
+    Lets every orchestrator replica read and warm the same cache. Expiry uses
+    Redis TTLs; size bounds and LRU eviction are left to the server's
+    maxmemory / maxmemory-policy settings.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str = "redis://localhost:6379/0", prefix: str = "rwe:cache:", client=None):
+        self.url = url
+        self.prefix = prefix
+        if client is None:
+            import redis.asyncio as redis_asyncio
+            client = redis_asyncio.from_url(url)
+        self.client = client
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self.client.set(self.prefix + key, value, px=max(1, int(ttl * 1000)))
+
+    async def clear(self):
+        keys = [key async for key in self.client.scan_iter(match=self.prefix + "*")]
+        if keys:
+            await self.client.delete(*keys)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def metrics(self) -> Dict:
+        return {"backend": self.name, "prefix": self.prefix}
+
+
+def create_cache_backend(name: str, max_bytes: int, redis_url: Optional[str] = None) -> CacheBackend:
+    """Build the backend selected by name ("memory" or "redis")"""
+    if name == "memory":
+        return MemoryCacheBackend(max_bytes=max_bytes)
+    if name == "redis":
+        return RedisCacheBackend(url=redis_url or "redis://localhost:6379/0")
+    raise ValueError(f"Unknown cache backend: {name}")
+
+
+class CacheStats:
+    """Hit/miss counters for one cached endpoint"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def as_dict(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class ResponseCache:
+    """Cache for deterministic MCP responses.
+
+    Only endpoints listed in `endpoint_ttls` are cached, each with its own TTL
+    in seconds. Entries are stored as serialized JSON in the configured
+    backend, so callers never share mutable results. Backend failures are
+    counted and treated as misses rather than failing the upstream call.
+
+    Entries are kept for `stale_seconds` past their TTL so that `get_stale`
+    can still serve them when the upstream call itself cannot complete.
+    """
+
+    def __init__(
+        self,
+        endpoint_ttls: Dict[Tuple[str, str], float],
+        backend: Optional[CacheBackend] = None,
+        stale_seconds: float = 0.0,
+    ):
+        self.endpoint_ttls = endpoint_ttls
+        self.backend = backend or MemoryCacheBackend()
+        self.stale_seconds = stale_seconds
+        self.backend_errors = 0
+        self.stale_hits = 0
+        self.stats = {f"{service}{endpoint}": CacheStats() for service, endpoint in endpoint_ttls}
+
+    def is_cacheable(self, service: str, endpoint: str) -> bool:
+        return (service, endpoint) in self.endpoint_ttls
+
+    async def _load(self, service: str, endpoint: str, payload: Dict) -> Optional[Dict]:
+        try:
+            data = await self.backend.get(cache_key(service, endpoint, payload))
+        except Exception:
+            self.backend_errors += 1
+            return None
+        return json.loads(data) if data is not None else None
+
+    async def get(self, service: str, endpoint: str, payload: Dict) -> Optional[Any]:
+        """Fresh cached response for the call, or None on a miss"""
+        stats = self.stats[f"{service}{endpoint}"]
+        entry = await self._load(service, endpoint, payload)
+        if entry is None or time.time() - entry["stored_at"] > self.endpoint_ttls[(service, endpoint)]:
+            stats.misses += 1
+            return None
+        stats.hits += 1
+        return entry["value"]
+
+    async def get_stale(self, service: str, endpoint: str, payload: Dict) -> Optional[Any]:
+        """Cached response even if past its TTL, for use when the upstream is unavailable"""
+        entry = await self._load(service, endpoint, payload)
+        if entry is None:
+            return None
+        self.stale_hits += 1
+        return entry["value"]
+
+    async def set(self, service: str, endpoint: str, payload: Dict, value: Any):
+        """Store a response; values that cannot be serialized are skipped"""
+        try:
+            data = json.dumps({"stored_at": time.time(), "value": value}, separators=(",", ":")).encode("utf-8")
+        except (TypeError, ValueError):
+            return
+        ttl = self.endpoint_ttls[(service, endpoint)] + self.stale_seconds
+        try:
+            await self.backend.set(cache_key(service, endpoint, payload), data, ttl)
+        except Exception:
+            self.backend_errors += 1
+
+    async def clear(self):
+        await self.backend.clear()
+
+    async def aclose(self):
+        await self.backend.aclose()
+
+    def metrics(self) -> Dict:
+        return {
+            **self.backend.metrics(),
+            "hits": sum(stats.hits for stats in self.stats.values()),
+            "misses": sum(stats.misses for stats in self.stats.values()),
+            "stale_hits": self.stale_hits,
+            "backend_errors": self.backend_errors,
+            "endpoints": {name: stats.as_dict() for name, stats in self.stats.items()},
+        }
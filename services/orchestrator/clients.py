@@ -0,0 +1,127 @@
+import asyncio
+import os
+from typing import Dict, Optional
+
+import httpx
+from pydantic import BaseModel
+
+try:
+    import h2  # noqa: F401  (required by httpx for HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class ServiceClientConfig(BaseModel):
+    """Connection settings for a single MCP service"""
+    timeout: float = 30.0
+    connect_timeout: float = 5.0
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 30.0
+    http2: bool = True
+    max_concurrency: int = 16
+    # Backup requests are opt-in per service via <SERVICE>_HEDGE_DELAY
+    hedge_delay: float = 0.0
+
+
+def _env_prefix(service_name: str) -> str:
+    return service_name.upper()
+
+
+def load_service_configs(services: Dict[str, str]) -> Dict[str, ServiceClientConfig]:
+    """Build per-service client settings from the MCP service map.
+
+    Every setting can be overridden per service through environment variables
+    named after the service key, e.g. PROTOCOL_SCORER_TIMEOUT or
+    DIVERSITY_MAPPER_MAX_CONCURRENCY.
+    """
+    defaults = ServiceClientConfig()
+    configs = {}
+    for service_name in services:
+        prefix = _env_prefix(service_name)
+        configs[service_name] = ServiceClientConfig(
+            timeout=float(os.getenv(f"{prefix}_TIMEOUT", defaults.timeout)),
+            connect_timeout=float(os.getenv(f"{prefix}_CONNECT_TIMEOUT", defaults.connect_timeout)),
+            max_connections=int(os.getenv(f"{prefix}_MAX_CONNECTIONS", defaults.max_connections)),
+            max_keepalive_connections=int(
+                os.getenv(f"{prefix}_MAX_KEEPALIVE", defaults.max_keepalive_connections)
+            ),
+            keepalive_expiry=float(os.getenv(f"{prefix}_KEEPALIVE_EXPIRY", defaults.keepalive_expiry)),
+            http2=os.getenv(f"{prefix}_HTTP2", "true").lower() == "true",
+            max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", defaults.max_concurrency)),
+            hedge_delay=float(os.getenv(f"{prefix}_HEDGE_DELAY", defaults.hedge_delay)),
+        )
+    return configs
+
+
+class ServiceClientRegistry:
+    """Long-lived, pooled HTTP clients for the MCP services.
+
+    One httpx.AsyncClient is kept per service so connections stay warm between
+    orchestration requests instead of being re-established on every call.
+    HTTP/2 is negotiated where the upstream supports it (TLS endpoints) and
+    the client falls back to keep-alive HTTP/1.1 otherwise.
+    """
+
+    def __init__(self, services: Dict[str, str], configs: Optional[Dict[str, ServiceClientConfig]] = None):
+        self.services = services
+        self.configs = configs or load_service_configs(services)
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _build_client(self, service_name: str) -> httpx.AsyncClient:
+        config = self.configs.get(service_name, ServiceClientConfig())
+        return httpx.AsyncClient(
+            base_url=self.services[service_name],
+            timeout=httpx.Timeout(config.timeout, connect=config.connect_timeout),
+            limits=httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+                keepalive_expiry=config.keepalive_expiry,
+            ),
+            http2=config.http2 and HTTP2_AVAILABLE,
+        )
+
+    def _check_loop(self):
+        # Connection pools are bound to the event loop that created them
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._clients = {}
+            self._loop = loop
+
+    async def start(self):
+        """Open a client for every configured service"""
+        self._check_loop()
+        for service_name in self.services:
+            if service_name not in self._clients:
+                self._clients[service_name] = self._build_client(service_name)
+
+    def get(self, service_name: str) -> httpx.AsyncClient:
+        """Return the pooled client for a service, creating it on first use"""
+        if service_name not in self.services:
+            raise KeyError(f"Unknown MCP service: {service_name}")
+        self._check_loop()
+        client = self._clients.get(service_name)
+        if client is None or client.is_closed:
+            client = self._build_client(service_name)
+            self._clients[service_name] = client
+        return client
+
+    async def aclose(self):
+        """Close all pooled clients"""
+        clients, self._clients = self._clients, {}
+        await asyncio.gather(*(client.aclose() for client in clients.values()), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Dict]:
+        """Current pool configuration and state for each service"""
+        return {
+            service_name: {
+                "url": self.services[service_name],
+                "open": service_name in self._clients and not self._clients[service_name].is_closed,
+                "http2": self.configs[service_name].http2 and HTTP2_AVAILABLE,
+                "timeout": self.configs[service_name].timeout,
+                "max_connections": self.configs[service_name].max_connections,
+            }
+            for service_name in self.services
+        }
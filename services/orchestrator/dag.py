@@ -0,0 +1,133 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+# Builds a step's request payload from the results of its dependencies
+PayloadBuilder = Callable[[Dict[str, Any]], Dict]
+
+# Performs one upstream call: (service, endpoint, payload) -> parsed JSON
+ServiceCall = Callable[[str, str, Dict], Awaitable[Any]]
+
+# Substitute result for a step that failed or missed the deadline:
+# (step, payload or None if it could not be built, error) -> result or None to omit
+StepFallback = Callable[["Step", Optional[Dict], BaseException], Awaitable[Any]]
+
+# Notified with (step name, result) as soon as each step has a result
+StepListener = Callable[[str, Any], None]
+
+# Marks a step with no result in partial execution
+_MISSING = object()
+
+
+class Step:
+    """A single upstream call in an orchestration graph"""
+
+    def __init__(
+        self,
+        name: str,
+        service: str,
+        endpoint: str,
+        payload: PayloadBuilder,
+        depends_on: Iterable[str] = (),
+    ):
+        self.name = name
+        self.service = service
+        self.endpoint = endpoint
+        self.payload = payload
+        self.depends_on = list(depends_on)
+
+    def __repr__(self) -> str:
+        return f"Step({self.name!r}, {self.service}{self.endpoint}, depends_on={self.depends_on})"
+
+
+class StepGraph:
+    """Validated, topologically ordered set of steps"""
+
+    def __init__(self, steps: Iterable[Step]):
+        self.steps: Dict[str, Step] = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f"Duplicate step name: {step.name}")
+            self.steps[step.name] = step
+
+        for step in self.steps.values():
+            missing = [dep for dep in step.depends_on if dep not in self.steps]
+            if missing:
+                raise ValueError(f"Step {step.name} depends on unknown steps: {', '.join(missing)}")
+
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> List[Step]:
+        remaining = {name: set(step.depends_on) for name, step in self.steps.items()}
+        order = []
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Dependency cycle between steps: {', '.join(sorted(remaining))}")
+            for name in ready:
+                order.append(self.steps[name])
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+
+
+async def execute_graph(
+    graph: StepGraph,
+    call: ServiceCall,
+    deadline: Optional[float] = None,
+    fallback: Optional[StepFallback] = None,
+    on_result: Optional[StepListener] = None,
+) -> Dict[str, Any]:
+    """Run every step as soon as its dependencies have completed.
+
+    Steps without dependencies all start immediately, so the total latency is
+    that of the slowest dependency chain rather than the sum of all calls. If
+    any step fails, the remaining steps are cancelled and the error is raised.
+
+    With a `deadline` (event loop time), execution is partial instead: each
+    step may only use the time left until the deadline, and a step that fails
+    or runs out of time is handed to `fallback`. Steps without a result, and
+    the steps depending on them, are left out of the returned dict.
+
+    `on_result`, if given, is called with each step's result as soon as it is
+    available, e.g. to stream sections before the whole graph has finished.
+    """
+    loop = asyncio.get_running_loop()
+    tasks: Dict[str, asyncio.Future] = {}
+
+    async def run(step: Step) -> Any:
+        result = await run_step(step)
+        if on_result is not None and result is not _MISSING:
+            on_result(step.name, result)
+        return result
+
+    async def run_step(step: Step) -> Any:
+        upstream = {dep: await tasks[dep] for dep in step.depends_on}
+        if deadline is None:
+            return await call(step.service, step.endpoint, step.payload(upstream))
+
+        if any(result is _MISSING for result in upstream.values()):
+            return _MISSING
+        payload = None
+        try:
+            payload = step.payload(upstream)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            return await asyncio.wait_for(call(step.service, step.endpoint, payload), remaining)
+        except Exception as error:
+            substitute = await fallback(step, payload, error) if fallback else None
+            return _MISSING if substitute is None else substitute
+
+    for step in graph.order:
+        tasks[step.name] = asyncio.ensure_future(run(step))
+
+    try:
+        results = await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+
+    return {name: result for name, result in zip(tasks, results) if result is not _MISSING}
@@ -0,0 +1,249 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Runs one job: request payload -> JSON-serializable result
+JobRunner = Callable[[Dict], Awaitable[Any]]
+
+# Maps a job failure to (status code, detail) as stored with the job
+JobErrorMapper = Callable[[BaseException], Tuple[int, str]]
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class JobNotFoundError(KeyError):
+    """Raised for an unknown job id"""
+
+
+class JobStore:
+    """SQLite-backed job records.
+
+    Each job keeps its request, status, timestamps and, once finished, its
+    result or error, so state survives restarts of the orchestrator. Writes are
+    small single-row updates and are made directly from the event loop.
+    """
+
+    def __init__(self, path: str = "jobs.db"):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    batch_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    request TEXT NOT NULL,
+                    result TEXT,
+                    error_status INTEGER,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._db().execute(sql, params)
+
+    def create_batch(self, requests: List[Dict]) -> List[str]:
+        batch_id = uuid.uuid4().hex
+        now = time.time()
+        rows = [(uuid.uuid4().hex, batch_id, QUEUED, json.dumps(request), now) for request in requests]
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            db.executemany(
+                "INSERT INTO jobs (id, batch_id, status, request, created_at) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            db.execute("COMMIT")
+        return [row[0] for row in rows]
+
+    def get(self, job_id: str) -> Dict:
+        row = self._execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            raise JobNotFoundError(job_id)
+        job = dict(row)
+        job["request"] = json.loads(job["request"])
+        job["result"] = json.loads(job["result"]) if job["result"] is not None else None
+        return job
+
+    def list_jobs(self, status: Optional[str] = None, batch_id: Optional[str] = None, limit: int = 100) -> List[Dict]:
+        clauses, params = [], []
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if batch_id:
+            clauses.append("batch_id = ?")
+            params.append(batch_id)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self._execute(
+            f"SELECT id, batch_id, status, error_status, error, created_at, started_at, finished_at "
+            f"FROM jobs {where} ORDER BY created_at, rowid LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def queued_ids(self) -> List[str]:
+        rows = self._execute("SELECT id FROM jobs WHERE status = ? ORDER BY created_at, rowid", (QUEUED,))
+        return [row["id"] for row in rows.fetchall()]
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def claim(self, job_id: str) -> bool:
+        """Move a queued job to running; False if it is no longer queued (e.g. cancelled)"""
+        cursor = self._execute(
+            "UPDATE jobs SET status = ?, started_at = ? WHERE id = ? AND status = ?",
+            (RUNNING, time.time(), job_id, QUEUED),
+        )
+        return cursor.rowcount == 1
+
+    def finish(self, job_id: str, status: str, result: Any = None,
+               error_status: Optional[int] = None, error: Optional[str] = None):
+        self._execute(
+            "UPDATE jobs SET status = ?, result = ?, error_status = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, json.dumps(result) if result is not None else None, error_status, error, time.time(), job_id),
+        )
+
+    def cancel_queued(self, job_id: str) -> bool:
+        cursor = self._execute(
+            "UPDATE jobs SET status = ?, finished_at = ? WHERE id = ? AND status = ?",
+            (CANCELLED, time.time(), job_id, QUEUED),
+        )
+        return cursor.rowcount == 1
+
+    def requeue_running(self) -> int:
+        """Return jobs interrupted by a shutdown to the queue"""
+        cursor = self._execute(
+            "UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?", (QUEUED, RUNNING)
+        )
+        return cursor.rowcount
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class JobQueue:
+    """Bounded worker pool draining the persistent job store.
+
+    `workers` jobs run at a time, which caps the planning throughput the job
+    API can impose on the MCP services regardless of how many jobs are
+    submitted. Submissions are rejected once `max_queued` jobs are waiting.
+    Jobs still queued or running when the pool stops are picked up again the
+    next time it starts.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        runner: JobRunner,
+        error_mapper: JobErrorMapper,
+        workers: int = 4,
+        max_queued: int = 10000,
+    ):
+        self.store = store
+        self.runner = runner
+        self.error_mapper = error_mapper
+        self.workers = workers
+        self.max_queued = max_queued
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._running: Dict[str, asyncio.Task] = {}
+        self._stopping = False
+
+    @property
+    def started(self) -> bool:
+        return bool(self._workers)
+
+    async def start(self):
+        self._stopping = False
+        self.store.requeue_running()
+        self._queue = asyncio.Queue()
+        for job_id in self.store.queued_ids():
+            self._queue.put_nowait(job_id)
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        self._stopping = True
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+        self.store.requeue_running()
+
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else len(self.store.queued_ids())
+
+    def submit(self, requests: List[Dict]) -> List[str]:
+        if self.queued() + len(requests) > self.max_queued:
+            raise OverflowError(f"Job queue is full ({self.max_queued} jobs waiting)")
+        job_ids = self.store.create_batch(requests)
+        if self._queue is not None:
+            for job_id in job_ids:
+                self._queue.put_nowait(job_id)
+        return job_ids
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job; False if it had already finished"""
+        job = self.store.get(job_id)
+        if job["status"] == QUEUED and self.store.cancel_queued(job_id):
+            return True
+        task = self._running.get(job_id)
+        return task.cancel() if task is not None else False
+
+    async def _work(self):
+        while True:
+            job_id = await self._queue.get()
+            if not self.store.claim(job_id):
+                continue
+            job = self.store.get(job_id)
+            task = asyncio.ensure_future(self.runner(job["request"]))
+            self._running[job_id] = task
+            try:
+                result = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if self._stopping:
+                    task.cancel()
+                    raise
+                self.store.finish(job_id, CANCELLED)
+            except Exception as error:
+                status_code, detail = self.error_mapper(error)
+                self.store.finish(job_id, FAILED, error_status=status_code, error=detail)
+            else:
+                self.store.finish(job_id, SUCCEEDED, result=result)
+            finally:
+                self._running.pop(job_id, None)
+
+    def metrics(self) -> Dict:
+        return {
+            "workers": self.workers,
+            "started": self.started,
+            "queued": self.queued(),
+            "running": len(self._running),
+            "max_queued": self.max_queued,
+            "jobs": self.store.counts(),
+        }
@@ -0,0 +1,83 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+
+class LimiterStats:
+    """Queueing metrics for one service's concurrency limit"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "completed": self.completed,
+            "avg_wait_ms": round(1000 * self.total_wait_seconds / self.completed, 3) if self.completed else 0.0,
+            "max_wait_ms": round(1000 * self.max_wait_seconds, 3),
+        }
+
+
+class ServiceLimiter:
+    """Caps in-flight requests per MCP service across all orchestrations.
+
+    Requests beyond a service's limit wait in FIFO order for a free slot, so a
+    burst of plans queues inside the orchestrator instead of piling hundreds
+    of concurrent posts onto a single downstream container.
+    """
+
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = limits
+        self.stats = {service: LimiterStats(limit) for service, limit in limits.items()}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _semaphore(self, service: str) -> asyncio.Semaphore:
+        # Semaphores are bound to the event loop they are first used on
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphores = {}
+            self._loop = loop
+        if service not in self._semaphores:
+            self._semaphores[service] = asyncio.Semaphore(self.limits[service])
+        return self._semaphores[service]
+
+    @asynccontextmanager
+    async def acquire(self, service: str):
+        """Hold one of the service's concurrency slots for the duration of the block"""
+        if service not in self.limits:
+            raise KeyError(f"Unknown MCP service: {service}")
+        semaphore = self._semaphore(service)
+        stats = self.stats[service]
+
+        stats.queued += 1
+        stats.max_queued = max(stats.max_queued, stats.queued)
+        started = time.perf_counter()
+        try:
+            await semaphore.acquire()
+        finally:
+            stats.queued -= 1
+
+        waited = time.perf_counter() - started
+        stats.total_wait_seconds += waited
+        stats.max_wait_seconds = max(stats.max_wait_seconds, waited)
+        stats.in_flight += 1
+        try:
+            yield
+        finally:
+            stats.in_flight -= 1
+            stats.completed += 1
+            semaphore.release()
+
+    def metrics(self) -> Dict[str, Dict]:
+        return {service: stats.as_dict() for service, stats in self.stats.items()}
@@ -1,21 +1,23 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
+from contextlib import asynccontextmanager
 import httpx
 import asyncio
+import json
 import os
 
-app = FastAPI(title="RWE Study Planner Orchestrator")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+from clients import ServiceClientRegistry
+from dag import Step, StepFallback, StepGraph, StepListener, execute_graph
+from limits import ServiceLimiter
+from cache import ResponseCache, create_cache_backend
+from singleflight import SingleFlight
+from resilience import CircuitBreaker, CircuitOpenError, RequestHedger, UpstreamError
+from jobs import FINISHED_STATES, SUCCEEDED, JobNotFoundError, JobQueue, JobStore
+from utils.criteria import CriteriaPlan
 
 # Service URLs - using Docker service names for internal networking
 # In production, these would be environment variables pointing to Azure endpoints
@@ -29,6 +31,101 @@ MCP_SERVICES = {
     "soa_comparator": os.getenv("SOA_URL", "http://mcp_soacomparator:8240")
 }
 
+# Pooled clients, one per MCP service, shared across all requests
+service_clients = ServiceClientRegistry(MCP_SERVICES)
+
+# Per-service cap on in-flight requests, shared by every orchestration in the process
+service_limiter = ServiceLimiter({
+    service_name: config.max_concurrency for service_name, config in service_clients.configs.items()
+})
+
+# Read-only upstream endpoints; identical concurrent calls to these are coalesced
+IDEMPOTENT_ENDPOINTS = {
+    ("protocol_scorer", "/score"),
+    ("data_ingestor", "/identify_sources"),
+    ("data_ingestor", "/estimate_cohort_size"),
+    ("feasibility_predictor", "/predict_feasibility"),
+    ("feasibility_predictor", "/predict_feasibility_batch"),
+    ("diversity_mapper", "/calculate_diversity"),
+    ("diversity_mapper", "/calculate_diversity_batch"),
+    ("soa_comparator", "/analyze_burden"),
+}
+
+single_flight = SingleFlight()
+
+# Per-service circuit breakers; a service failing most of its recent calls is
+# skipped for CIRCUIT_OPEN_SECONDS instead of tying requests up until timeout
+circuit_breakers = {
+    service_name: CircuitBreaker(
+        service_name,
+        window_seconds=float(os.getenv("CIRCUIT_WINDOW_SECONDS", 30)),
+        min_requests=int(os.getenv("CIRCUIT_MIN_REQUESTS", 10)),
+        error_threshold=float(os.getenv("CIRCUIT_ERROR_THRESHOLD", 0.5)),
+        open_seconds=float(os.getenv("CIRCUIT_OPEN_SECONDS", 15))
+    )
+    for service_name in MCP_SERVICES
+}
+
+# Idempotent endpoints that get a backup request when the first attempt is
+# slower than the service's <SERVICE>_HEDGE_DELAY (default 0: no hedging)
+HEDGED_ENDPOINTS = {
+    ("protocol_scorer", "/score"),
+    ("diversity_mapper", "/calculate_diversity"),
+    ("diversity_mapper", "/calculate_diversity_batch"),
+}
+
+request_hedger = RequestHedger({
+    service_name: config.hedge_delay for service_name, config in service_clients.configs.items()
+})
+
+# Upstream endpoints whose responses are deterministic for a given payload.
+# Only these are cached; set CACHE_ENABLED=false to bypass the cache entirely.
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", 900))
+CACHEABLE_ENDPOINTS = {
+    ("protocol_scorer", "/score"): CACHE_TTL_SECONDS,
+    ("data_ingestor", "/identify_sources"): CACHE_TTL_SECONDS,
+    ("diversity_mapper", "/calculate_diversity"): CACHE_TTL_SECONDS,
+    ("diversity_mapper", "/calculate_diversity_batch"): CACHE_TTL_SECONDS,
+} if os.getenv("CACHE_ENABLED", "true").lower() == "true" else {}
+
+# CACHE_BACKEND=redis shares cached responses across orchestrator replicas
+# Expired entries are kept for CACHE_STALE_SECONDS to fill in degraded plans
+response_cache = ResponseCache(
+    CACHEABLE_ENDPOINTS,
+    backend=create_cache_backend(
+        os.getenv("CACHE_BACKEND", "memory"),
+        max_bytes=int(os.getenv("CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+        redis_url=os.getenv("CACHE_REDIS_URL")
+    ),
+    stale_seconds=float(os.getenv("CACHE_STALE_SECONDS", 86400))
+)
+
+# Default overall deadline for plan_rwe_study; unset means wait for every step
+PLAN_DEADLINE_SECONDS = float(os.getenv("PLAN_DEADLINE_SECONDS")) if os.getenv("PLAN_DEADLINE_SECONDS") else None
+
+# Bulk planning: largest accepted batch and default overall deadline
+BULK_MAX_REQUESTS = int(os.getenv("BULK_MAX_REQUESTS", 500))
+BULK_DEADLINE_SECONDS = float(os.getenv("BULK_DEADLINE_SECONDS", 300))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await service_clients.start()
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    await service_clients.aclose()
+    await response_cache.aclose()
+
+app = FastAPI(title="RWE Study Planner Orchestrator", lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
 class RWEStudyRequest(BaseModel):
     protocol_text: str
     disease_area: str
@@ -39,6 +136,7 @@ class RWEStudyRequest(BaseModel):
     study_duration_months: int
     primary_endpoints: List[str]
     secondary_endpoints: List[str]
+    deadline_seconds: Optional[float] = None  # enables partial results when set
 
 class SiteRecommendation(BaseModel):
     site_id: str
@@ -51,178 +149,768 @@ class SiteRecommendation(BaseModel):
     strengths: List[str]
     challenges: List[str]
 
+class DegradedSection(BaseModel):
+    section: str
+    reason: str
+    fallback: str  # "cache" (possibly stale result used) or "omitted"
+
 class RWEStudyPlan(BaseModel):
     study_id: str
     protocol_complexity_score: float
-    estimated_total_cohort_size: int
+    estimated_total_cohort_size: Optional[int]
     recommended_sites: List[SiteRecommendation]
     data_sources: List[Dict]
     timeline_estimate: Dict
     risk_factors: List[str]
     optimization_opportunities: List[str]
+    degraded_sections: List[DegradedSection] = []
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "service": "orchestrator", "timestamp": datetime.now().isoformat()}
 
+@app.get("/metrics")
+async def get_metrics():
+    """Orchestrator-side metrics for upstream MCP calls"""
+    return {
+        "concurrency": service_limiter.metrics(),
+        "cache": response_cache.metrics(),
+        "coalescing": single_flight.metrics(),
+        "circuit_breakers": {name: breaker.metrics() for name, breaker in circuit_breakers.items()},
+        "hedging": request_hedger.metrics(),
+        "jobs": job_queue.metrics(),
+        "clients": service_clients.stats()
+    }
+
 @app.get("/service_status")
 async def check_service_status():
     """Check health status of all MCP services"""
-    status = {}
-    async with httpx.AsyncClient(timeout=5.0) as client:
-        for service_name, url in MCP_SERVICES.items():
-            try:
-                response = await client.get(f"{url}/health")
-                status[service_name] = "healthy" if response.status_code == 200 else "unhealthy"
-            except:
-                status[service_name] = "unreachable"
-    return status
+    async def probe(service_name: str) -> str:
+        try:
+            response = await service_clients.get(service_name).get("/health", timeout=5.0)
+            return "healthy" if response.status_code == 200 else "unhealthy"
+        except:
+            return "unreachable"
 
-@app.post("/plan_rwe_study", response_model=RWEStudyPlan)
-async def plan_rwe_study(request: RWEStudyRequest):
-    """Main orchestration endpoint that coordinates all MCP services"""
+    results = await asyncio.gather(*(probe(service_name) for service_name in MCP_SERVICES))
+    return dict(zip(MCP_SERVICES, results))
+
+def parse_response(response: httpx.Response):
+    """JSON body of an upstream response; NDJSON bodies become a list of objects"""
+    if response.headers.get("content-type", "").split(";")[0].strip() == "application/x-ndjson":
+        return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+    return response.json()
+
+def upstream_error(service: str, endpoint: str, response: httpx.Response) -> UpstreamError:
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            # Step 1: Assess Protocol Complexity
-            protocol_response = await client.post(
-                f"{MCP_SERVICES['protocol_scorer']}/score",
-                json={"protocol_text": request.protocol_text}
-            )
-            protocol_complexity = protocol_response.json()
-            
-            # Step 2: Identify Data Sources (parallel calls)
-            data_source_task = client.post(
-                f"{MCP_SERVICES['data_ingestor']}/identify_sources",
-                json={
-                    "disease_area": request.disease_area,
-                    "geography": request.target_countries,
-                    "minimum_patient_count": request.target_enrollment
-                }
-            )
-            
-            # Step 3: Estimate Cohort Size
-            cohort_task = client.post(
-                f"{MCP_SERVICES['data_ingestor']}/estimate_cohort_size",
-                json={
-                    "base_population": 100000,
-                    "inclusion_criteria": request.inclusion_criteria,
-                    "exclusion_criteria": request.exclusion_criteria
-                }
-            )
-            
-            # Execute parallel tasks
-            data_sources_response, cohort_response = await asyncio.gather(
-                data_source_task, cohort_task
-            )
-            
-            data_sources = data_sources_response.json()
-            cohort_estimate = cohort_response.json()
-            
-            # Step 4: Assess Site Feasibility for each country
-            site_recommendations = []
-            for country in request.target_countries:
-                # Parallel calls for feasibility and diversity
-                feasibility_task = client.post(
-                    f"{MCP_SERVICES['feasibility_predictor']}/predict_feasibility",
-                    json={
-                        "country": country,
-                        "protocol_complexity": protocol_complexity["overall_score"],
-                        "target_enrollment": request.target_enrollment
-                    }
-                )
-                
-                diversity_task = client.post(
-                    f"{MCP_SERVICES['diversity_mapper']}/calculate_diversity",
-                    json={"country": country}
-                )
-                
-                feasibility_resp, diversity_resp = await asyncio.gather(
-                    feasibility_task, diversity_task
-                )
-                
-                # Create site recommendations
-                for i in range(3):  # Mock 3 sites per country
-                    site = SiteRecommendation(
-                        site_id=f"{country}_SITE_{i+1:03d}",
-                        site_name=f"{country} Clinical Research Site {i+1}",
-                        country=country,
-                        feasibility_score=8.5 - (i * 0.3),
-                        diversity_score=7.8 - (i * 0.2),
-                        data_availability_score=8.0 - (i * 0.1),
-                        overall_rank=len(site_recommendations) + 1,
-                        strengths=[
-                            "Strong enrollment history",
-                            "Experienced research staff",
-                            "Good data quality"
-                        ][:2-i],
-                        challenges=[
-                            "Limited parking",
-                            "Competition from other studies"
-                        ][i:i+1]
-                    )
-                    site_recommendations.append(site)
-            
-            # Step 5: Compare Schedule of Assessments
-            soa_response = await client.post(
-                f"{MCP_SERVICES['soa_comparator']}/analyze_burden",
-                json={
-                    "study_duration_months": request.study_duration_months,
-                    "endpoints": request.primary_endpoints + request.secondary_endpoints
-                }
-            )
-            
-            # Sort sites by overall score
-            site_recommendations.sort(
-                key=lambda x: (x.feasibility_score + x.diversity_score + x.data_availability_score) / 3,
-                reverse=True
-            )
-            
-            # Update rankings
-            for idx, site in enumerate(site_recommendations):
-                site.overall_rank = idx + 1
-            
-            # Compile final study plan
-            study_plan = RWEStudyPlan(
-                study_id=f"RWE_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
-                protocol_complexity_score=protocol_complexity["overall_score"],
-                estimated_total_cohort_size=cohort_estimate["estimated_cohort_size"],
-                recommended_sites=site_recommendations[:10],  # Top 10 sites
-                data_sources=data_sources[:5],  # Top 5 data sources
-                timeline_estimate={
-                    "startup_months": 3,
-                    "enrollment_months": request.study_duration_months,
-                    "total_months": request.study_duration_months + 6
+        body = response.json()
+        detail = body.get("detail", body) if isinstance(body, dict) else body
+    except ValueError:
+        detail = response.text[:500]
+    return UpstreamError(service, endpoint, response.status_code, detail)
+
+async def call_service(service: str, endpoint: str, payload: Dict, timeout: Optional[float] = None):
+    """POST a payload to an MCP service and return the parsed JSON response.
+
+    Responses from cacheable endpoints are served from the response cache
+    when a fresh entry exists for the same payload, and identical concurrent
+    calls to idempotent endpoints share a single upstream request. Each
+    upstream attempt passes the service's circuit breaker and concurrency
+    limit; slow calls to hedged endpoints get one backup attempt. Non-2xx
+    responses raise UpstreamError once the breaker has recorded them.
+    """
+    cacheable = response_cache.is_cacheable(service, endpoint)
+    if cacheable:
+        cached = await response_cache.get(service, endpoint, payload)
+        if cached is not None:
+            return cached
+
+    async def attempt():
+        breaker = circuit_breakers[service]
+        breaker.before_call()
+        success = None
+        try:
+            options = {"timeout": timeout} if timeout is not None else {}
+            async with service_limiter.acquire(service):
+                response = await service_clients.get(service).post(endpoint, json=payload, **options)
+            success = response.status_code < 500
+        except httpx.RequestError:
+            success = False
+            raise
+        finally:
+            breaker.after_call(success)
+        if not response.is_success:
+            raise upstream_error(service, endpoint, response)
+        return response
+
+    async def fetch():
+        if (service, endpoint) in HEDGED_ENDPOINTS:
+            response = await request_hedger.call(service, attempt)
+        else:
+            response = await attempt()
+        result = parse_response(response)
+
+        if cacheable:
+            await response_cache.set(service, endpoint, payload, result)
+        return result
+
+    if (service, endpoint) in IDEMPOTENT_ENDPOINTS:
+        return await single_flight.do(service, endpoint, payload, fetch)
+    return await fetch()
+
+# Data sources included in a plan, and so assessed for quality
+PLAN_DATA_SOURCES = 5
+
+def top_source_ids(data_sources: List[Dict]) -> List[str]:
+    return [source["source_id"] for source in data_sources[:PLAN_DATA_SOURCES] if "source_id" in source]
+
+def attach_quality(data_sources: List[Dict], assessments) -> List[Dict]:
+    """Add each source's quality assessment from the batch quality results"""
+    if not isinstance(assessments, list):
+        return data_sources
+    by_id = {a.get("source_id"): a for a in assessments if isinstance(a, dict) and "error" not in a}
+    return [
+        {
+            **source,
+            "quality_assessment": {
+                "overall_quality_score": by_id[source["source_id"]]["overall_quality_score"],
+                "quality_metrics": by_id[source["source_id"]]["quality_metrics"]
+            }
+        } if source.get("source_id") in by_id else source
+        for source in data_sources
+    ]
+
+def build_plan_graph(request: RWEStudyRequest) -> StepGraph:
+    """Declare the upstream calls needed for a study plan and their dependencies.
+
+    Only the feasibility predictions (which need the protocol complexity score)
+    and the quality assessment of the top data sources wait on another call;
+    everything else can start as soon as the request arrives. The criteria
+    are compiled once into a plan shared with every service that needs them.
+    """
+    criteria_plan = CriteriaPlan.from_text(request.inclusion_criteria, request.exclusion_criteria)
+    steps = [
+        Step(
+            "protocol", "protocol_scorer", "/score",
+            lambda deps: {"protocol_text": request.protocol_text}
+        ),
+        Step(
+            "data_sources", "data_ingestor", "/identify_sources",
+            lambda deps: {
+                "disease_area": request.disease_area,
+                "geography": request.target_countries,
+                "minimum_patient_count": request.target_enrollment
+            }
+        ),
+        Step(
+            "cohort", "data_ingestor", "/estimate_cohort_size",
+            lambda deps: {
+                "base_population": 100000,
+                "criteria_plan": criteria_plan.to_dict()
+            }
+        ),
+        Step(
+            "soa", "soa_comparator", "/analyze_burden",
+            lambda deps: {
+                "study_duration_months": request.study_duration_months,
+                "endpoints": request.primary_endpoints + request.secondary_endpoints
+            }
+        ),
+        Step(
+            "data_quality", "data_ingestor", "/data_quality_assessment_batch",
+            lambda deps: {"source_ids": top_source_ids(deps["data_sources"])},
+            depends_on=["data_sources"]
+        ),
+    ]
+
+    if len(request.target_countries) > 1:
+        # One batch call per service instead of one call per country
+        steps.append(Step(
+            "feasibility", "feasibility_predictor", "/predict_feasibility_batch",
+            lambda deps: {
+                "countries": request.target_countries,
+                "protocol_complexity": deps["protocol"]["overall_score"],
+                "target_enrollment": request.target_enrollment
+            },
+            depends_on=["protocol"]
+        ))
+        steps.append(Step(
+            "diversity", "diversity_mapper", "/calculate_diversity_batch",
+            lambda deps: {"countries": request.target_countries}
+        ))
+    else:
+        for country in request.target_countries:
+            steps.append(Step(
+                f"feasibility:{country}", "feasibility_predictor", "/predict_feasibility",
+                lambda deps, country=country: {
+                    "country": country,
+                    "protocol_complexity": deps["protocol"]["overall_score"],
+                    "target_enrollment": request.target_enrollment
                 },
-                risk_factors=protocol_complexity.get("warnings", []),
-                optimization_opportunities=protocol_complexity.get("recommendations", [])
+                depends_on=["protocol"]
+            ))
+            steps.append(Step(
+                f"diversity:{country}", "diversity_mapper", "/calculate_diversity",
+                lambda deps, country=country: {"country": country}
+            ))
+
+    return StepGraph(steps)
+
+def results_by_country(results: Dict, step_prefix: str) -> Dict[str, Dict]:
+    """Per-country results of a step, whether it ran as a batch or per country"""
+    if step_prefix in results:
+        return results[step_prefix].get("results", {})
+    return {
+        name.split(":", 1)[1]: result.get("data", result)
+        for name, result in results.items()
+        if name.startswith(f"{step_prefix}:")
+    }
+
+def build_site_recommendations(countries: List[str]) -> List[SiteRecommendation]:
+    """Create ranked site recommendations for the target countries"""
+    site_recommendations = []
+    for country in countries:
+        for i in range(3):  # Mock 3 sites per country
+            site = SiteRecommendation(
+                site_id=f"{country}_SITE_{i+1:03d}",
+                site_name=f"{country} Clinical Research Site {i+1}",
+                country=country,
+                feasibility_score=8.5 - (i * 0.3),
+                diversity_score=7.8 - (i * 0.2),
+                data_availability_score=8.0 - (i * 0.1),
+                overall_rank=len(site_recommendations) + 1,
+                strengths=[
+                    "Strong enrollment history",
+                    "Experienced research staff",
+                    "Good data quality"
+                ][:2-i],
+                challenges=[
+                    "Limited parking",
+                    "Competition from other studies"
+                ][i:i+1]
             )
-            
-            return study_plan
-            
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=503, detail=f"Service communication error: {str(e)}")
+            site_recommendations.append(site)
+    
+    # Sort sites by overall score
+    site_recommendations.sort(
+        key=lambda x: (x.feasibility_score + x.diversity_score + x.data_availability_score) / 3,
+        reverse=True
+    )
+    
+    # Update rankings
+    for idx, site in enumerate(site_recommendations):
+        site.overall_rank = idx + 1
+    
+    return site_recommendations
+
+def assemble_study_plan(
+    request: RWEStudyRequest,
+    results: Dict,
+    degraded_sections: Optional[List[DegradedSection]] = None
+) -> RWEStudyPlan:
+    """Compile the final study plan from the step graph results.
+
+    Only the protocol complexity result is required; sections missing from
+    a partial run are left empty and should be listed in degraded_sections.
+    """
+    protocol_complexity = results["protocol"]
+    site_recommendations = build_site_recommendations(request.target_countries)
+    cohort_estimate = results.get("cohort")
+    
+    return RWEStudyPlan(
+        study_id=f"RWE_{datetime.now().strftime('%Y%m%d_%H%M%S')}",
+        protocol_complexity_score=protocol_complexity["overall_score"],
+        estimated_total_cohort_size=cohort_estimate["estimated_cohort_size"] if cohort_estimate else None,
+        recommended_sites=site_recommendations[:10],  # Top 10 sites
+        data_sources=attach_quality(
+            results.get("data_sources", [])[:PLAN_DATA_SOURCES],
+            results.get("data_quality")
+        ),
+        timeline_estimate={
+            "startup_months": 3,
+            "enrollment_months": request.study_duration_months,
+            "total_months": request.study_duration_months + 6
+        },
+        risk_factors=protocol_complexity.get("warnings", []),
+        optimization_opportunities=protocol_complexity.get("recommendations", []),
+        degraded_sections=degraded_sections or []
+    )
+
+def stale_cache_fallback(reasons: Dict[str, str], from_cache: set) -> StepFallback:
+    """Step fallback serving cached responses, even stale ones, for failed steps.
+
+    Records why each step failed in `reasons` and the steps served from the
+    cache in `from_cache`.
+    """
+    async def fallback(step: Step, payload: Optional[Dict], error: BaseException):
+        reasons[step.name] = "deadline exceeded" if isinstance(error, asyncio.TimeoutError) else f"{type(error).__name__}: {error}"
+        if payload is None or not response_cache.is_cacheable(step.service, step.endpoint):
+            return None
+        cached = await response_cache.get_stale(step.service, step.endpoint, payload)
+        if cached is not None:
+            from_cache.add(step.name)
+        return cached
+
+    return fallback
+
+async def run_partial_plan(
+    request: RWEStudyRequest,
+    deadline_seconds: float,
+    on_step_done: Optional[StepListener] = None
+) -> RWEStudyPlan:
+    """Run the plan graph against an overall deadline, degrading instead of failing.
+
+    Every step gets whatever is left of the deadline when it starts. Steps that
+    fail or run out of time are filled from the response cache (even if stale)
+    where possible, otherwise omitted; both cases are listed in
+    degraded_sections. The protocol complexity score is the one section a plan
+    cannot be built without.
+    """
+    graph = build_plan_graph(request)
+    reasons: Dict[str, str] = {}
+    from_cache = set()
+
+    # Keep a small share of the budget for assembling the response
+    deadline = asyncio.get_running_loop().time() + deadline_seconds * 0.95
+    results = await execute_graph(
+        graph, call_service, deadline=deadline,
+        fallback=stale_cache_fallback(reasons, from_cache), on_result=on_step_done
+    )
+
+    if "protocol" not in results:
+        raise HTTPException(
+            status_code=504,
+            detail=f"Protocol complexity unavailable within deadline ({reasons.get('protocol', 'unknown')})"
+        )
+
+    degraded_sections = [
+        DegradedSection(
+            section=name,
+            reason=reasons.get(name, "depends on an unavailable section"),
+            fallback="cache" if name in from_cache else "omitted"
+        )
+        for name in graph.steps
+        if name in from_cache or name not in results
+    ]
+    return assemble_study_plan(request, results, degraded_sections)
+
+async def run_plan(request: RWEStudyRequest, on_step_done: Optional[StepListener] = None) -> RWEStudyPlan:
+    """Build a study plan, in degradation mode if a deadline applies"""
+    deadline_seconds = request.deadline_seconds or PLAN_DEADLINE_SECONDS
+    if deadline_seconds:
+        return await run_partial_plan(request, deadline_seconds, on_step_done)
+
+    results = await execute_graph(build_plan_graph(request), call_service, on_result=on_step_done)
+    return assemble_study_plan(request, results)
+
+def orchestration_error(error: Exception) -> HTTPException:
+    """Map a failure while planning to the HTTP error returned to the client"""
+    if isinstance(error, HTTPException):
+        return error
+    if isinstance(error, (httpx.RequestError, CircuitOpenError)):
+        return HTTPException(status_code=503, detail=f"Service communication error: {str(error)}")
+    if isinstance(error, UpstreamError):
+        # Rejected input is the caller's error; an overloaded service is worth retrying
+        if error.status_code in (429, 503):
+            status_code = 503
+        elif error.status_code < 500:
+            status_code = 400
+        else:
+            status_code = 502
+        return HTTPException(status_code=status_code, detail=f"Upstream error: {str(error)}")
+    return HTTPException(status_code=500, detail=f"Orchestration error: {str(error)}")
+
+@app.post("/plan_rwe_study", response_model=RWEStudyPlan)
+async def plan_rwe_study(request: RWEStudyRequest):
+    """Main orchestration endpoint that coordinates all MCP services.
+
+    With a deadline (request.deadline_seconds or PLAN_DEADLINE_SECONDS) the
+    plan is returned on time with any late or failed sections degraded.
+    """
+    try:
+        return await run_plan(request)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Orchestration error: {str(e)}")
+        raise orchestration_error(e)
+
+# Plan steps streamed as their own section, keyed by step name
+STREAMED_SECTIONS = {
+    "protocol": "protocol_complexity",
+    "data_sources": "data_sources",
+    "cohort": "cohort_estimate",
+    "soa": "soa_burden",
+    "data_quality": "data_quality",
+}
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/plan_rwe_study/stream")
+async def plan_rwe_study_stream(request: RWEStudyRequest):
+    """Stream a study plan as Server-Sent Events.
+
+    Each section is sent as soon as its upstream calls finish:
+    protocol_complexity, data_sources, cohort_estimate, soa_burden and one
+    site_recommendations event per country. A final "plan" event carries the
+    complete RWEStudyPlan, or an "error" event if planning failed.
+    Planning only starts once the response starts streaming, so a client
+    that disconnects before then costs no upstream calls.
+    """
+    async def events():
+        queue: asyncio.Queue = asyncio.Queue()
+        results = {}
+        countries_sent = set()
+        plan_task = asyncio.ensure_future(
+            run_plan(request, on_step_done=lambda name, result: queue.put_nowait((name, result)))
+        )
+        plan_task.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                name, result = item
+                results[name] = result
+
+                if name in STREAMED_SECTIONS:
+                    data = result[:PLAN_DATA_SOURCES] if name == "data_sources" else result
+                    yield sse_event(STREAMED_SECTIONS[name], data)
+
+                feasibility = results_by_country(results, "feasibility")
+                diversity = results_by_country(results, "diversity")
+                for country in request.target_countries:
+                    if country not in countries_sent and country in feasibility and country in diversity:
+                        countries_sent.add(country)
+                        sites = build_site_recommendations([country])
+                        yield sse_event("site_recommendations", {
+                            "country": country,
+                            "sites": [site.model_dump() for site in sites]
+                        })
+
+            plan = plan_task.result()
+            yield sse_event("plan", plan.model_dump())
+        except Exception as e:
+            error = orchestration_error(e)
+            yield sse_event("error", {"status_code": error.status_code, "detail": error.detail})
+        finally:
+            if not plan_task.done():
+                plan_task.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def run_plan_job(request: Dict) -> Dict:
+    plan = await run_plan(RWEStudyRequest(**request))
+    return plan.model_dump()
+
+def job_error(error: BaseException):
+    http_error = orchestration_error(error)
+    return http_error.status_code, str(http_error.detail)
+
+class BulkPlanRequest(BaseModel):
+    requests: List[RWEStudyRequest]
+    deadline_seconds: Optional[float] = None
+
+class BulkPlanResult(BaseModel):
+    index: int
+    plan: Optional[RWEStudyPlan] = None
+    error: Optional[str] = None
+
+class BulkPlanResponse(BaseModel):
+    plans: List[BulkPlanResult]
+    upstream_calls: int
+    upstream_calls_without_sharing: int
+
+def build_bulk_plan_graph(requests: List[RWEStudyRequest]) -> Tuple[StepGraph, List[Dict[str, List[str]]]]:
+    """Declare the upstream calls for a batch of plans, each distinct call once.
+
+    Requests share a protocol score, cohort estimate or SoA analysis when their
+    inputs match (cohorts when their criteria compile to the same plan); data
+    sources are looked up once per disease area and country (with the smallest
+    minimum patient count any request needs), diversity in a single batch call
+    over all countries, and feasibility in one batch call per protocol and
+    enrollment target. The top sources of all plans are assessed for quality in
+    one call. Returns the graph and, for each request, the step names feeding
+    each plan section.
+    """
+    protocols: Dict[str, str] = {}
+    min_patients: Dict[Tuple[str, str], int] = {}
+    cohorts: Dict[str, CriteriaPlan] = {}
+    plan_hashes: List[str] = []
+    soas: Dict[Tuple, Tuple[int, List[str]]] = {}
+    feasibility_countries: Dict[Tuple[str, int], List[str]] = {}
+    all_countries: List[str] = []
+
+    for request in requests:
+        protocols.setdefault(request.protocol_text, f"protocol#{len(protocols)}")
+        for country in request.target_countries:
+            key = (request.disease_area, country)
+            min_patients[key] = min(min_patients.get(key, request.target_enrollment), request.target_enrollment)
+            if country not in all_countries:
+                all_countries.append(country)
+            countries = feasibility_countries.setdefault((request.protocol_text, request.target_enrollment), [])
+            if country not in countries:
+                countries.append(country)
+        plan = CriteriaPlan.from_text(request.inclusion_criteria, request.exclusion_criteria)
+        cohorts.setdefault(plan.hash, plan)
+        plan_hashes.append(plan.hash)
+        endpoints = request.primary_endpoints + request.secondary_endpoints
+        soas.setdefault((request.study_duration_months, tuple(endpoints)), (request.study_duration_months, endpoints))
+
+    steps = [
+        Step(name, "protocol_scorer", "/score", lambda deps, text=text: {"protocol_text": text})
+        for text, name in protocols.items()
+    ]
+    source_steps = {}
+    for (disease_area, country), minimum in min_patients.items():
+        source_steps[(disease_area, country)] = f"data_sources#{len(source_steps)}"
+        steps.append(Step(
+            source_steps[(disease_area, country)], "data_ingestor", "/identify_sources",
+            lambda deps, disease_area=disease_area, country=country, minimum=minimum: {
+                "disease_area": disease_area,
+                "geography": [country],
+                "minimum_patient_count": minimum
+            }
+        ))
+    cohort_steps = {}
+    for key, plan in cohorts.items():
+        cohort_steps[key] = f"cohort#{len(cohort_steps)}"
+        steps.append(Step(
+            cohort_steps[key], "data_ingestor", "/estimate_cohort_size",
+            lambda deps, plan=plan: {
+                "base_population": 100000,
+                "criteria_plan": plan.to_dict()
+            }
+        ))
+    soa_steps = {}
+    for key, (duration, endpoints) in soas.items():
+        soa_steps[key] = f"soa#{len(soa_steps)}"
+        steps.append(Step(
+            soa_steps[key], "soa_comparator", "/analyze_burden",
+            lambda deps, duration=duration, endpoints=endpoints: {
+                "study_duration_months": duration,
+                "endpoints": endpoints
+            }
+        ))
+    feasibility_steps = {}
+    for (text, enrollment), countries in feasibility_countries.items():
+        feasibility_steps[(text, enrollment)] = f"feasibility#{len(feasibility_steps)}"
+        steps.append(Step(
+            feasibility_steps[(text, enrollment)], "feasibility_predictor", "/predict_feasibility_batch",
+            lambda deps, protocol=protocols[text], countries=countries, enrollment=enrollment: {
+                "countries": countries,
+                "protocol_complexity": deps[protocol]["overall_score"],
+                "target_enrollment": enrollment
+            },
+            depends_on=[protocols[text]]
+        ))
+    if all_countries:
+        steps.append(Step(
+            "diversity", "diversity_mapper", "/calculate_diversity_batch",
+            lambda deps: {"countries": all_countries}
+        ))
+
+    sections = []
+    for request, plan_hash in zip(requests, plan_hashes):
+        endpoints = request.primary_endpoints + request.secondary_endpoints
+        sections.append({
+            "protocol": [protocols[request.protocol_text]],
+            "data_sources": [source_steps[(request.disease_area, c)] for c in request.target_countries],
+            "cohort": [cohort_steps[plan_hash]],
+            "soa": [soa_steps[(request.study_duration_months, tuple(endpoints))]],
+            "feasibility": [feasibility_steps[(request.protocol_text, request.target_enrollment)]] if request.target_countries else [],
+            "diversity": ["diversity"] if request.target_countries else [],
+            "data_quality": ["data_quality"] if source_steps else [],
+        })
+
+    if source_steps:
+        # One quality assessment for the top sources of every plan in the batch
+        def quality_payload(deps: Dict) -> Dict:
+            source_ids = []
+            for request, plan_sections in zip(requests, sections):
+                plan_sources = fan_out_bulk_results(request, plan_sections, deps).get("data_sources", [])
+                source_ids.extend(i for i in top_source_ids(plan_sources) if i not in source_ids)
+            return {"source_ids": source_ids}
+
+        steps.append(Step(
+            "data_quality", "data_ingestor", "/data_quality_assessment_batch",
+            quality_payload, depends_on=list(source_steps.values())
+        ))
+    return StepGraph(steps), sections
+
+def fan_out_bulk_results(request: RWEStudyRequest, sections: Dict[str, List[str]], results: Dict) -> Dict:
+    """Pick one request's share of the shared bulk results, in build_plan_graph's result shape"""
+    plan_results = {}
+    for section in ("protocol", "cohort", "soa"):
+        if sections[section][0] in results:
+            plan_results[section] = results[sections[section][0]]
+
+    sources = [
+        source
+        for name in sections["data_sources"] if name in results
+        for source in results[name]
+        if source.get("patient_count", 0) >= request.target_enrollment
+    ]
+    sources.sort(key=lambda x: (x.get("patient_count", 0), x.get("quality_score", 0)), reverse=True)
+    if all(name in results for name in sections["data_sources"]):
+        plan_results["data_sources"] = sources
+
+    if sections["data_quality"] and "data_quality" in results:
+        plan_results["data_quality"] = results["data_quality"]
+
+    for section in ("feasibility", "diversity"):
+        if sections[section] and sections[section][0] in results:
+            shared = results[sections[section][0]].get("results", {})
+            plan_results[section] = {
+                "results": {c: shared[c] for c in request.target_countries if c in shared}
+            }
+    return plan_results
+
+@app.post("/plan_rwe_study_bulk", response_model=BulkPlanResponse)
+async def plan_rwe_study_bulk(bulk: BulkPlanRequest):
+    """Plan many studies at once, sharing identical upstream calls across the batch.
+
+    A failure or timeout in one upstream call only degrades the plans that
+    use it; a plan whose protocol score is unavailable is returned with an
+    error instead.
+    """
+    if not bulk.requests:
+        raise HTTPException(status_code=400, detail="At least one study request is required")
+    if len(bulk.requests) > BULK_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_REQUESTS} study requests per bulk call")
+
+    graph, sections = build_bulk_plan_graph(bulk.requests)
+    reasons: Dict[str, str] = {}
+    from_cache = set()
+    deadline_seconds = bulk.deadline_seconds or BULK_DEADLINE_SECONDS
+    deadline = asyncio.get_running_loop().time() + deadline_seconds * 0.95
+    results = await execute_graph(
+        graph, call_service, deadline=deadline, fallback=stale_cache_fallback(reasons, from_cache)
+    )
+
+    plans = []
+    for index, (request, plan_sections) in enumerate(zip(bulk.requests, sections)):
+        protocol_step = plan_sections["protocol"][0]
+        if protocol_step not in results:
+            plans.append(BulkPlanResult(
+                index=index,
+                error=f"Protocol complexity unavailable ({reasons.get(protocol_step, 'unknown')})"
+            ))
+            continue
+
+        degraded_sections = []
+        for section, names in plan_sections.items():
+            missing = [name for name in names if name not in results]
+            cached = [name for name in names if name in from_cache]
+            if missing or cached:
+                name = (missing or cached)[0]
+                degraded_sections.append(DegradedSection(
+                    section=section,
+                    reason=reasons.get(name, "depends on an unavailable section"),
+                    fallback="omitted" if missing else "cache"
+                ))
+
+        plan = assemble_study_plan(request, fan_out_bulk_results(request, plan_sections, results), degraded_sections)
+        plan.study_id = f"{plan.study_id}_{index + 1:03d}"
+        plans.append(BulkPlanResult(index=index, plan=plan))
+
+    return BulkPlanResponse(
+        plans=plans,
+        upstream_calls=len(graph.steps),
+        upstream_calls_without_sharing=sum(len(build_plan_graph(request).steps) for request in bulk.requests)
+    )
+
+# Planning jobs run in the background by a bounded worker pool; job state
+# is kept in SQLite so queued jobs survive a restart
+job_queue = JobQueue(
+    JobStore(os.getenv("JOB_DB_PATH", "jobs.db")),
+    run_plan_job,
+    job_error,
+    workers=int(os.getenv("JOB_WORKERS", 4)),
+    max_queued=int(os.getenv("JOB_MAX_QUEUED", 10000))
+)
+
+class JobSubmission(BaseModel):
+    requests: List[RWEStudyRequest]
+
+def get_job_or_404(job_id: str) -> Dict:
+    try:
+        return job_queue.store.get(job_id)
+    except JobNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+def job_summary(job: Dict) -> Dict:
+    return {key: value for key, value in job.items() if key not in ("request", "result")}
+
+@app.post("/jobs", status_code=202)
+async def submit_jobs(submission: JobSubmission):
+    """Queue one planning job per study request; poll /jobs/{job_id} for progress"""
+    if not submission.requests:
+        raise HTTPException(status_code=400, detail="At least one study request is required")
+    try:
+        job_ids = job_queue.submit([request.model_dump() for request in submission.requests])
+    except OverflowError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return {
+        "batch_id": job_queue.store.get(job_ids[0])["batch_id"],
+        "job_ids": job_ids,
+        "status": "queued"
+    }
+
+@app.get("/jobs")
+async def list_jobs(
+    status: Optional[str] = None,
+    batch_id: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000)
+):
+    """List jobs, optionally filtered by status or batch"""
+    return {"jobs": job_queue.store.list_jobs(status=status, batch_id=batch_id, limit=limit)}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status of a planning job"""
+    return job_summary(get_job_or_404(job_id))
+
+@app.get("/jobs/{job_id}/result", response_model=RWEStudyPlan)
+async def get_job_result(job_id: str):
+    """Study plan produced by a job; 409 until it has succeeded"""
+    job = get_job_or_404(job_id)
+    if job["status"] == SUCCEEDED:
+        return job["result"]
+    if job["error_status"]:
+        raise HTTPException(status_code=job["error_status"], detail=job["error"])
+    raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['status']}")
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a queued or running job"""
+    job = get_job_or_404(job_id)
+    if job["status"] in FINISHED_STATES or not job_queue.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is already {job['status']}")
+    return {"id": job_id, "status": "cancelled"}
 
 @app.post("/quick_assessment")
 async def quick_assessment(data: Dict):
     """Lightweight assessment endpoint for quick protocol review"""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            # Just check protocol complexity
-            response = await client.post(
-                f"{MCP_SERVICES['protocol_scorer']}/score",
-                json={"protocol_text": data.get("protocol_text", "")}
-            )
-            
-            return {
-                "assessment": "quick",
-                "complexity": response.json(),
-                "recommendation": "Proceed with full planning" if response.json()["overall_score"] < 7 else "Consider protocol simplification first"
-            }
-            
+        # Just check protocol complexity
+        complexity = await call_service(
+            "protocol_scorer",
+            "/score",
+            {"protocol_text": data.get("protocol_text", "")},
+            timeout=10.0
+        )
+        
+        return {
+            "assessment": "quick",
+            "complexity": complexity,
+            "recommendation": "Proceed with full planning" if complexity["overall_score"] < 7 else "Consider protocol simplification first"
+        }
+        
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise orchestration_error(e)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,176 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit is open"""
+
+    def __init__(self, service: str, retry_after: float):
+        self.service = service
+        self.retry_after = retry_after
+        super().__init__(f"Circuit open for {service}; retry in {retry_after:.1f}s")
+
+
+class UpstreamError(Exception):
+    """An MCP service answered with a non-2xx status"""
+
+    def __init__(self, service: str, endpoint: str, status_code: int, detail: Any):
+        self.service = service
+        self.endpoint = endpoint
+        self.status_code = status_code
+        self.detail = detail
+        super().__init__(f"{service}{endpoint} returned {status_code}: {detail}")
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker driven by a rolling error-rate window.
+
+    While closed, call outcomes from the last `window_seconds` are kept; once
+    at least `min_requests` calls are in the window and the failure ratio
+    reaches `error_threshold`, the circuit opens and calls fail fast for
+    `open_seconds`. It then lets `half_open_max_calls` probe calls through: a
+    successful probe closes the circuit, a failed one re-opens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        service: str,
+        window_seconds: float = 30.0,
+        min_requests: int = 10,
+        error_threshold: float = 0.5,
+        open_seconds: float = 15.0,
+        half_open_max_calls: int = 1,
+    ):
+        self.service = service
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = self.CLOSED
+        self._outcomes: deque = deque()
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def _trim(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - self.window_seconds:
+            self._outcomes.popleft()
+
+    def error_rate(self) -> float:
+        self._trim(time.monotonic())
+        if not self._outcomes:
+            return 0.0
+        failures = sum(1 for _, ok in self._outcomes if not ok)
+        return failures / len(self._outcomes)
+
+    def _open(self, now: float):
+        self.state = self.OPEN
+        self._opened_at = now
+        self._probes_in_flight = 0
+        self.times_opened += 1
+
+    def before_call(self):
+        """Admit a call or raise CircuitOpenError"""
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            remaining = self._opened_at + self.open_seconds - now
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.service, remaining)
+            self.state = self.HALF_OPEN
+            self._probes_in_flight = 0
+        if self.state == self.HALF_OPEN:
+            if self._probes_in_flight >= self.half_open_max_calls:
+                self.rejected += 1
+                raise CircuitOpenError(self.service, 0.0)
+            self._probes_in_flight += 1
+
+    def after_call(self, success: Optional[bool]):
+        """Record a call outcome; None means the call was abandoned (e.g. a cancelled hedge)"""
+        now = time.monotonic()
+        if self.state == self.HALF_OPEN:
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+            if success is True:
+                self.state = self.CLOSED
+                self._outcomes.clear()
+            elif success is False:
+                self._open(now)
+            return
+        if success is None or self.state == self.OPEN:
+            return
+
+        self._outcomes.append((now, success))
+        self._trim(now)
+        if len(self._outcomes) >= self.min_requests and self.error_rate() >= self.error_threshold:
+            self._open(now)
+
+    def metrics(self) -> Dict:
+        return {
+            "state": self.state,
+            "error_rate": round(self.error_rate(), 4),
+            "window_calls": len(self._outcomes),
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+class HedgeStats:
+    def __init__(self):
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def as_dict(self) -> Dict:
+        return {"calls": self.calls, "hedges": self.hedges, "hedge_wins": self.hedge_wins}
+
+
+class RequestHedger:
+    """Issues a backup request when the first one is slower than a per-service delay.
+
+    Whichever attempt succeeds first wins and the other is cancelled. Only use
+    for idempotent calls: both attempts may reach the upstream service.
+    """
+
+    def __init__(self, delays: Dict[str, float], max_attempts: int = 2):
+        self.delays = delays
+        self.max_attempts = max_attempts
+        self.stats: Dict[str, HedgeStats] = {service: HedgeStats() for service in delays}
+
+    async def call(self, service: str, attempt: Callable[[], Awaitable[Any]]) -> Any:
+        stats = self.stats.setdefault(service, HedgeStats())
+        stats.calls += 1
+        delay = self.delays.get(service, 0)
+        first = asyncio.ensure_future(attempt())
+        pending = {first}
+        launched = 1
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                timeout = delay if delay > 0 and launched < self.max_attempts else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            stats.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+                if not done:
+                    pending.add(asyncio.ensure_future(attempt()))
+                    launched += 1
+                    stats.hedges += 1
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def metrics(self) -> Dict:
+        return {service: stats.as_dict() for service, stats in self.stats.items()}
@@ -0,0 +1,62 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from cache import cache_key
+
+
+class CoalescingStats:
+    """Counts of upstream calls made versus calls served by joining one in flight"""
+
+    def __init__(self):
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    def as_dict(self) -> Dict:
+        return {"upstream_calls": self.upstream_calls, "coalesced": self.coalesced}
+
+
+class SingleFlight:
+    """Shares one in-flight upstream call among identical concurrent requests.
+
+    The first caller for a (service, endpoint, payload) starts the call; every
+    identical request arriving before it completes awaits the same task
+    instead of issuing its own. The upstream task is shielded, so a cancelled
+    caller does not cancel the call for the others. Waiters receive the same
+    result object and must not mutate it.
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.stats: Dict[str, CoalescingStats] = {}
+
+    async def do(self, service: str, endpoint: str, payload: Dict, fn: Callable[[], Awaitable[Any]]) -> Any:
+        key = cache_key(service, endpoint, payload)
+        stats = self.stats.setdefault(f"{service}{endpoint}", CoalescingStats())
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done, key=key: self._finish(key, done))
+            stats.upstream_calls += 1
+        else:
+            stats.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved; waiters re-raise it themselves
+
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def metrics(self) -> Dict:
+        return {
+            "in_flight": self.in_flight(),
+            "upstream_calls": sum(stats.upstream_calls for stats in self.stats.values()),
+            "coalesced": sum(stats.coalesced for stats in self.stats.values()),
+            "endpoints": {name: stats.as_dict() for name, stats in self.stats.items()},
+        }
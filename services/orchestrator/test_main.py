@@ -1,9 +1,15 @@
 import pytest
+import json
 import asyncio
+import os
+import time
 from fastapi.testclient import TestClient
+
+os.environ.setdefault("JOB_DB_PATH", ":memory:")
+
 from main import app
 import httpx
-from unittest.mock import patch, AsyncMock
+from unittest.mock import patch, AsyncMock, MagicMock
 
 client = TestClient(app)
 
@@ -74,5 +80,749 @@ def test_plan_rwe_study_missing_fields():
     response = client.post("/plan_rwe_study", json={"protocol_text": "Test"})
     assert response.status_code == 422  # Validation error
 
+def test_service_clients_are_pooled():
+    """Clients are reused across requests and configured per service"""
+    from main import service_clients, MCP_SERVICES
+
+    async def fetch_twice():
+        return service_clients.get("protocol_scorer"), service_clients.get("protocol_scorer")
+
+    first, second = asyncio.run(fetch_twice())
+    assert first is second
+    assert str(first.base_url).rstrip("/") == MCP_SERVICES["protocol_scorer"]
+    assert set(service_clients.stats()) == set(MCP_SERVICES)
+
+def test_service_client_config_from_env(monkeypatch):
+    """Per-service settings can be overridden via environment variables"""
+    from clients import load_service_configs
+
+    monkeypatch.setenv("DIVERSITY_MAPPER_TIMEOUT", "2.5")
+    monkeypatch.setenv("DIVERSITY_MAPPER_MAX_CONNECTIONS", "4")
+    monkeypatch.setenv("DIVERSITY_MAPPER_HEDGE_DELAY", "0.5")
+    configs = load_service_configs({"diversity_mapper": "http://x", "soa_comparator": "http://y"})
+    assert configs["diversity_mapper"].timeout == 2.5
+    assert configs["diversity_mapper"].max_connections == 4
+    assert configs["diversity_mapper"].hedge_delay == 0.5
+    assert configs["soa_comparator"].timeout == 30.0
+    # Hedging is opt-in
+    assert configs["soa_comparator"].hedge_delay == 0
+
+STUDY_REQUEST = {
+    "protocol_text": "Test protocol",
+    "disease_area": "Diabetes",
+    "target_countries": ["USA", "UK"],
+    "target_enrollment": 100,
+    "inclusion_criteria": ["Age > 18"],
+    "exclusion_criteria": ["Pregnant"],
+    "study_duration_months": 12,
+    "primary_endpoints": ["HbA1c"],
+    "secondary_endpoints": ["Weight"]
+}
+
+MOCK_SERVICE_RESPONSES = {
+    "/score": {"overall_score": 5.5, "warnings": ["w"], "recommendations": ["r"]},
+    "/identify_sources": [{"source_id": "USA_EHR_1"}],
+    "/estimate_cohort_size": {"estimated_cohort_size": 1000},
+    "/data_quality_assessment_batch": [
+        {"source_id": "USA_EHR_1", "overall_quality_score": 92.1, "quality_metrics": {"completeness": 95.0}}
+    ],
+}
+
+async def fake_call_service(service, endpoint, payload):
+    await asyncio.sleep(0.01)
+    return MOCK_SERVICE_RESPONSES.get(endpoint, {"status": "success"})
+
+def test_execute_graph_runs_independent_steps_concurrently():
+    """Independent steps overlap; dependent steps see upstream results"""
+    from dag import Step, StepGraph, execute_graph
+
+    started = []
+
+    async def call(service, endpoint, payload):
+        started.append(endpoint)
+        await asyncio.sleep(0.05)
+        return {"endpoint": endpoint, "payload": payload}
+
+    graph = StepGraph([
+        Step("a", "svc", "/a", lambda deps: {}),
+        Step("b", "svc", "/b", lambda deps: {"from_a": deps["a"]["endpoint"]}, depends_on=["a"]),
+        *[Step(f"c{i}", "svc", f"/c{i}", lambda deps: {}) for i in range(20)],
+    ])
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        results = await execute_graph(graph, call)
+        return results, loop.time() - t0
+
+    results, elapsed = asyncio.run(run())
+    assert results["b"]["payload"] == {"from_a": "/a"}
+    assert started.index("/b") > started.index("/a")
+    assert elapsed < 0.5  # two round trips on the critical path, not 22
+
+def test_step_graph_rejects_cycles_and_unknown_dependencies():
+    from dag import Step, StepGraph
+
+    with pytest.raises(ValueError):
+        StepGraph([
+            Step("a", "svc", "/a", lambda deps: {}, depends_on=["b"]),
+            Step("b", "svc", "/b", lambda deps: {}, depends_on=["a"]),
+        ])
+    with pytest.raises(ValueError):
+        StepGraph([Step("a", "svc", "/a", lambda deps: {}, depends_on=["missing"])])
+
+def test_plan_graph_dependencies_are_minimal():
+    from main import build_plan_graph, RWEStudyRequest
+
+    single_country = RWEStudyRequest(**{**STUDY_REQUEST, "target_countries": ["USA"]})
+    graph = build_plan_graph(single_country)
+    dependent = {name: step.depends_on for name, step in graph.steps.items() if step.depends_on}
+    assert dependent == {"feasibility:USA": ["protocol"], "data_quality": ["data_sources"]}
+
+def test_plan_graph_uses_batch_endpoints_for_multiple_countries():
+    from main import build_plan_graph, RWEStudyRequest
+
+    graph = build_plan_graph(RWEStudyRequest(**STUDY_REQUEST))
+    assert graph.steps["feasibility"].endpoint == "/predict_feasibility_batch"
+    assert graph.steps["diversity"].endpoint == "/calculate_diversity_batch"
+    assert not any(":" in name for name in graph.steps)
+
+    payload = graph.steps["diversity"].payload({})
+    assert payload == {"countries": ["USA", "UK"]}
+
+def test_plan_rwe_study_with_step_graph():
+    with patch("main.call_service", fake_call_service):
+        response = client.post("/plan_rwe_study", json=STUDY_REQUEST)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["protocol_complexity_score"] == 5.5
+    assert data["estimated_total_cohort_size"] == 1000
+    assert len(data["recommended_sites"]) == 6
+    assert data["risk_factors"] == ["w"]
+    assert data["data_sources"][0]["quality_assessment"]["overall_quality_score"] == 92.1
+
+def test_parse_response_reads_ndjson():
+    from main import parse_response
+
+    response = httpx.Response(200, text='{"a": 1}\n{"a": 2}\n', headers={"content-type": "application/x-ndjson"})
+    assert parse_response(response) == [{"a": 1}, {"a": 2}]
+
+def test_service_limiter_caps_in_flight_requests():
+    """No more than the configured number of calls run at once per service"""
+    from limits import ServiceLimiter
+
+    limiter = ServiceLimiter({"diversity_mapper": 3})
+    peak = {"current": 0, "max": 0}
+
+    async def call():
+        async with limiter.acquire("diversity_mapper"):
+            peak["current"] += 1
+            peak["max"] = max(peak["max"], peak["current"])
+            await asyncio.sleep(0.01)
+            peak["current"] -= 1
+
+    async def run():
+        await asyncio.gather(*(call() for _ in range(20)))
+
+    asyncio.run(run())
+    metrics = limiter.metrics()["diversity_mapper"]
+    assert peak["max"] == 3
+    assert metrics["completed"] == 20
+    assert metrics["max_queued"] >= 17
+    assert metrics["in_flight"] == 0 and metrics["queued"] == 0
+
+def test_metrics_endpoint_reports_concurrency():
+    from main import MCP_SERVICES
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "diversity_mapper" in response.json()["concurrency"]
+    clients = response.json()["clients"]
+    assert set(clients) == set(MCP_SERVICES)
+    assert clients["diversity_mapper"]["url"] == MCP_SERVICES["diversity_mapper"]
+
+def test_response_cache_ttl_and_canonical_keys():
+    from cache import ResponseCache
+
+    cache = ResponseCache({("protocol_scorer", "/score"): 0.05})
+
+    async def run():
+        await cache.set("protocol_scorer", "/score", {"a": 1, "b": 2}, {"overall_score": 5.0})
+        fresh = await cache.get("protocol_scorer", "/score", {"b": 2, "a": 1})
+        await asyncio.sleep(0.06)
+        expired = await cache.get("protocol_scorer", "/score", {"a": 1, "b": 2})
+        return fresh, expired
+
+    fresh, expired = asyncio.run(run())
+    assert fresh == {"overall_score": 5.0}
+    assert expired is None
+    assert cache.metrics()["hits"] == 1
+    assert cache.metrics()["expirations"] == 1
+
+def test_memory_backend_lru_eviction_by_size():
+    from cache import MemoryCacheBackend
+
+    backend = MemoryCacheBackend(max_bytes=100)
+
+    async def run():
+        await backend.set("USA", b"x" * 40, 60)
+        await backend.set("UK", b"x" * 40, 60)
+        await backend.get("USA")  # USA is now most recent
+        await backend.set("Japan", b"x" * 40, 60)
+        return await backend.get("UK"), await backend.get("USA")
+
+    uk, usa = asyncio.run(run())
+    assert uk is None
+    assert usa == b"x" * 40
+    assert backend.metrics()["evictions"] == 1
+    assert backend.metrics()["bytes"] <= 100
+
+def test_redis_backend_shares_entries_between_caches():
+    """Two orchestrator replicas pointed at the same Redis see each other's entries"""
+    fakeredis = pytest.importorskip("fakeredis")
+    from cache import RedisCacheBackend, ResponseCache
+
+    endpoints = {("data_ingestor", "/identify_sources"): 60}
+    payload = {"disease_area": "Diabetes", "geography": ["USA"]}
+
+    async def run():
+        server = fakeredis.FakeServer()
+        replica_a = ResponseCache(endpoints, RedisCacheBackend(client=fakeredis.FakeAsyncRedis(server=server)))
+        replica_b = ResponseCache(endpoints, RedisCacheBackend(client=fakeredis.FakeAsyncRedis(server=server)))
+        await replica_a.set("data_ingestor", "/identify_sources", payload, [{"source_id": "USA_EHR_1"}])
+        shared = await replica_b.get("data_ingestor", "/identify_sources", payload)
+        await replica_b.clear()
+        cleared = await replica_a.get("data_ingestor", "/identify_sources", payload)
+        return shared, cleared
+
+    shared, cleared = asyncio.run(run())
+    assert shared == [{"source_id": "USA_EHR_1"}]
+    assert cleared is None
+
+def test_cache_backend_errors_are_treated_as_misses():
+    from cache import CacheBackend, ResponseCache
+
+    class BrokenBackend(CacheBackend):
+        async def get(self, key):
+            raise ConnectionError("redis down")
+
+        async def set(self, key, value, ttl):
+            raise ConnectionError("redis down")
+
+        async def clear(self):
+            raise ConnectionError("redis down")
+
+    class IncompleteBackend(CacheBackend):
+        async def get(self, key):
+            return None
+
+    # A backend missing part of the interface fails when created, not when first used
+    with pytest.raises(TypeError):
+        IncompleteBackend()
+
+    cache = ResponseCache({("protocol_scorer", "/score"): 60}, BrokenBackend())
+
+    async def run():
+        await cache.set("protocol_scorer", "/score", {}, {"overall_score": 1.0})
+        return await cache.get("protocol_scorer", "/score", {})
+
+    assert asyncio.run(run()) is None
+    assert cache.metrics()["backend_errors"] == 2
+
+def test_repeated_protocol_scoring_served_from_cache():
+    upstream = MagicMock()
+    upstream.status_code = 200
+    upstream.json.return_value = {"overall_score": 4.5}
+
+    with patch("httpx.AsyncClient.post", new=AsyncMock(return_value=upstream)) as mock_post:
+        for _ in range(3):
+            response = client.post("/quick_assessment", json={"protocol_text": "cached protocol"})
+            assert response.status_code == 200
+        assert mock_post.call_count == 1
+
+    cache_metrics = client.get("/metrics").json()["cache"]
+    assert cache_metrics["endpoints"]["protocol_scorer/score"]["hits"] >= 2
+
+def test_single_flight_coalesces_identical_calls():
+    from singleflight import SingleFlight
+
+    flight = SingleFlight()
+    calls = []
+
+    async def upstream():
+        calls.append(1)
+        await asyncio.sleep(0.02)
+        return {"sources": 3}
+
+    async def run():
+        same = [flight.do("data_ingestor", "/identify_sources", {"disease_area": "Diabetes"}, upstream) for _ in range(10)]
+        other = flight.do("data_ingestor", "/identify_sources", {"disease_area": "Asthma"}, upstream)
+        return await asyncio.gather(*same, other)
+
+    results = asyncio.run(run())
+    assert all(result == {"sources": 3} for result in results)
+    assert len(calls) == 2
+    metrics = flight.metrics()
+    assert metrics["coalesced"] == 9
+    assert metrics["upstream_calls"] == 2
+    assert metrics["in_flight"] == 0
+
+def test_single_flight_shares_errors_and_survives_cancelled_leader():
+    from singleflight import SingleFlight
+
+    flight = SingleFlight()
+
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise httpx.ConnectError("down")
+
+    async def slow():
+        await asyncio.sleep(0.02)
+        return "ok"
+
+    async def run():
+        errors = await asyncio.gather(
+            *(flight.do("protocol_scorer", "/score", {}, failing) for _ in range(3)),
+            return_exceptions=True
+        )
+        leader = asyncio.ensure_future(flight.do("protocol_scorer", "/score", {"x": 1}, slow))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("protocol_scorer", "/score", {"x": 1}, slow))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return errors, await follower
+
+    errors, follower_result = asyncio.run(run())
+    assert all(isinstance(error, httpx.ConnectError) for error in errors)
+    assert follower_result == "ok"
+
+def test_circuit_breaker_opens_and_recovers():
+    from resilience import CircuitBreaker, CircuitOpenError
+
+    breaker = CircuitBreaker("diversity_mapper", min_requests=4, error_threshold=0.5, open_seconds=0.05)
+    for success in (True, False, False, False):
+        breaker.before_call()
+        breaker.after_call(success)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    breaker.before_call()  # half-open probe
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # only one probe at a time
+    breaker.after_call(False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.after_call(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.metrics()["times_opened"] == 2
+
+def test_hedged_request_wins_over_slow_attempt():
+    from resilience import RequestHedger
+
+    hedger = RequestHedger({"diversity_mapper": 0.02})
+    delays = [0.5, 0.01]
+    cancelled = []
+
+    async def attempt():
+        delay = delays.pop(0)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(delay)
+            raise
+        return delay
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        result = await hedger.call("diversity_mapper", attempt)
+        await asyncio.sleep(0)
+        return result, loop.time() - t0
+
+    result, elapsed = asyncio.run(run())
+    assert result == 0.01
+    assert elapsed < 0.2
+    assert cancelled == [0.5]
+    assert hedger.metrics()["diversity_mapper"] == {"calls": 1, "hedges": 1, "hedge_wins": 1}
+
+def test_hedged_request_raises_when_all_attempts_fail():
+    from resilience import RequestHedger
+
+    hedger = RequestHedger({"diversity_mapper": 0.01})
+
+    async def attempt():
+        await asyncio.sleep(0.02)
+        raise httpx.ReadTimeout("slow")
+
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(hedger.call("diversity_mapper", attempt))
+
+def test_plan_returns_503_when_circuit_open():
+    from main import circuit_breakers
+    from resilience import CircuitBreaker
+
+    breaker = circuit_breakers["soa_comparator"]
+    breaker.state = CircuitBreaker.OPEN
+    breaker._opened_at = time.monotonic()
+    try:
+        upstream = MagicMock()
+        upstream.status_code = 200
+        upstream.json.return_value = {"overall_score": 5.0, "estimated_cohort_size": 10}
+        with patch("httpx.AsyncClient.post", new=AsyncMock(return_value=upstream)):
+            response = client.post("/plan_rwe_study", json=STUDY_REQUEST)
+        assert response.status_code == 503
+        assert "soa_comparator" in response.json()["detail"]
+    finally:
+        breaker.state = CircuitBreaker.CLOSED
+
+def test_execute_graph_partial_omits_failed_steps_and_dependents():
+    from dag import Step, StepGraph, execute_graph
+
+    async def call(service, endpoint, payload):
+        if endpoint == "/slow":
+            await asyncio.sleep(1)
+        if endpoint == "/broken":
+            raise httpx.ConnectError("down")
+        return endpoint
+
+    async def fallback(step, payload, error):
+        return "from cache" if step.name == "broken" else None
+
+    graph = StepGraph([
+        Step("fast", "svc", "/fast", lambda deps: {}),
+        Step("slow", "svc", "/slow", lambda deps: {}),
+        Step("after_slow", "svc", "/fast", lambda deps: {}, depends_on=["slow"]),
+        Step("broken", "svc", "/broken", lambda deps: {}),
+    ])
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        return await execute_graph(graph, call, deadline=loop.time() + 0.05, fallback=fallback)
+
+    results = asyncio.run(run())
+    assert results == {"fast": "/fast", "broken": "from cache"}
+
+def test_plan_with_deadline_degrades_slow_and_failed_sections():
+    import main
+
+    request = {**STUDY_REQUEST, "disease_area": "Degraded Asthma", "deadline_seconds": 0.3}
+    sources_payload = {
+        "disease_area": "Degraded Asthma",
+        "geography": request["target_countries"],
+        "minimum_patient_count": request["target_enrollment"]
+    }
+    asyncio.run(main.response_cache.set("data_ingestor", "/identify_sources", sources_payload, [{"source_id": "stale"}]))
+
+    async def flaky_call_service(service, endpoint, payload):
+        if endpoint == "/analyze_burden":
+            await asyncio.sleep(5)
+        if endpoint == "/identify_sources":
+            raise httpx.ConnectError("ingestor down")
+        return await fake_call_service(service, endpoint, payload)
+
+    with patch("main.call_service", flaky_call_service):
+        started = time.monotonic()
+        response = client.post("/plan_rwe_study", json=request)
+        elapsed = time.monotonic() - started
+
+    assert response.status_code == 200
+    assert elapsed < 2
+    data = response.json()
+    degraded = {section["section"]: section for section in data["degraded_sections"]}
+    assert degraded["soa"]["fallback"] == "omitted"
+    assert degraded["soa"]["reason"] == "deadline exceeded"
+    assert degraded["data_sources"]["fallback"] == "cache"
+    assert data["data_sources"] == [{"source_id": "stale"}]
+    assert data["protocol_complexity_score"] == 5.5
+
+def test_plan_with_deadline_requires_protocol_complexity():
+    async def no_protocol(service, endpoint, payload):
+        if endpoint == "/score":
+            raise httpx.ConnectError("scorer down")
+        return await fake_call_service(service, endpoint, payload)
+
+    request = {**STUDY_REQUEST, "protocol_text": "uncached protocol", "deadline_seconds": 0.5}
+    with patch("main.call_service", no_protocol):
+        response = client.post("/plan_rwe_study", json=request)
+    assert response.status_code == 504
+
+def upstream_transport(failing_endpoint, status_code=500):
+    """Pooled clients answering every MCP call from MOCK_SERVICE_RESPONSES, except one failing endpoint"""
+    def handler(request):
+        if request.url.path == failing_endpoint:
+            return httpx.Response(status_code, json={"detail": "cohort model unavailable"})
+        if request.url.path.endswith("_batch") and request.url.path != "/data_quality_assessment_batch":
+            countries = json.loads(request.content)["countries"]
+            return httpx.Response(200, json={"results": {c: {"score": 7.0} for c in countries}})
+        return httpx.Response(200, json=MOCK_SERVICE_RESPONSES.get(request.url.path, {"status": "success"}))
+
+    return lambda service_name: httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://mcp")
+
+def test_upstream_error_status_degrades_section_instead_of_failing_plan():
+    request = {**STUDY_REQUEST, "protocol_text": "upstream 500 protocol", "disease_area": "Upstream Error Gout"}
+    with patch("main.service_clients.get", upstream_transport("/estimate_cohort_size")):
+        response = client.post("/plan_rwe_study", json={**request, "deadline_seconds": 2})
+        assert response.status_code == 200
+        data = response.json()
+        degraded = {section["section"]: section for section in data["degraded_sections"]}
+        assert degraded["cohort"]["fallback"] == "omitted"
+        assert degraded["cohort"]["reason"].startswith("UpstreamError: data_ingestor/estimate_cohort_size returned 500")
+        assert data["estimated_total_cohort_size"] is None
+
+        # Without a deadline the plan fails as a bad gateway, not an orchestration error
+        response = client.post("/plan_rwe_study", json=request)
+        assert response.status_code == 502
+        assert "cohort model unavailable" in response.json()["detail"]
+
+        bulk = client.post("/plan_rwe_study_bulk", json={"requests": [request]}).json()
+        degraded = {section["section"]: section for section in bulk["plans"][0]["plan"]["degraded_sections"]}
+        assert degraded["cohort"]["fallback"] == "omitted"
+
+    with patch("main.service_clients.get", upstream_transport("/score", status_code=422)):
+        response = client.post("/quick_assessment", json={"protocol_text": "rejected upstream protocol"})
+    assert response.status_code == 400
+
+def test_quick_assessment_maps_unavailable_services_to_503():
+    from resilience import CircuitOpenError
+
+    for error in (CircuitOpenError("protocol_scorer", 5.0), httpx.ConnectError("connection refused")):
+        with patch("main.call_service", AsyncMock(side_effect=error)):
+            response = client.post("/quick_assessment", json={"protocol_text": "unreachable scorer"})
+        assert response.status_code == 503
+        assert response.json()["detail"].startswith("Service communication error")
+
+def parse_sse(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+def test_results_by_country_handles_batch_and_per_country_steps():
+    from main import results_by_country
+
+    batch = {"diversity": {"results": {"USA": {"score": 1}}}}
+    per_country = {"diversity:USA": {"data": {"score": 1}}, "feasibility:USA": {}}
+    assert results_by_country(batch, "diversity") == {"USA": {"score": 1}}
+    assert results_by_country(per_country, "diversity") == {"USA": {"score": 1}}
+
+def test_plan_stream_starts_planning_only_when_streamed():
+    import main
+
+    called = []
+
+    async def recording_call_service(service, endpoint, payload):
+        called.append(endpoint)
+        return await fake_call_service(service, endpoint, payload)
+
+    async def run():
+        # A client that disconnects before the first chunk never iterates the body
+        response = await main.plan_rwe_study_stream(main.RWEStudyRequest(**STUDY_REQUEST))
+        await asyncio.sleep(0.05)
+        return response
+
+    with patch("main.call_service", recording_call_service):
+        asyncio.run(run())
+    assert called == []
+
+def test_plan_stream_emits_sections_as_they_complete():
+    async def batch_call_service(service, endpoint, payload):
+        if endpoint in ("/predict_feasibility_batch", "/calculate_diversity_batch"):
+            return {"results": {country: {} for country in payload["countries"]}}
+        return await fake_call_service(service, endpoint, payload)
+
+    with patch("main.call_service", batch_call_service):
+        response = client.post("/plan_rwe_study/stream", json=STUDY_REQUEST)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+
+    events = parse_sse(response.text)
+    names = [name for name, _ in events]
+    assert {"protocol_complexity", "data_sources", "cohort_estimate", "soa_burden"} <= set(names)
+    assert names[-1] == "plan"
+    sites = [data for name, data in events if name == "site_recommendations"]
+    assert sorted(data["country"] for data in sites) == ["UK", "USA"]
+    assert all(len(data["sites"]) == 3 for data in sites)
+    assert events[-1][1]["protocol_complexity_score"] == 5.5
+
+def test_plan_stream_reports_errors_as_events():
+    async def failing_call_service(service, endpoint, payload):
+        raise httpx.ConnectError("upstream down")
+
+    with patch("main.call_service", failing_call_service):
+        response = client.post("/plan_rwe_study/stream", json=STUDY_REQUEST)
+    assert response.status_code == 200
+    events = parse_sse(response.text)
+    assert events[-1] == ("error", {"status_code": 503, "detail": "Service communication error: upstream down"})
+
+def test_job_queue_bounds_concurrency_and_records_outcomes(tmp_path):
+    from jobs import JobQueue, JobStore
+
+    active = []
+    peak = []
+
+    async def runner(request):
+        active.append(request["n"])
+        peak.append(len(active))
+        await asyncio.sleep(0.02)
+        active.remove(request["n"])
+        if request["n"] == 3:
+            raise ValueError("bad request")
+        return {"n": request["n"]}
+
+    queue = JobQueue(JobStore(str(tmp_path / "jobs.db")), runner, lambda e: (500, str(e)), workers=2)
+
+    async def run():
+        await queue.start()
+        job_ids = queue.submit([{"n": n} for n in range(6)])
+        while queue.store.counts().get("queued") or queue.store.counts().get("running"):
+            await asyncio.sleep(0.01)
+        await queue.stop()
+        return job_ids
+
+    job_ids = asyncio.run(run())
+    assert max(peak) == 2
+    assert queue.store.counts() == {"succeeded": 5, "failed": 1}
+    assert queue.store.get(job_ids[0])["result"] == {"n": 0}
+    failed = queue.store.get(job_ids[3])
+    assert (failed["error_status"], failed["error"]) == (500, "bad request")
+
+def test_job_queue_persists_queued_jobs_and_cancels(tmp_path):
+    from jobs import JobQueue, JobStore
+
+    path = str(tmp_path / "jobs.db")
+
+    async def runner(request):
+        await asyncio.sleep(request.get("sleep", 0))
+        return request
+
+    first = JobQueue(JobStore(path), runner, lambda e: (500, str(e)))
+    kept, dropped = first.submit([{"id": 1}, {"id": 2}])
+    assert first.cancel(dropped)
+    first.store.close()
+
+    # A new process picks up what was still queued
+    second = JobQueue(JobStore(path), runner, lambda e: (500, str(e)), workers=1)
+
+    async def run():
+        await second.start()
+        slow = second.submit([{"sleep": 10}])[0]
+        while second.store.get(kept)["status"] != "succeeded" or second.store.get(slow)["status"] != "running":
+            await asyncio.sleep(0.01)
+        assert second.cancel(slow)
+        while second.store.get(slow)["status"] == "running":
+            await asyncio.sleep(0.01)
+        await second.stop()
+        return slow
+
+    slow = asyncio.run(run())
+    assert second.store.get(dropped)["status"] == "cancelled"
+    assert second.store.get(slow)["status"] == "cancelled"
+
+def test_jobs_api_submit_poll_and_fetch_result():
+    with patch("main.call_service", fake_call_service), TestClient(app) as jobs_client:
+        response = jobs_client.post("/jobs", json={"requests": [STUDY_REQUEST, STUDY_REQUEST]})
+        assert response.status_code == 202
+        job_ids = response.json()["job_ids"]
+        assert len(job_ids) == 2
+
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            statuses = [jobs_client.get(f"/jobs/{job_id}").json()["status"] for job_id in job_ids]
+            if all(status == "succeeded" for status in statuses):
+                break
+            time.sleep(0.02)
+        assert statuses == ["succeeded", "succeeded"]
+
+        result = jobs_client.get(f"/jobs/{job_ids[0]}/result")
+        assert result.status_code == 200
+        assert result.json()["protocol_complexity_score"] == 5.5
+        assert jobs_client.delete(f"/jobs/{job_ids[0]}").status_code == 409
+        assert jobs_client.get("/jobs/unknown").status_code == 404
+        batch = jobs_client.get("/jobs", params={"batch_id": response.json()["batch_id"]}).json()
+        assert [job["id"] for job in batch["jobs"]] == job_ids
+
+def test_bulk_plan_graph_shares_calls_across_requests():
+    from main import RWEStudyRequest, build_bulk_plan_graph
+
+    requests = [
+        RWEStudyRequest(**{**STUDY_REQUEST, "target_enrollment": enrollment, "target_countries": countries})
+        for enrollment, countries in [(100, ["USA", "UK"]), (50, ["USA"]), (100, ["UK", "Japan"])]
+    ]
+    graph, sections = build_bulk_plan_graph(requests)
+    endpoints = [step.endpoint for step in graph.steps.values()]
+    assert endpoints.count("/score") == 1
+    assert endpoints.count("/calculate_diversity_batch") == 1
+    assert endpoints.count("/identify_sources") == 3  # one per distinct disease/country
+    assert endpoints.count("/predict_feasibility_batch") == 2  # one per enrollment target
+    usa_sources = graph.steps[sections[1]["data_sources"][0]]
+    assert usa_sources.payload({}) == {"disease_area": "Diabetes", "geography": ["USA"], "minimum_patient_count": 50}
+
+def test_bulk_plan_graph_shares_cohorts_with_equivalent_criteria():
+    from main import RWEStudyRequest, build_bulk_plan_graph
+
+    requests = [
+        RWEStudyRequest(**{**STUDY_REQUEST, "inclusion_criteria": inclusion, "exclusion_criteria": exclusion})
+        for inclusion, exclusion in [
+            (["Age > 18", "Type 2 diabetes"], ["Pregnant"]),
+            (["T2DM", "age >= 19"], ["pregnancy"]),
+            (["Age > 18"], ["Pregnant"]),
+        ]
+    ]
+    graph, sections = build_bulk_plan_graph(requests)
+    assert sections[0]["cohort"] == sections[1]["cohort"] != sections[2]["cohort"]
+    payload = graph.steps[sections[0]["cohort"][0]].payload({})
+    assert payload["criteria_plan"]["inclusion"] == [
+        {"type": "condition", "codes": ["E11"]}, {"type": "age", "min": 19}
+    ]
+
+def test_plan_rwe_study_bulk_fans_out_shared_results():
+    calls = []
+
+    async def bulk_call_service(service, endpoint, payload):
+        calls.append(endpoint)
+        if endpoint == "/identify_sources":
+            country = payload["geography"][0]
+            return [
+                {"source_id": f"{country}_big", "patient_count": 5000, "quality_score": 8.0},
+                {"source_id": f"{country}_small", "patient_count": 60, "quality_score": 9.0},
+            ]
+        if endpoint in ("/predict_feasibility_batch", "/calculate_diversity_batch"):
+            return {"results": {country: {"country": country} for country in payload["countries"]}}
+        return await fake_call_service(service, endpoint, payload)
+
+    requests = [{**STUDY_REQUEST, "target_enrollment": 50}] + [STUDY_REQUEST] * 9
+    with patch("main.call_service", bulk_call_service):
+        response = client.post("/plan_rwe_study_bulk", json={"requests": requests})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["upstream_calls"] == len(calls) == 9
+    assert data["upstream_calls_without_sharing"] == 70
+    assert calls.count("/data_quality_assessment_batch") == 1
+    assert len(data["plans"]) == 10
+    first, second = data["plans"][0]["plan"], data["plans"][1]["plan"]
+    assert [s["source_id"] for s in first["data_sources"]] == ["USA_big", "UK_big", "USA_small", "UK_small"]
+    assert [s["source_id"] for s in second["data_sources"]] == ["USA_big", "UK_big"]
+    assert first["study_id"] != second["study_id"]
+
+def test_plan_rwe_study_bulk_isolates_failed_protocols():
+    async def failing_protocol(service, endpoint, payload):
+        if endpoint == "/score" and payload["protocol_text"] == "broken":
+            raise httpx.ConnectError("scorer down")
+        return await fake_call_service(service, endpoint, payload)
+
+    requests = [STUDY_REQUEST, {**STUDY_REQUEST, "protocol_text": "broken"}]
+    with patch("main.call_service", failing_protocol):
+        response = client.post("/plan_rwe_study_bulk", json={"requests": requests})
+    plans = response.json()["plans"]
+    assert plans[0]["plan"]["protocol_complexity_score"] == 5.5
+    assert plans[1]["plan"] is None
+    assert "scorer down" in plans[1]["error"]
+
 if __name__ == "__main__":
     pytest.main([__file__])
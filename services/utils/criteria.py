@@ -0,0 +1,512 @@
+import hashlib
+import json
+import re
+from datetime import date
+from typing import Dict, List, Optional, Sequence, Tuple
+
+PLAN_VERSION = 1
+
+# OMOP CDM gender concepts
+GENDER_CONCEPTS = {"male": 8507, "female": 8532}
+
+# OMOP event table and source-code column behind each code criterion
+EVENT_TABLES = {
+    "condition": ("condition_occurrence", "condition_source_value"),
+    "drug": ("drug_exposure", "drug_source_value"),
+    "procedure": ("procedure_occurrence", "procedure_source_value"),
+}
+
+# Claim line column each code criterion filters; other criteria have no claims equivalent
+CLAIMS_FIELDS = {"condition": "diagnosis_code", "procedure": "procedure_code"}
+
+LEAF_TYPES = ("age", "gender", "condition", "drug", "procedure", "measurement", "text")
+GROUP_TYPES = ("all", "any")
+
+# Free-text vocabulary, most specific terms first: text matched by one entry is
+# not matched again by a later, more general one
+CONCEPTS = [
+    (r"type\s*(?:2|ii)\s*diabetes|t2dm|diabetes mellitus,? type\s*(?:2|ii)", "condition", ["E11"]),
+    (r"type\s*(?:1|i)\s*diabetes|t1dm|diabetes mellitus,? type\s*(?:1|i)", "condition", ["E10"]),
+    (r"diabet(?:es|ic)", "condition", ["E10", "E11"]),
+    (r"hypertension|high blood pressure", "condition", ["I10"]),
+    (r"heart failure|chf", "condition", ["I50"]),
+    (r"(?:chronic kidney disease|ckd)\s*(?:stage\s*)?(?:3|iii)", "condition", ["N183"]),
+    (r"(?:chronic kidney disease|ckd)\s*(?:stage\s*)?(?:4|iv)", "condition", ["N184"]),
+    (r"chronic kidney disease|ckd", "condition", ["N18"]),
+    (r"cardiovascular event|myocardial infarction|heart attack|stroke|mace", "condition", ["I21", "I22", "I63"]),
+    (r"copd|chronic obstructive", "condition", ["J44"]),
+    (r"asthma", "condition", ["J45"]),
+    (r"breast cancer", "condition", ["C50"]),
+    (r"cancer|malignan\w*", "condition", ["C"]),
+    (r"depressi\w*", "condition", ["F32", "F33"]),
+    (r"hyperlipid\w*|dyslipid\w*|hypercholesterol\w*", "condition", ["E78"]),
+    (r"low back pain", "condition", ["M545"]),
+    (r"alzheimer'?s?", "condition", ["G30"]),
+    (r"pregnan\w*", "condition", ["O", "Z33"]),
+    (r"lactati\w*|breast\s*feeding", "condition", ["Z391"]),
+    (r"metformin", "drug", ["6809"]),
+    (r"insulin", "drug", ["5856", "274783"]),
+    (r"sglt-?2 inhibitors?|empagliflozin", "drug", ["1545653"]),
+    (r"lisinopril", "drug", ["29046"]),
+    (r"statins?|atorvastatin", "drug", ["83367"]),
+    (r"sertraline", "drug", ["36437"]),
+    (r"dialysis", "procedure", ["90935", "90937"]),
+    (r"colonoscopy", "procedure", ["45378"]),
+    (r"electrocardiogram|ecg|ekg", "procedure", ["93000"]),
+    (r"chest x-?ray", "procedure", ["71046"]),
+]
+
+# Lab terms -> LOINC code
+LABS = [
+    (r"hba1c|a1c|glycated ha?emoglobin", "4548-4"),
+    (r"egfr", "33914-3"),
+    (r"creatinine", "2160-0"),
+    (r"systolic blood pressure|sbp", "8480-6"),
+    (r"bmi|body mass index", "39156-5"),
+]
+
+NUMBER = r"\d+(?:\.\d+)?"
+UNIT = r"(?:\s*(?:%|mg/dl|mmol/mol|mmol/l|ml/min(?:/1\.73\s*m2?)?|kg/m2?|mmhg|years?|yrs?))?"
+OPERATORS = {
+    ">=": ">=", "at least": ">=", "<=": "<=", "at most": "<=", "up to": "<=", "=": "=",
+    ">": ">", "over": ">", "above": ">", "more than": ">", "greater than": ">", "older than": ">",
+    "<": "<", "under": "<", "below": "<", "less than": "<", "younger than": "<",
+}
+OPERATOR = "|".join(sorted(map(re.escape, OPERATORS), key=len, reverse=True))
+# "7.0-10.0%", "between 25 and 40", ">= 7", "less than 45"
+BOUND = (
+    rf"(?:\s*(?:levels?|values?|results?|of|is))*\s*(?:"
+    rf"(?:between\s*)?(?P<low>{NUMBER}){UNIT}\s*(?:-|to|and)\s*(?P<high>{NUMBER})"
+    rf"|(?P<op>{OPERATOR})\s*(?P<value>{NUMBER})"
+    rf"|(?P<plus>{NUMBER}){UNIT}\s*\+)"
+)
+AGE_PATTERNS = [
+    re.compile(rf"\bage[sd]?\b{BOUND}"),
+    re.compile(rf"\b(?P<low>\d{{1,3}})\s*(?:-|to)\s*(?P<high>\d{{1,3}})\s*(?:years?|yrs?|y/?o)\b"),
+    # "18 or older" only counts as an age next to "age(d)" or "years"
+    re.compile(rf"\bage[sd]?\s*(?P<value>\d{{1,3}})\s*(?:years?|yrs?)?\s*(?P<op>\+|or older|and older|or over|or above)"),
+    re.compile(rf"\b(?P<value>\d{{1,3}})\s*(?:years?|yrs?)(?:\s*of\s*age|\s*old)?\s*(?P<op>\+|or older|and older|or over|or above)"),
+    re.compile(rf"\b(?P<value>\d{{1,3}})\s*(?P<op>\+)\s*(?:years?|yrs?)\b"),
+    re.compile(rf"\b(?P<op>{OPERATOR})\s*(?P<value>\d{{1,3}})\s*(?:years?|yrs?)\b"),
+]
+AGE_GROUPS = [(r"adults?", {"min": 18}), (r"elderly", {"min": 65}), (r"children|p(?:a)?ediatric", {"max": 17})]
+GENDERS = [(r"females?|wom[ae]n", "female"), (r"males?|m[ae]n", "male")]
+NEGATION = re.compile(r"^(?:no|not|without|absence of|never)\b(?:\s*(?:history of|prior|previous))?\s*")
+DISJUNCTION = re.compile(r"\bor\b(?!\s*(?:older|over|above|more|greater|less|younger))")
+CONJUNCTION = re.compile(r"\b(?:and|with|plus)\b")
+
+
+class CriteriaError(ValueError):
+    """Raised for criteria that cannot be compiled"""
+
+
+def normalize_code(code: str) -> str:
+    return str(code).strip().upper().replace(".", "")
+
+
+def normalize_text(text: str) -> str:
+    text = str(text).lower()
+    for old, new in (("≥", ">="), ("≤", "<="), ("–", "-"), ("—", "-"), ("²", "2"), ("≧", ">="), ("≦", "<=")):
+        text = text.replace(old, new)
+    return " ".join(text.split())
+
+
+def canonical_json(value) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+
+def predicate_hash(predicate: Dict) -> str:
+    """Stable digest of one normalized predicate"""
+    return hashlib.sha256(canonical_json(predicate).encode()).hexdigest()[:16]
+
+
+def _bounds(match: re.Match, integer: bool) -> Dict:
+    """min/max of a matched BOUND; strict integer bounds become inclusive ones"""
+    groups = match.groupdict()
+    if groups.get("plus") is not None:
+        bounds = {"min": float(groups["plus"])}
+    elif groups.get("low") is not None:
+        low, high = float(groups["low"]), float(groups["high"])
+        bounds = {"min": min(low, high), "max": max(low, high)}
+    else:
+        op = OPERATORS.get(groups["op"], ">=")
+        value = float(groups["value"])
+        if op == "=":
+            bounds = {"min": value, "max": value}
+        elif op.startswith(">"):
+            bounds = {"min": value, "min_exclusive": op == ">"}
+        else:
+            bounds = {"max": value, "max_exclusive": op == "<"}
+    if integer:
+        if bounds.pop("min_exclusive", False):
+            bounds["min"] += 1
+        if bounds.pop("max_exclusive", False):
+            bounds["max"] -= 1
+        bounds = {key: int(value) for key, value in bounds.items()}
+    return {key: value for key, value in bounds.items() if value is not False}
+
+
+def _search(text: str, pattern, taken: List[Tuple[int, int]]) -> List[re.Match]:
+    """Matches of `pattern` not overlapping text already taken; marks them taken"""
+    if isinstance(pattern, str):
+        pattern = re.compile(rf"\b(?:{pattern})\b")
+    found = []
+    for match in pattern.finditer(text):
+        start, end = match.span()
+        if any(start < t_end and t_start < end for t_start, t_end in taken):
+            continue
+        taken.append((start, end))
+        found.append(match)
+    return found
+
+
+def parse_criterion(text: str) -> Tuple[Dict, bool]:
+    """Predicate for one free-text criterion and whether the text negates it.
+
+    Recognizes ages, genders, lab thresholds and the conditions, drugs and
+    procedures in CONCEPTS. Several concepts in one criterion are combined with
+    "any" when joined by "or", otherwise "all"; both genders in one criterion
+    ("men and women") match either gender. Text with no recognized concept
+    becomes an opaque "text" predicate: it still counts towards the plan and its
+    hash, but no backend can evaluate it.
+    """
+    normalized = normalize_text(text)
+    if not normalized:
+        raise CriteriaError("Criteria must not be empty")
+    negation = NEGATION.match(normalized)
+    body = normalized[negation.end():] if negation else normalized
+    taken: List[Tuple[int, int]] = []
+    found: List[Tuple[int, Dict]] = []
+
+    for pattern, code in LABS:
+        for match in _search(body, re.compile(rf"\b(?:{pattern})\b(?:{BOUND})?"), taken):
+            predicate = {"type": "measurement", "code": code}
+            if any(match.group(bound) is not None for bound in ("low", "op", "plus")):
+                predicate.update(_bounds(match, integer=False))
+            found.append((match.start(), predicate))
+    for pattern in AGE_PATTERNS:
+        for match in _search(body, pattern, taken):
+            if match.groupdict().get("op") in ("+", "or older", "and older", "or over", "or above"):
+                found.append((match.start(), {"type": "age", "min": int(match.group("value"))}))
+            else:
+                found.append((match.start(), {"type": "age", **_bounds(match, integer=True)}))
+    for pattern, bounds in AGE_GROUPS:
+        found.extend((m.start(), {"type": "age", **bounds}) for m in _search(body, pattern, taken))
+    genders = []
+    for pattern, value in GENDERS:
+        genders.extend((m, {"type": "gender", "value": value}) for m in _search(body, pattern, taken))
+    join_text = body
+    if len({predicate["value"] for _, predicate in genders}) > 1:
+        # "Men and women": either gender, whatever joins the rest of the criterion
+        start = min(m.start() for m, _ in genders)
+        end = max(m.end() for m, _ in genders)
+        found.append((start, {"type": "any", "predicates": [predicate for _, predicate in genders]}))
+        join_text = body[:start] + body[end:]
+    else:
+        found.extend((m.start(), predicate) for m, predicate in genders)
+    for pattern, kind, codes in CONCEPTS:
+        found.extend((m.start(), {"type": kind, "codes": codes}) for m in _search(body, pattern, taken))
+
+    if not found:
+        return {"type": "text", "text": body}, bool(negation)
+    predicates = [predicate for _, predicate in sorted(found, key=lambda item: item[0])]
+    join = "any" if DISJUNCTION.search(join_text) and not CONJUNCTION.search(join_text) else "all"
+    return normalize_predicate({"type": join, "predicates": predicates}), bool(negation)
+
+
+def _normalize_leaf(predicate: Dict) -> Dict:
+    kind = predicate["type"]
+    if kind == "age":
+        bounds = {key: int(predicate[key]) for key in ("min", "max") if predicate.get(key) is not None}
+        if not bounds:
+            raise CriteriaError("age criteria need min and/or max")
+        return {"type": "age", **bounds}
+    if kind == "gender":
+        value = str(predicate.get("value", "")).lower()
+        if value not in GENDER_CONCEPTS:
+            raise CriteriaError(f"gender must be one of {list(GENDER_CONCEPTS)}")
+        return {"type": "gender", "value": value}
+    if kind in EVENT_TABLES:
+        codes = sorted({normalize_code(code) for code in predicate.get("codes") or []})
+        if not codes or not all(codes):
+            raise CriteriaError(f"{kind} criteria need a non-empty list of codes")
+        # A prefix already covers every longer code it starts
+        codes = [c for c in codes if not any(c != p and c.startswith(p) for p in codes)]
+        return {"type": kind, "codes": codes}
+    if kind == "measurement":
+        code = str(predicate.get("code") or "").strip()
+        if not code:
+            raise CriteriaError("measurement criteria need a code")
+        result = {"type": "measurement", "code": code}
+        for key in ("min", "max"):
+            if predicate.get(key) is not None:
+                result[key] = float(predicate[key])
+                if predicate.get(f"{key}_exclusive"):
+                    result[f"{key}_exclusive"] = True
+        return result
+    text = normalize_text(predicate.get("text", ""))
+    if not text:
+        raise CriteriaError("text criteria need text")
+    return {"type": "text", "text": text}
+
+
+def _intersect(first: Dict, second: Dict) -> Dict:
+    """Range predicate (age or one measurement code) matching both ranges"""
+    merged = dict(first)
+    for key, tighter in (("min", max), ("max", min)):
+        if key not in second:
+            continue
+        if key not in merged:
+            merged[key] = second[key]
+            if second.get(f"{key}_exclusive"):
+                merged[f"{key}_exclusive"] = True
+            continue
+        value = tighter(merged[key], second[key])
+        exclusive = any(p.get(f"{key}_exclusive") for p in (first, second) if key in p and p[key] == value)
+        merged[key] = value
+        merged.pop(f"{key}_exclusive", None)
+        if exclusive:
+            merged[f"{key}_exclusive"] = True
+    return merged
+
+
+def _merge(kind: str, predicates: List[Dict]) -> List[Dict]:
+    """Fold mergeable siblings: code unions under "any", range intersections under "all" """
+    merged: List[Dict] = []
+    by_key: Dict[Tuple, int] = {}
+    for predicate in predicates:
+        if kind == "any" and predicate["type"] in EVENT_TABLES:
+            key = (predicate["type"],)
+        elif kind == "all" and predicate["type"] in ("age", "measurement"):
+            key = (predicate["type"], predicate.get("code"))
+        else:
+            merged.append(predicate)
+            continue
+        if key not in by_key:
+            by_key[key] = len(merged)
+            merged.append(predicate)
+        elif kind == "any":
+            existing = merged[by_key[key]]
+            merged[by_key[key]] = _normalize_leaf({**existing, "codes": existing["codes"] + predicate["codes"]})
+        else:
+            merged[by_key[key]] = _intersect(merged[by_key[key]], predicate)
+    return merged
+
+
+def normalize_predicate(predicate: Dict) -> Dict:
+    """Canonical form of a predicate tree.
+
+    Leaves get canonical field values; nested groups of the same kind are
+    flattened, mergeable siblings folded, duplicates dropped and children
+    sorted, so criteria that mean the same thing normalize (and hash) the same.
+    """
+    if not isinstance(predicate, dict):
+        raise CriteriaError("Each criterion must be an object")
+    kind = predicate.get("type")
+    if kind in LEAF_TYPES:
+        return _normalize_leaf(predicate)
+    if kind not in GROUP_TYPES:
+        raise CriteriaError(f"Unknown criterion type {kind!r}")
+    children = predicate.get("predicates")
+    if not isinstance(children, list) or not children:
+        raise CriteriaError(f"{kind} criteria need a non-empty list of predicates")
+    flat: List[Dict] = []
+    for child in map(normalize_predicate, children):
+        flat.extend(child["predicates"] if child["type"] == kind else [child])
+    unique = {canonical_json(child): child for child in _merge(kind, flat)}
+    ordered = [unique[key] for key in sorted(unique)]
+    return ordered[0] if len(ordered) == 1 else {"type": kind, "predicates": ordered}
+
+
+def has_text(predicate: Dict) -> bool:
+    if predicate["type"] in GROUP_TYPES:
+        return any(has_text(child) for child in predicate["predicates"])
+    return predicate["type"] == "text"
+
+
+def prefix_range(prefix: str) -> Tuple[str, str]:
+    """Half-open range of strings starting with `prefix`, usable by an index range scan"""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def compile_predicate(predicate: Dict, reference_year: int) -> Tuple[str, List]:
+    """SQL condition on the OMOP person alias `p` for one criterion"""
+    if not isinstance(predicate, dict):
+        raise CriteriaError("Each criterion must be an object")
+    kind = predicate.get("type")
+    if kind in GROUP_TYPES:
+        children = predicate.get("predicates")
+        if not isinstance(children, list) or not children:
+            raise CriteriaError(f"{kind} criteria need a non-empty list of predicates")
+        clauses, params = [], []
+        for child in children:
+            sql, child_params = compile_predicate(child, reference_year)
+            clauses.append(f"({sql})")
+            params.extend(child_params)
+        return (" AND " if kind == "all" else " OR ").join(clauses), params
+    if kind == "age":
+        low, high = predicate.get("min"), predicate.get("max")
+        if low is None and high is None:
+            raise CriteriaError("age criteria need min and/or max")
+        clauses, params = [], []
+        if high is not None:
+            clauses.append("p.year_of_birth >= ?")
+            params.append(reference_year - int(high))
+        if low is not None:
+            clauses.append("p.year_of_birth <= ?")
+            params.append(reference_year - int(low))
+        return " AND ".join(clauses), params
+    if kind == "gender":
+        value = str(predicate.get("value", "")).lower()
+        if value not in GENDER_CONCEPTS:
+            raise CriteriaError(f"gender must be one of {list(GENDER_CONCEPTS)}")
+        return "p.gender_concept_id = ?", [GENDER_CONCEPTS[value]]
+    if kind in EVENT_TABLES:
+        table, column = EVENT_TABLES[kind]
+        codes = [normalize_code(code) for code in predicate.get("codes") or []]
+        if not codes or not all(codes):
+            raise CriteriaError(f"{kind} criteria need a non-empty list of codes")
+        ranges, params = [], []
+        for code in codes:
+            ranges.append(f"({column} >= ? AND {column} < ?)")
+            params.extend(prefix_range(code))
+        return f"p.person_id IN (SELECT person_id FROM {table} WHERE {' OR '.join(ranges)})", params
+    if kind == "measurement":
+        code = predicate.get("code")
+        if not code:
+            raise CriteriaError("measurement criteria need a code")
+        clauses, params = ["measurement_source_value = ?"], [str(code).strip()]
+        if predicate.get("min") is not None:
+            clauses.append("value_as_number > ?" if predicate.get("min_exclusive") else "value_as_number >= ?")
+            params.append(float(predicate["min"]))
+        if predicate.get("max") is not None:
+            clauses.append("value_as_number < ?" if predicate.get("max_exclusive") else "value_as_number <= ?")
+            params.append(float(predicate["max"]))
+        return f"p.person_id IN (SELECT person_id FROM measurement WHERE {' AND '.join(clauses)})", params
+    if kind == "text":
+        raise CriteriaError(f"Free-text criterion {predicate.get('text')!r} cannot be compiled to SQL")
+    raise CriteriaError(f"Unknown criterion type {kind!r}")
+
+
+def compile_criteria(criteria: Dict, reference_year: Optional[int] = None) -> Tuple[str, List]:
+    """WHERE clause over `person p` selecting the patients who meet every
+    inclusion criterion and no exclusion criterion.
+
+    Each criterion becomes an index range scan (event tables) or a column test
+    on person, so SQLite evaluates the whole cohort without reading any row
+    it does not need.
+    """
+    reference_year = reference_year or date.today().year
+    clauses, params = [], []
+    for predicate in criteria.get("inclusion") or []:
+        sql, predicate_params = compile_predicate(predicate, reference_year)
+        clauses.append(f"({sql})")
+        params.extend(predicate_params)
+    for predicate in criteria.get("exclusion") or []:
+        sql, predicate_params = compile_predicate(predicate, reference_year)
+        clauses.append(f"NOT ({sql})")
+        params.extend(predicate_params)
+    return (" AND ".join(clauses) or "1"), params
+
+
+def claims_filter(predicate: Dict) -> Optional[Dict]:
+    """Code-prefix filter over claim line columns, or None if claims cannot express the predicate"""
+    kind = predicate["type"]
+    if kind in CLAIMS_FIELDS:
+        return {"field": CLAIMS_FIELDS[kind], "prefixes": predicate["codes"]}
+    if kind in GROUP_TYPES:
+        children = [claims_filter(child) for child in predicate["predicates"]]
+        if any(child is None for child in children):
+            return None
+        return {kind: children}
+    return None
+
+
+class CriteriaPlan:
+    """Normalized inclusion/exclusion predicates, hashed once and reused by every backend.
+
+    Compile free text with `from_text`, send `to_dict()` to other services and
+    rebuild it there with `from_dict`, which re-normalizes and checks the hash.
+    `hash` identifies the cohort definition for result caching.
+    """
+
+    def __init__(self, inclusion: Sequence[Dict], exclusion: Sequence[Dict]):
+        if not isinstance(inclusion, (list, tuple)) or not isinstance(exclusion, (list, tuple)):
+            raise CriteriaError("inclusion and exclusion must be lists of criteria")
+        # Inclusion criteria are one conjunction, so they are normalized (and merged) together
+        if inclusion:
+            combined = normalize_predicate({"type": "all", "predicates": list(inclusion)})
+            self.inclusion = combined["predicates"] if combined["type"] == "all" else [combined]
+        else:
+            self.inclusion = []
+        unique = {canonical_json(p): p for p in map(normalize_predicate, exclusion)}
+        self.exclusion = [unique[key] for key in sorted(unique)]
+        body = {"version": PLAN_VERSION, "inclusion": self.inclusion, "exclusion": self.exclusion}
+        self.hash = hashlib.sha256(canonical_json(body).encode()).hexdigest()[:16]
+
+    @classmethod
+    def from_text(cls, inclusion_criteria: Sequence[str], exclusion_criteria: Sequence[str] = ()) -> "CriteriaPlan":
+        """Plan for free-text criteria; negated text ("No prior insulin") moves to the other list
+        and blank entries are skipped"""
+        if not isinstance(inclusion_criteria, (list, tuple)) or not isinstance(exclusion_criteria, (list, tuple)):
+            raise CriteriaError("inclusion_criteria and exclusion_criteria must be lists of strings")
+        inclusion, exclusion = [], []
+        for texts, target, opposite in ((inclusion_criteria, inclusion, exclusion),
+                                        (exclusion_criteria, exclusion, inclusion)):
+            for text in texts:
+                if not normalize_text(text):
+                    continue
+                predicate, negated = parse_criterion(text)
+                (opposite if negated else target).append(predicate)
+        return cls(inclusion, exclusion)
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "CriteriaPlan":
+        if not isinstance(data, dict):
+            raise CriteriaError("criteria_plan must be an object")
+        if data.get("version", PLAN_VERSION) != PLAN_VERSION:
+            raise CriteriaError(f"Unsupported criteria plan version {data.get('version')}")
+        plan = cls(data.get("inclusion") or [], data.get("exclusion") or [])
+        if data.get("hash") not in (None, plan.hash):
+            raise CriteriaError("criteria_plan hash does not match its predicates")
+        return plan
+
+    def to_dict(self) -> Dict:
+        return {"version": PLAN_VERSION, "hash": self.hash, "inclusion": self.inclusion, "exclusion": self.exclusion}
+
+    def __len__(self) -> int:
+        return len(self.inclusion) + len(self.exclusion)
+
+    def ehr_criteria(self) -> Tuple[Dict, List[Dict]]:
+        """Structured criteria for the EHR SQL compiler, and the predicates it cannot apply.
+
+        A top-level predicate holding any free text is left out whole rather
+        than partially applied.
+        """
+        criteria = {"inclusion": [], "exclusion": []}
+        not_applied = []
+        for side in ("inclusion", "exclusion"):
+            for predicate in getattr(self, side):
+                if has_text(predicate):
+                    not_applied.append(predicate)
+                else:
+                    criteria[side].append(predicate)
+        return criteria, not_applied
+
+    def sql(self, reference_year: Optional[int] = None) -> Tuple[str, List, List[Dict]]:
+        """WHERE clause over the OMOP `person p`, its parameters and the predicates left out"""
+        criteria, not_applied = self.ehr_criteria()
+        where, params = compile_criteria(criteria, reference_year)
+        return where, params, not_applied
+
+    def claims_filters(self) -> Dict:
+        """Code-prefix filters over claim lines; demographics, drugs, labs and free text are not_applied"""
+        plan = {"inclusion": [], "exclusion": [], "not_applied": []}
+        for side in ("inclusion", "exclusion"):
+            for predicate in getattr(self, side):
+                claims = claims_filter(predicate)
+                if claims is None:
+                    plan["not_applied"].append(predicate)
+                else:
+                    plan[side].append(claims)
+        return plan